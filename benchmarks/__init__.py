@@ -0,0 +1 @@
+"""Benchmarks of the BVH conversion stages, see benchmarks.__main__."""
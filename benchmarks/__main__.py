@@ -0,0 +1,195 @@
+from __future__ import print_function, division
+import sys
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.stages import benchmark
+from benchmarks.synthetic import ROTATION_ORDERS, generate_bvh
+from bvh_converter.writers import WRITERS
+
+"""
+Benchmarks of the BVH conversion stages.
+
+    python -m benchmarks run --out before.json
+    (change something)
+    python -m benchmarks run --out after.json
+    python -m benchmarks compare before.json after.json --threshold 10
+
+run times every stage of a suite of synthetic files (see CASES) and
+writes the results as JSON.  compare lists the change of every stage and
+exits with status 1 if any stage got slower by more than the threshold.
+generate writes a single synthetic file for experiments.
+"""
+
+# Version of the results file layout
+RESULTS_VERSION = 1
+
+CASES = {
+    "default": {"joints": 60, "depth": 8, "fanout": 3},
+    "wide": {"joints": 60, "depth": 3, "fanout": 30},
+    "deep": {"joints": 60, "depth": 60, "fanout": 1},
+    "six_channel": {"joints": 60, "depth": 8, "fanout": 3, "six_channel": 0.5},
+    "large_rig": {"joints": 200, "depth": 12, "fanout": 4},
+}
+
+
+def git_commit():
+    """Return the commit the benchmarked code is at, or None outside a git checkout."""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=devnull,
+                                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def add_rig_arguments(parser):
+    parser.add_argument("--joints", type=int, help='Number of joints, end sites excluded.')
+    parser.add_argument("--depth", type=int, help='Maximum depth of the joint tree.')
+    parser.add_argument("--fanout", type=int, help='Maximum number of children per joint.')
+    parser.add_argument("--orders", type=str,
+                        help='Comma separated rotation orders given to the joints in turn '
+                             '(default: {}).'.format(",".join(ROTATION_ORDERS)))
+    parser.add_argument("--six-channel", type=float,
+                        help='Fraction of non-root joints with position channels too (default: 0).')
+    parser.add_argument("--seed", type=int, default=0, help='Random seed (default: 0).')
+
+
+def rig_parameters(args, base=None):
+    """Combine the rig options given on the command line with the defaults in base."""
+    params = dict(base or {})
+    for name in ("joints", "depth", "fanout", "six_channel"):
+        value = getattr(args, name)
+        if value is not None:
+            params[name] = value
+    if args.orders:
+        params["rotation_orders"] = args.orders.upper().split(",")
+    params["seed"] = args.seed
+    return params
+
+
+def run(args):
+    # Rig options change the chosen cases, or make up a single custom case.
+    custom = any(getattr(args, name) is not None for name in ("joints", "depth", "fanout", "orders", "six_channel"))
+    if custom and not args.case:
+        cases = {"custom": rig_parameters(args, CASES["default"])}
+    else:
+        cases = dict((name, rig_parameters(args, CASES[name])) for name in args.case or CASES)
+
+    results = {"version": RESULTS_VERSION,
+               "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "commit": git_commit(),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "platform": platform.platform(),
+               "frames": args.frames,
+               "repeat": args.repeat,
+               "cases": {}}
+    directory = tempfile.mkdtemp(prefix="bvh-bench-")
+    try:
+        for name in sorted(cases):
+            params = cases[name]
+            filename = os.path.join(directory, name + ".bvh")
+            channels = generate_bvh(filename, frames=args.frames, **params)
+            stages = benchmark(filename, args.frames, args.repeat, args.formats)
+            results["cases"][name] = {"params": params, "channels": channels,
+                                      "bytes": os.path.getsize(filename), "stages": stages}
+            print(name)
+            for stage in stages:
+                print("  {:<12} {:9.4f}s {:12.0f} frames/s".format(stage, stages[stage]["seconds"],
+                                                                  stages[stage]["fps"] or 0))
+    finally:
+        shutil.rmtree(directory)
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results written to {}".format(args.out))
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    limit = 1 + args.threshold / 100
+    regressions = 0
+    print("{:<14} {:<14} {:>10} {:>10} {:>8}".format("case", "stage", "base", "new", "change"))
+    for case in sorted(set(base["cases"]) & set(new["cases"])):
+        base_stages = base["cases"][case]["stages"]
+        new_stages = new["cases"][case]["stages"]
+        for stage in sorted(set(base_stages) & set(new_stages)):
+            before = base_stages[stage]["seconds"]
+            after = new_stages[stage]["seconds"]
+            change = after / before - 1 if before > 0 else 0.
+            flag = ""
+            # Very short stages are mostly noise
+            if after > before * limit and max(before, after) >= args.min_seconds:
+                flag = "  REGRESSION"
+                regressions += 1
+            print("{:<14} {:<14} {:9.4f}s {:9.4f}s {:+7.1f}%{}".format(
+                case, stage, before, after, 100 * change, flag))
+    if regressions:
+        print("{} stage(s) slower by more than {}%".format(regressions, args.threshold))
+        sys.exit(1)
+
+
+def generate(args):
+    params = rig_parameters(args, CASES["default"])
+    channels = generate_bvh(args.filename, frames=args.frames, **params)
+    print("Wrote {} ({} channels, {} frames)".format(args.filename, channels, args.frames))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Benchmark the BVH conversion stages.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run", help='Time the stages and write the results as JSON.')
+    run_parser.add_argument("--out", type=str, default="benchmark.json",
+                            help='Results file (default: benchmark.json).')
+    run_parser.add_argument("--frames", type=int, default=2000, help='Frames per file (default: 2000).')
+    run_parser.add_argument("--repeat", type=int, default=3,
+                            help='Runs per case; the best time counts (default: 3).')
+    run_parser.add_argument("--case", action='append', choices=sorted(CASES),
+                            help='Case to run, may be repeated (default: all).')
+    run_parser.add_argument("--formats", type=lambda s: s.split(","), default=["csv"],
+                            help='Comma separated export formats to time, out of {} (default: csv).'
+                                 .format(", ".join(sorted(WRITERS))))
+    add_rig_arguments(run_parser)
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser("compare", help='Compare two results files.')
+    compare_parser.add_argument("base", help='Results to compare against.')
+    compare_parser.add_argument("new", help='New results.')
+    compare_parser.add_argument("--threshold", type=float, default=10.,
+                                help='Slowdown in percent that counts as a regression (default: 10).')
+    compare_parser.add_argument("--min-seconds", type=float, default=0.001,
+                                help='Ignore stages shorter than this in both runs (default: 0.001).')
+    compare_parser.set_defaults(func=compare)
+
+    generate_parser = subparsers.add_parser("generate", help='Write a synthetic BVH file.')
+    generate_parser.add_argument("filename", help='Output file.')
+    generate_parser.add_argument("--frames", type=int, default=2000, help='Number of frames (default: 2000).')
+    add_rig_arguments(generate_parser)
+    generate_parser.set_defaults(func=generate)
+
+    args = parser.parse_args()
+    if getattr(args, "formats", None):
+        unknown = [name for name in args.formats if name not in WRITERS]
+        if unknown:
+            parser.error("Unknown format(s): {}".format(", ".join(unknown)))
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
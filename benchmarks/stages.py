@@ -0,0 +1,84 @@
+from __future__ import print_function, division
+import os
+import shutil
+import tempfile
+import time
+
+from bvh_converter.bvhplayer_skeleton import ReadBVH, Skeleton, process_bvhnode, process_bvhkeyframes
+from bvh_converter.writers import WRITERS
+
+"""
+Timing of the conversion stages of one BVH file.
+
+ - hierarchy: tokenizing and parsing the HIERARCHY section
+ - motion: parsing the MOTION section into the keyframes array
+ - skeleton: building the joint tree and the Skeleton
+ - fk: forward kinematics of all frames
+ - export_<format>: writing world positions and rotations
+"""
+
+STAGES = ("hierarchy", "motion", "skeleton", "fk")
+
+
+class _TimedReader(ReadBVH):
+    """Reader noting the time at which the hierarchy was done."""
+
+    def on_hierarchy(self, root):
+        self.hierarchy_done = time.time()
+        ReadBVH.on_hierarchy(self, root)
+
+
+def time_stages(filename, formats=("csv",)):
+    """
+    Convert filename once and time every stage.
+    :param formats: Output formats to time the export of.
+    :return: Dictionary of {stage: seconds}.
+    :rtype: dict
+    """
+    seconds = {}
+    reader = _TimedReader(filename)
+    start = time.time()
+    reader.read()
+    done = time.time()
+    seconds["hierarchy"] = reader.hierarchy_done - start
+    seconds["motion"] = done - reader.hierarchy_done
+
+    start = time.time()
+    skeleton = Skeleton(process_bvhnode(reader.root), keyframes=reader.keyframes,
+                        frames=reader.frames, dt=reader.dt)
+    seconds["skeleton"] = time.time() - start
+
+    start = time.time()
+    process_bvhkeyframes(skeleton.keyframes, skeleton.root)
+    seconds["fk"] = time.time() - start
+
+    directory = tempfile.mkdtemp(prefix="bvh-bench-")
+    try:
+        for output_format in formats:
+            writer = WRITERS[output_format](os.path.join(directory, output_format), rotations=True)
+            start = time.time()
+            writer.write(skeleton)
+            writer.close()
+            seconds["export_" + output_format] = time.time() - start
+    finally:
+        shutil.rmtree(directory)
+    return seconds
+
+
+def benchmark(filename, frames, repeat=3, formats=("csv",)):
+    """
+    Time the stages of filename repeat times.
+    :param frames: Number of frames in filename, for the frame rates.
+    :return: Dictionary of {stage: {"seconds": best time, "median": median time,
+        "fps": frames per second at the best time}}.
+    :rtype: dict
+    """
+    runs = [time_stages(filename, formats) for _ in range(repeat)]
+    results = {}
+    for stage in runs[0]:
+        times = sorted(run[stage] for run in runs)
+        best = times[0]
+        results[stage] = {"seconds": best,
+                          "median": times[len(times) // 2],
+                          "fps": frames / best if best > 0 else None}
+    return results
@@ -0,0 +1,101 @@
+from __future__ import print_function, division
+
+import numpy as np
+
+"""
+Deterministic synthetic BVH files.
+
+The same parameters and seed always produce the same file, so timings of
+different commits are measured on identical input.
+"""
+
+ROTATION_ORDERS = ("ZXY", "XYZ", "YZX", "ZYX", "XZY", "YXZ")
+
+
+def build_tree(joints, depth, fanout, seed=0):
+    """
+    Lay out a joint tree.
+    :param joints: Number of joints, including the root (end sites excluded).
+    :param depth: Maximum number of joints from the root to a leaf.
+    :param fanout: Maximum number of children per joint.
+    :return: List of parent indices, -1 for the root; parents come first.
+    :rtype: list
+    """
+    if joints > 1 and (depth < 2 or fanout < 1):
+        raise ValueError("A tree of depth {} and fan-out {} holds only one joint".format(depth, fanout))
+    rng = np.random.RandomState(seed)
+    parents = [-1]
+    levels = [0]
+    children = [0]
+    open_joints = [0] if depth > 1 else []
+    while len(parents) < joints:
+        if not open_joints:
+            raise ValueError("A tree of depth {} and fan-out {} can't hold {} joints"
+                             .format(depth, fanout, joints))
+        parent = open_joints[rng.randint(len(open_joints))]
+        parents.append(parent)
+        levels.append(levels[parent] + 1)
+        children.append(0)
+        children[parent] += 1
+        if children[parent] == fanout:
+            open_joints.remove(parent)
+        if levels[-1] + 1 < depth:
+            open_joints.append(len(parents) - 1)
+    return parents
+
+
+def generate_bvh(filename, joints=60, depth=8, fanout=3, frames=1000,
+                 rotation_orders=ROTATION_ORDERS, six_channel=0., frame_time=1. / 120, seed=0):
+    """
+    Write a synthetic BVH file.
+    :param filename: Output file name.
+    :param joints: Number of joints, including the root; every leaf also gets an end site.
+    :param depth: Maximum depth of the joint tree.
+    :param fanout: Maximum number of children per joint.
+    :param frames: Number of motion frames.
+    :param rotation_orders: Rotation orders such as "ZXY", assigned to the joints in turn.
+    :param six_channel: Fraction of the non-root joints that get position channels as well.
+    :param frame_time: Frame time in seconds.
+    :param seed: Random seed.
+    :return: Total number of channels.
+    :rtype: int
+    """
+    parents = build_tree(joints, depth, fanout, seed)
+    rng = np.random.RandomState(seed + 1)
+    offsets = rng.uniform(-10., 10., (joints, 3))
+    offsets[0] = 0.
+    six = set(np.flatnonzero(rng.uniform(size=joints) < six_channel).tolist()) - {0}
+    kids = [[] for _ in parents]
+    for j, parent in enumerate(parents[1:], 1):
+        kids[parent].append(j)
+
+    lines = ["HIERARCHY"]
+    num_channels = [0]
+
+    def write_joint(j, indent):
+        tabs = "\t" * indent
+        lines.append(tabs + ("ROOT Hips" if j == 0 else "JOINT J{}".format(j)))
+        lines.append(tabs + "{")
+        lines.append(tabs + "\tOFFSET {:.6f} {:.6f} {:.6f}".format(*offsets[j]))
+        channels = ["{}rotation".format(axis) for axis in rotation_orders[j % len(rotation_orders)]]
+        if j == 0 or j in six:
+            channels = ["Xposition", "Yposition", "Zposition"] + channels
+        lines.append(tabs + "\tCHANNELS {} {}".format(len(channels), " ".join(channels)))
+        num_channels[0] += len(channels)
+        for child in kids[j]:
+            write_joint(child, indent + 1)
+        if not kids[j]:
+            lines.extend([tabs + "\tEnd Site", tabs + "\t{",
+                          tabs + "\t\tOFFSET 0.000000 5.000000 0.000000", tabs + "\t}"])
+        lines.append(tabs + "}")
+
+    write_joint(0, 0)
+    lines.extend(["MOTION", "Frames: {}".format(frames), "Frame Time: {:.6f}".format(frame_time)])
+
+    with open(filename, "w") as f:
+        f.write("\n".join(lines) + "\n")
+        block = 4096
+        for start in range(0, frames, block):
+            values = rng.uniform(-180., 180., (min(block, frames - start), num_channels[0]))
+            np.savetxt(f, values, fmt="%.4f")
+    return num_channels[0]
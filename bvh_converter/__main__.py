@@ -1,11 +1,22 @@
 from __future__ import print_function, division
 import sys
-import csv
 import argparse
+import json
 import os
-import io
+import glob
+import multiprocessing
+import signal
+import threading
+import time
 
-from bvh_converter.bvhplayer_skeleton import process_bvhfile, process_bvhkeyframe
+from bvh_converter.bvhplayer_skeleton import (DTYPES, process_bvhfile, process_bvhkeyframes,
+                                               process_bvhfile_chunks, process_bvhfile_follow)
+from bvh_converter.cache import ParseCache
+from bvh_converter.parallel import process_bvhkeyframes_parallel
+from bvh_converter.rigs import RIG_CACHE
+from bvh_converter.rotations import REPRESENTATIONS
+from bvh_converter.stats import NO_STATS, ConversionStats
+from bvh_converter.writers import WRITERS, COMPRESSIONS
 
 """
 Based on: http://www.dcs.shef.ac.uk/intranet/research/public/resmes/CS0111.pdf
@@ -15,58 +26,404 @@ Notes:
  - End sites are semi important (used to calculate length of the toe? vectors)
 """
 
+# Extensions of compressed input files, stripped before naming the outputs
+INPUT_COMPRESSIONS = (".gz", ".bz2", ".xz")
+BVH_EXTENSIONS = (".bvh",) + tuple(".bvh" + extension for extension in INPUT_COMPRESSIONS)
 
-def open_csv(filename, mode='r'):
-    """Open a csv file in proper mode depending on Python version."""
-    if sys.version_info < (3,):
-        return io.open(filename, mode=mode+'b')
+
+def output_base(file_in):
+    """Strip the .bvh extension, and a compression extension after it, from file_in."""
+    for extension in INPUT_COMPRESSIONS:
+        if file_in.lower().endswith(extension):
+            file_in = file_in[:-len(extension)]
+            break
+    return file_in[:-4]
+
+
+def colliding_outputs(files):
+    """
+    Find files whose outputs would have the same names, such as walk.bvh
+    and walk.bvh.gz, or one file given by two different paths.
+    :return: List of the groups of files sharing an output base.
+    :rtype: list
+    """
+    groups = {}
+    for file_in in files:
+        key = os.path.normcase(os.path.realpath(output_base(file_in)))
+        groups.setdefault(key, []).append(file_in)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def convert_stream(file_in, writer, chunk_frames=1024, select=None, start=None, end=None, step=None,
+                   keep_orientations=False, stats=NO_STATS, rigs=None, dtype=DTYPES["float64"]):
+    """Convert file_in chunk_frames frames at a time, handing each chunk
+    to writer before the next one is read.  Returns the number of frames."""
+    num_frames = 0
+    for skeleton in process_bvhfile_chunks(file_in, chunk_frames, select=select,
+                                           start=start, end=end, step=step,
+                                           keep_orientations=keep_orientations, stats=stats, rigs=rigs,
+                                           dtype=dtype):
+        num_frames += len(skeleton.keyframes)
+        with stats.stage("write", len(skeleton.keyframes)):
+            writer.write(skeleton)
+    return num_frames
+
+
+def convert_follow(file_in, writer, args, keep_orientations=False, stats=NO_STATS):
+    """Convert file_in while it is being written (--follow), flushing the
+    outputs after every batch of new frames, until no data was appended
+    for args.follow_timeout seconds or Ctrl-C is pressed.  Returns the
+    number of frames."""
+    stop = threading.Event()
+    try:
+        # Ctrl-C ends following after the current batch
+        previous = signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    except ValueError:  # Only the main thread can handle signals
+        previous = None
+    num_frames = 0
+    try:
+        for skeleton in process_bvhfile_follow(file_in, args.chunk_frames, select=args.joints,
+                                               start=args.start, end=args.end, step=args.step,
+                                               keep_orientations=keep_orientations, stats=stats,
+                                               rigs=RIG_CACHE, poll_interval=args.poll_interval,
+                                               timeout=args.follow_timeout, stop=stop,
+                                               dtype=DTYPES[args.dtype]):
+            num_frames += len(skeleton.keyframes)
+            with stats.stage("write", len(skeleton.keyframes)):
+                writer.write(skeleton)
+                writer.flush()
+    finally:
+        if previous is not None:
+            signal.signal(signal.SIGINT, previous)
+    return num_frames
+
+
+def convert_file(file_in, args, stats=NO_STATS, outputs=None):
+    """Convert file_in as requested by the command line arguments args.
+    Returns the number of frames converted.  stats records the stages.
+    Hierarchies go through RIG_CACHE, so a batch of clips of the same rig
+    parses it once per process.
+    The (description, filename) pairs of the outputs are appended to outputs."""
+    options = {"rotation_format": args.rotation_format, "rotation_space": args.rotation_space}
+    if args.format == "csv":
+        options.update(precision=args.precision, compression=args.compress)
+    writer = WRITERS[args.format](output_base(file_in), rotations=args.rotation, **options)
+    # Global rotation matrices come straight out of the forward kinematics.
+    keep_orientations = args.rotation_space != "local" and args.rotation_format in ("matrix", "6d")
+
+    try:
+        if args.follow:
+            print("Following {} (Ctrl-C to stop)...".format(file_in))
+            num_frames = convert_follow(file_in, writer, args, keep_orientations, stats)
+            print("done")
+        elif args.stream:
+            print("Converting frames...")
+            num_frames = convert_stream(file_in, writer, args.chunk_frames, args.joints,
+                                        args.start, args.end, args.step, keep_orientations, stats, RIG_CACHE,
+                                        DTYPES[args.dtype])
+            print("done")
+        else:
+            cache = None
+            if args.cache_dir:
+                cache = ParseCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024,
+                                   use_hash=args.cache_key == "hash")
+            other_s = process_bvhfile(file_in, cache=cache, select=args.joints,
+                                      start=args.start, end=args.end, step=args.step,
+                                      keep_orientations=keep_orientations, stats=stats, rigs=RIG_CACHE,
+                                      dtype=DTYPES[args.dtype])
+            num_frames = len(other_s.keyframes)
+
+            print("Analyzing frames...")
+            with stats.stage("fk", num_frames):
+                if args.fk_jobs == 1:
+                    process_bvhkeyframes(other_s.keyframes, other_s.root)
+                else:
+                    process_bvhkeyframes_parallel(other_s, args.fk_jobs)
+            print("done")
+            with stats.stage("write", num_frames):
+                writer.write(other_s)
+    finally:
+        with stats.stage("close"):
+            writer.close()
+    for _, file_out in writer.outputs:
+        if os.path.exists(file_out):
+            stats.add_bytes_written(os.path.getsize(file_out))
+
+    if outputs is not None:
+        outputs.extend(writer.outputs)
+
+    for description, file_out in writer.outputs:
+        print("{} Output file: {}".format(description, file_out))
+    return num_frames
+
+
+def convert_task(task):
+    """Convert one file of a batch without printing progress.
+    :param task: Tuple of (filename, command line arguments).
+    :return: Tuple of (filename, frames converted, seconds, error message or None,
+        profile or None, list of (description, output filename)).
+    :rtype: tuple
+    """
+    file_in, args = task
+    start = time.time()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    stats = ConversionStats(track_memory=args.track_memory) if args.profile else NO_STATS
+    outputs = []
+    try:
+        num_frames = convert_file(file_in, args, stats, outputs)
+        error = None
+    except Exception as e:
+        num_frames = 0
+        error = "{}: {}".format(type(e).__name__, e)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    seconds = time.time() - start
+    return (file_in, num_frames, seconds, error, profile_entry(file_in, num_frames, seconds, error, stats),
+            outputs)
+
+
+def profile_entry(file_in, num_frames, seconds, error, stats):
+    """Return the --profile record of one file, or None if profiling is off."""
+    if not stats.enabled:
+        return None
+    stats.close()
+    entry = stats.as_dict()
+    entry.update(file=file_in, frames=num_frames, seconds=seconds, error=error)
+    return entry
+
+
+def write_profile(entries, destination, stdout=None):
+    """Write the --profile records as JSON to destination, "-" for stdout
+    (or the stream given as stdout)."""
+    text = json.dumps({"files": entries}, indent=2)
+    if destination == "-":
+        print(text, file=stdout or sys.stdout)
     else:
-        return io.open(filename, mode=mode, newline='')
-    
+        with open(destination, "w") as f:
+            f.write(text + "\n")
 
-def main():
-    parser = argparse.ArgumentParser(
+
+def find_inputs(patterns):
+    """
+    Expand file names, directories and glob patterns to BVH files.
+    Directories are searched recursively for .bvh files, compressed or not.
+    :return: Tuple of (files found, patterns that matched nothing).
+    :rtype: tuple
+    """
+    files = []
+    missing = []
+    for pattern in patterns:
+        if os.path.exists(pattern):
+            paths = [pattern]
+        else:
+            paths = sorted(glob.glob(pattern))
+            if not paths:
+                missing.append(pattern)
+        for path in paths:
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirnames.sort()
+                    files.extend(os.path.join(dirpath, name) for name in sorted(filenames)
+                                 if name.lower().endswith(BVH_EXTENSIONS))
+            else:
+                files.append(path)
+    # Drop duplicates, keeping the order
+    seen = set()
+    files = [f for f in files if not (f in seen or seen.add(f))]
+    return files, missing
+
+
+def convert_batch(files, args, profiles=None):
+    """Convert files, args.jobs at a time, and print a line per file and a summary.
+    Returns the number of files that failed.  The --profile records of the
+    files are appended to profiles."""
+    tasks = [(file_in, args) for file_in in files]
+    jobs = args.jobs or multiprocessing.cpu_count()
+    start = time.time()
+    pool = None
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        results = pool.imap_unordered(convert_task, tasks)
+    else:
+        results = (convert_task(task) for task in tasks)
+
+    failed = 0
+    total_frames = 0
+    try:
+        for file_in, num_frames, seconds, error, profile, _ in results:
+            if profiles is not None and profile is not None:
+                profiles.append(profile)
+            if error is None:
+                total_frames += num_frames
+                print("OK      {} ({} frames, {:.2f}s)".format(file_in, num_frames, seconds))
+            else:
+                failed += 1
+                print("FAILED  {} ({})".format(file_in, error))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = max(time.time() - start, 1e-9)
+    print("Converted {} of {} files in {:.2f}s ({:.1f} files/s, {:.0f} frames/s)".format(
+        len(files) - failed, len(files), elapsed, (len(files) - failed) / elapsed, total_frames / elapsed))
+    return failed
+
+
+def build_parser(parser_class=argparse.ArgumentParser):
+    """Return the command line parser, an instance of parser_class."""
+    parser = parser_class(
         description="Extract joint location and optionally rotation data from BVH file format.")
-    parser.add_argument("filename", type=str, help='BVH file for conversion.')
+    parser.add_argument("filenames", type=str, nargs='+', metavar='filename',
+                        help='BVH files, directories or glob patterns for conversion.')
     parser.add_argument("-r", "--rotation", action='store_true', help='Write rotations to CSV as well.')
-    args = parser.parse_args()
+    parser.add_argument("--rotation-format", choices=sorted(REPRESENTATIONS), default="euler",
+                        help='Rotation output as the Euler angles of the file, quaternions (W, X, Y, Z), '
+                             '3x3 matrices or the first two matrix columns (6d) (default: euler). '
+                             'Implies -r unless euler.')
+    parser.add_argument("--rotation-space", choices=("local", "global", "both"), default="local",
+                        help='Write rotations relative to the parent joint, to the world (to an extra '
+                             '_global_rotations output) or both (default: local).  Implies -r unless local.')
+    parser.add_argument("--joints", action='append',
+                        help='Comma separated joint names or patterns such as "*Hand*" to convert; '
+                             'may be given more than once (default: all joints).')
+    parser.add_argument("--start", type=int,
+                        help='First frame to convert, counting from 0 (default: 0).')
+    parser.add_argument("--end", type=int,
+                        help='Frame to stop before (default: convert to the end of the clip).')
+    parser.add_argument("--step", type=int,
+                        help='Convert only every Nth frame (default: 1).')
+    parser.add_argument("-f", "--format", choices=sorted(WRITERS), default="csv",
+                        help='Output format: CSV tables, .npy arrays of shape (frames, joints, 3) with a '
+                             '_skeleton.npz of joint names, parents and times, or all of it in one .npz '
+                             '(default: csv).')
+    parser.add_argument("--dtype", choices=sorted(DTYPES), default="float64",
+                        help='Floating point type to parse, compute and write in; float32 halves the memory '
+                             'and is accurate to about 7 significant digits (default: float64).')
+    parser.add_argument("--precision", type=int,
+                        help='Number of decimal places in CSV output (default: shortest exact representation).')
+    parser.add_argument("--compress", choices=COMPRESSIONS,
+                        help='Compress CSV output, adding the extension to the output file names.')
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help='Number of files to convert in parallel, 0 for one per CPU (default: 1).')
+    parser.add_argument("--fk-jobs", type=int, default=1,
+                        help='Number of processes sharing the frames of each file, 0 for one per CPU '
+                             '(default: 1).')
+    parser.add_argument("--stream", action='store_true',
+                        help='Read, convert and write a few frames at a time to keep memory use constant.')
+    parser.add_argument("--chunk-frames", type=int, default=1024,
+                        help='Number of frames per chunk in stream mode (default: 1024).')
+    parser.add_argument("--follow", action='store_true',
+                        help='Keep converting frames as they are appended to a file that is still being '
+                             'written, like tail -f, until Ctrl-C or --follow-timeout.  The Frames: count '
+                             'is ignored.')
+    parser.add_argument("--poll-interval", type=float, default=0.1,
+                        help='Seconds between checks for new frames in follow mode (default: 0.1).')
+    parser.add_argument("--follow-timeout", type=float,
+                        help='Stop following once no data was appended for this many seconds '
+                             '(default: until Ctrl-C).')
+    parser.add_argument("--profile", metavar='FILE',
+                        help='Record the time, frame rate and process memory use (peak resident set size) '
+                             'after every stage and the bytes read and written, and write them as JSON to '
+                             'FILE, or to standard output for "-", with the progress messages moved to '
+                             'standard error.')
+    parser.add_argument("--track-memory", action='store_true',
+                        help='Also trace the peak memory allocated during each stage for --profile.  '
+                             'This slows the conversion down considerably.')
+    parser.add_argument("--cache-dir", type=str,
+                        help='Directory for caching parsed BVH files between runs.')
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help='Maximum size of the cache directory in MB (default: 1024).')
+    parser.add_argument("--cache-key", choices=("hash", "mtime"), default="hash",
+                        help='Find cached files by a hash of their contents, or by their path, size and '
+                             'modification time, which skips reading the file on a hit (default: hash).')
+    return parser
+
 
-    file_in = args.filename
-    do_rotations = args.rotation
+def check_rotation_arguments(parser, args):
+    """Check --rotation-format and --rotation-space, which imply -r unless
+    they are the defaults."""
+    if args.rotation_format == "euler" and args.rotation_space != "local":
+        parser.error("global rotations need --rotation-format quat, matrix or 6d")
+    if args.rotation_format != "euler" or args.rotation_space != "local":
+        args.rotation = True
 
-    if not os.path.exists(file_in):
-        print("Error: file {} not found.".format(file_in))
+
+def check_arguments(parser, args):
+    """Check the combination of command line arguments args, calling
+    parser.error on a conflict, and fill in the options they imply."""
+    if (args.stream or args.follow) and args.fk_jobs != 1:
+        parser.error("--fk-jobs can't be combined with --stream or --follow")
+    if args.follow and args.stream:
+        parser.error("--follow can't be combined with --stream")
+    if (args.stream or args.follow) and args.cache_dir:
+        parser.error("--cache-dir can't be combined with --stream or --follow")
+    if args.track_memory and not args.profile:
+        parser.error("--track-memory needs --profile")
+    if args.poll_interval <= 0:
+        parser.error("--poll-interval must be positive")
+    if args.format != "csv" and (args.precision is not None or args.compress):
+        parser.error("--precision and --compress only apply to CSV output")
+    check_rotation_arguments(parser, args)
+    if any(value is not None and value < 0 for value in (args.start, args.end)):
+        parser.error("--start and --end can't be negative")
+    if args.step is not None and args.step < 1:
+        parser.error("--step must be at least 1")
+    if args.joints is not None:
+        args.joints = [name.strip() for names in args.joints for name in names.split(",") if name.strip()]
+        if not args.joints:
+            parser.error("--joints needs at least one joint name")
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+    check_arguments(parser, args)
+    stdout = sys.stdout
+    if args.profile == "-":
+        # Keep standard output for the JSON profile alone.
+        sys.stdout = sys.stderr
+
+    files, missing = find_inputs(args.filenames)
+    for pattern in missing:
+        print("Error: file {} not found.".format(pattern))
+    if not files:
         sys.exit(0)
-    print("Input filename: {}".format(file_in))
-
-    other_s = process_bvhfile(file_in)
-
-    print("Analyzing frames...")
-    for i in range(other_s.frames):
-        new_frame = process_bvhkeyframe(other_s.keyframes[i], other_s.root,
-                                        other_s.dt * i)
-    print("done")
-    
-    file_out = file_in[:-4] + "_worldpos.csv"
-
-    with open_csv(file_out, 'w') as f:
-        writer = csv.writer(f)
-        header, frames = other_s.get_frames_worldpos()
-        writer.writerow(header)
-        for frame in frames:
-            writer.writerow(frame)
-    print("World Positions Output file: {}".format(file_out))
-
-    if do_rotations:
-        file_out = file_in[:-4] + "_rotations.csv"
-    
-        with open_csv(file_out, 'w') as f:
-            writer = csv.writer(f)
-            header, frames = other_s.get_frames_rotations()
-            writer.writerow(header)
-            for frame in frames:
-                writer.writerow(frame)
-        print("Rotations Output file: {}".format(file_out))
+
+    if args.follow and (len(args.filenames) != 1 or files != args.filenames):
+        parser.error("--follow takes a single file")
+
+    if len(args.filenames) == 1 and files == args.filenames:
+        # A single file: convert it here and show the progress.
+        file_in = files[0]
+        print("Input filename: {}".format(file_in))
+        stats = ConversionStats(track_memory=args.track_memory) if args.profile else NO_STATS
+        start = time.time()
+        try:
+            num_frames = convert_file(file_in, args, stats)
+        except (SyntaxError, ValueError, IOError) as e:
+            # E.g. a followed file that ends inside its hierarchy
+            print("Error: {}: {}".format(file_in, e), file=sys.stderr)
+            sys.exit(1)
+        if args.profile:
+            write_profile([profile_entry(file_in, num_frames, time.time() - start, None, stats)],
+                          args.profile, stdout)
+        return
+
+    collisions = colliding_outputs(files)
+    for group in collisions:
+        print("Error: {} would write the same output files.".format(", ".join(group)))
+    if collisions:
+        sys.exit(1)
+
+    profiles = []
+    failed = convert_batch(files, args, profiles)
+    if args.profile:
+        write_profile(profiles, args.profile, stdout)
+    if failed or missing:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,166 @@
+from __future__ import print_function, division
+import io
+
+import numpy as np
+
+from bvh_converter.bvh import detect_compression, open_compressed
+from bvh_converter.bvhplayer_skeleton import ReadBVH, Skeleton, build_joints, process_bvhkeyframes
+from bvh_converter.rigs import RIG_CACHE
+from bvh_converter.writers import joint_names, joint_parents
+
+"""
+In-memory conversion of BVH data.
+
+parse_bvh and load_bvh take BVH data that is already in memory or comes
+from any file-like object, e.g. a payload received over the network:
+
+    arrays = load_bvh(payload)
+    arrays["worldpos"]  # (frames, joints, 3)
+
+ - bytes (or bytearray): the contents of a BVH file, possibly compressed
+   with gzip, bzip2 or xz (told by the first bytes), decoded as UTF-8
+ - str (unicode): BVH text; never taken for a filename
+ - a binary file-like object: read like bytes; it isn't closed
+ - a text file-like object: read as is; it isn't closed
+
+dtype float32 parses the motion and runs the forward kinematics in single
+precision, halving the memory of the keyframes and results.  Mocap data
+is rarely accurate beyond 1e-4, well within float32; world positions
+differ from float64 by at most about 1e-6 times the distance of the
+joint from the origin plus the length of its chain of bones, for
+hierarchies up to ~30 joints deep.
+
+Nothing is read from or written to the filesystem and nothing is printed.
+Every call builds its own reader, joints and arrays, so calls may run
+concurrently in several threads.  Hierarchies are compiled through the
+shared, thread-safe bvh_converter.rigs.RIG_CACHE by default, so clips of
+a rig that was seen before only have their motion parsed.
+"""
+
+if bytes is str:  # Python 2
+    text_type = unicode  # noqa: F821
+else:
+    text_type = str
+
+
+def _binary_text(binary):
+    """Return a text file object reading the binary file object binary,
+    decompressing it if needed."""
+    if hasattr(binary, "seek") and (not hasattr(binary, "seekable") or binary.seekable()):
+        position = binary.tell()
+        head = binary.read(6)
+        binary.seek(position)
+    else:
+        binary = io.BytesIO(binary.read())
+        head = binary.getvalue()[:6]
+    compression = detect_compression(head)
+    if compression is not None:
+        binary = open_compressed(binary, compression)
+    if not hasattr(binary, "readable"):  # Python 2 file objects
+        binary = io.BytesIO(binary.read())
+    return io.TextIOWrapper(binary, encoding="utf-8", newline=None)
+
+
+def _float_type(dtype):
+    """Return numpy.float32 or numpy.float64 for dtype, given as a type or a name."""
+    dtype = np.dtype(dtype).type
+    if dtype not in (np.float32, np.float64):
+        raise ValueError("dtype must be float32 or float64, got {}".format(np.dtype(dtype).name))
+    return dtype
+
+
+def parse_bvh(source, select=None, start=None, end=None, step=None,
+              keep_trtr=False, keep_orientations=False, rigs=RIG_CACHE, dtype=np.float64):
+    """
+    Parse in-memory BVH data and run the forward kinematics on it.
+    :param source: bytes, str or file-like object, see the module documentation.
+    :param select: Joint name patterns to keep, see Skeleton.
+    :param start: First frame to keep.
+    :param end: Frame to stop at (excluded).
+    :param step: Keep every step-th frame.
+    :param keep_trtr: Keep the joint transforms (Skeleton.trtr).
+    :param keep_orientations: Keep the global joint orientations (Skeleton.orientations).
+    :param rigs: RigCache compiling the hierarchy, or None to parse it every time.
+    :param dtype: numpy.float64 or numpy.float32 (or their names), the
+        precision of the keyframes, the computation and the results.
+    :return: Skeleton whose world positions and rotations are filled in.
+    :rtype: Skeleton
+    """
+    if isinstance(source, (bytes, bytearray)):
+        text = _binary_text(io.BytesIO(bytes(source)))
+    elif isinstance(source, text_type):
+        text = io.StringIO(source)
+    elif hasattr(source, "read"):
+        if isinstance(source, io.TextIOBase) or isinstance(source.read(0), text_type):
+            text = source
+        else:
+            text = _binary_text(source)
+    else:
+        raise TypeError("Expected bytes, str or a file-like object, got {}".format(type(source).__name__))
+
+    my_bvh = ReadBVH(None)
+    my_bvh.frame_range = slice(start, end, step)
+    my_bvh.rig_cache = rigs
+    my_bvh.dtype = _float_type(dtype)
+    try:
+        my_bvh.read_file(text)
+    finally:
+        if text is not source and isinstance(text, io.TextIOWrapper):
+            text.detach()  # Leave the caller's object open
+
+    hips, joints = build_joints(my_bvh)
+    if hasattr(my_bvh, "frames"):
+        first, _, step = my_bvh.frame_indices(my_bvh.frames)
+        keyframes = my_bvh.keyframes
+        dt = my_bvh.dt
+    else:  # No MOTION section
+        first, step = 0, 1
+        keyframes = np.empty((0, my_bvh.num_channels), dtype=my_bvh.dtype)
+        dt = .033333333
+    skeleton = Skeleton(hips, keyframes=keyframes, frames=len(keyframes), dt=dt,
+                        keep_trtr=keep_trtr, select=select, start_frame=first, frame_step=step,
+                        keep_orientations=keep_orientations, joints=joints, rig=my_bvh.rig)
+    process_bvhkeyframes(skeleton.keyframes, skeleton.root)
+    return skeleton
+
+
+def load_bvh(source, select=None, start=None, end=None, step=None, keep_orientations=False,
+             rigs=RIG_CACHE, dtype=np.float64):
+    """
+    Convert in-memory BVH data to NumPy arrays.
+    :param source: bytes, str or file-like object, see the module documentation.
+    :param select: Joint name patterns to keep, see Skeleton.
+    :param start: First frame to keep.
+    :param end: Frame to stop at (excluded).
+    :param step: Keep every step-th frame.
+    :param keep_orientations: Add the global joint orientations.
+    :param rigs: RigCache compiling the hierarchy, or None to parse it every time.
+    :param dtype: numpy.float64 or numpy.float32, the type of worldpos,
+        rotations and orientations (see parse_bvh).
+    :return: Dictionary of
+        worldpos: (frames, joints, 3) world positions,
+        rotations: (frames, joints, 3) local rotation channel values in (x, y, z) order,
+        orientations: (frames, joints, 3, 3) global rotation matrices, with keep_orientations only,
+        time: (frames,) time of every frame in seconds,
+        joints: (joints,) joint names,
+        parents: (joints,) index of every joint's parent, -1 for the root,
+        offsets: (joints, 3) joint offsets from their parents,
+        channels: list of the channel names of every joint,
+        dt: frame time in seconds,
+        rig: key of the hierarchy (see bvh_converter.rigs), None without rigs.
+    :rtype: dict
+    """
+    skeleton = parse_bvh(source, select=select, start=start, end=end, step=step,
+                         keep_orientations=keep_orientations, rigs=rigs, dtype=dtype)
+    arrays = {"worldpos": skeleton.worldpos,
+              "rotations": skeleton.rotations,
+              "time": skeleton.frame_time(np.arange(len(skeleton.keyframes))),
+              "joints": joint_names(skeleton),
+              "parents": joint_parents(skeleton),
+              "offsets": np.array([joint.strans for joint in skeleton.joints], dtype=float).reshape(-1, 3),
+              "channels": [list(joint.channels) for joint in skeleton.joints],
+              "dt": skeleton.dt,
+              "rig": skeleton.rig.key if skeleton.rig is not None else None}
+    if keep_orientations:
+        arrays["orientations"] = skeleton.orientations
+    return arrays
@@ -40,7 +40,19 @@
 # \file bvh.py
 # Contains the BVHReader class.
 
+import bisect
+import collections
+import io
+import itertools
+import mmap
 import string
+import threading
+import time
+
+import numpy as np
+
+CHANNEL_NAMES = frozenset(["Xposition", "Yposition", "Zposition",
+                           "Xrotation", "Yrotation", "Zrotation"])
 
 
 class Node(object):
@@ -62,14 +74,288 @@ class Node(object):
         return len(self.children) == 0
 
 
+# Magic bytes at the start of compressed files
+COMPRESSION_MAGIC = [(b"\x1f\x8b", "gz"),
+                     (b"BZh", "bz2"),
+                     (b"\xfd7zXZ\x00", "xz")]
+
+
+def detect_compression(head):
+    """Return the compression ("gz", "bz2" or "xz") of data starting with
+    the bytes head, or None for uncompressed data."""
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def get_compression(filename):
+    """Return the compression of filename ("gz", "bz2" or "xz"), judging by
+    its first bytes, or None for an uncompressed file."""
+    with open(filename, 'rb') as f:
+        return detect_compression(f.read(6))
+
+
+def open_compressed(fileobj, compression):
+    """Wrap the binary file object fileobj to decompress it on the fly.
+    Closing the result doesn't close fileobj."""
+    if compression == "gz":
+        import gzip
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if compression == "bz2":
+        import bz2
+        return bz2.BZ2File(fileobj, 'rb')
+    import lzma  # Python 3 only
+    return lzma.LZMAFile(fileobj, 'rb')
+
+
+def open_bvh(filename):
+    """Open a BVH file for reading text, decompressing it on the fly if
+    it is compressed."""
+    compression = get_compression(filename)
+    if compression is None:
+        return open(filename, 'r')
+    if compression == "gz":
+        import gzip
+        binary = gzip.GzipFile(filename, 'rb')
+    elif compression == "bz2":
+        import bz2
+        binary = bz2.BZ2File(filename, 'rb')
+    else:
+        import lzma  # Python 3 only
+        binary = lzma.LZMAFile(filename, 'rb')
+    return io.TextIOWrapper(binary)
+
+
+def parse_frame_lines(lines, num_channels, line_num, line_step=1, dtype=np.float64, line_nums=None):
+    """Convert motion lines to a (len(lines), num_channels) array of dtype.
+
+    line_num is the line number of the first line and line_step the
+    distance between the lines in the file, used for the SyntaxError
+    raised on a malformed line.  line_nums, if given, lists the line
+    number of every line instead, for lines that aren't evenly spaced.
+    """
+    try:
+        values = np.loadtxt(lines, dtype=dtype, comments=None, ndmin=2)
+    except ValueError:
+        values = None
+    # loadtxt skips blank lines, so check the shape as well
+    if values is None or values.shape != (len(lines), num_channels):
+        values = check_frame_lines(lines, num_channels, line_num, line_step, dtype, line_nums)
+    return values.reshape(len(lines), num_channels)
+
+
+def check_frame_lines(lines, num_channels, line_num, line_step=1, dtype=np.float64, line_nums=None):
+    """Convert lines one at a time, raising a SyntaxError on the first
+    malformed line."""
+    if line_nums is None:
+        line_nums = range(line_num, line_num + len(lines) * line_step, line_step)
+    values = []
+    for s, n in zip(lines, line_nums):
+        a = s.split()
+        if len(a) != num_channels:
+            raise SyntaxError("Syntax error in line %d: %d float values "
+                              "expected, got %d instead"
+                              % (n, num_channels, len(a)))
+        for tok in a:
+            try:
+                values.append(float(tok))
+            except ValueError:
+                raise SyntaxError("Syntax error in line %d: Float "
+                                  "expected, got '%s' instead"
+                                  % (n, tok))
+    return np.array(values, dtype=dtype)
+
+
+class MappedMotion(object):
+    """Random access to the motion lines of a BVH file.
+
+    The file is memory-mapped and the byte offsets of the frame lines are
+    indexed on demand, only as far as the highest frame requested so
+    far.  Indexing or slicing returns the channel values of the selected
+    frames, like indexing the (frames, num_channels) keyframes array.
+    """
+
+    # Number of bytes scanned for line breaks in one go
+    block_size = 1 << 24
+
+    def __init__(self, filename, offset, frames, num_channels, line_num, dtype=np.float64):
+        """
+        :param offset: Byte offset of the first motion line.
+        :param line_num: Line number of the first motion line.
+        :param dtype: Floating point type of the values returned.
+        """
+        self.filename = filename
+        self.dtype = dtype
+        self.frames = frames
+        self.num_channels = num_channels
+        self.line_num = line_num
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Start offsets of the lines found so far, in blocks.  _counts[i]
+        # is the number of offsets in the blocks before block i.
+        self._blocks = [np.array([offset])]
+        self._counts = [0]
+        self._scanned = offset
+
+    def __len__(self):
+        return self.frames
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.frames)
+            if step != 1:
+                return self[start:stop][::step]
+            if stop <= start:
+                return np.empty((0, self.num_channels), dtype=self.dtype)
+            lines = [self.line(i) for i in range(start, stop)]
+            return parse_frame_lines(lines, self.num_channels,
+                                     self.line_num + start, dtype=self.dtype)
+        if key < 0:
+            key += self.frames
+        if not 0 <= key < self.frames:
+            raise IndexError("frame %d out of range" % key)
+        return parse_frame_lines([self.line(key)], self.num_channels,
+                                 self.line_num + key, dtype=self.dtype)[0]
+
+    def line(self, i):
+        """Return line i of the motion data as a string."""
+        start = self.offset(i)
+        if i + 1 < self.frames:
+            end = self.offset(i + 1)
+        else:
+            end = self._mmap.find(b"\n", start)
+            if end == -1:
+                end = len(self._mmap)
+        return self._mmap[start:end].decode("latin-1")
+
+    def offset(self, i):
+        """Return the byte offset of line i of the motion data."""
+        while i >= self._counts[-1] + len(self._blocks[-1]):
+            if self._scanned >= len(self._mmap):
+                found = self._counts[-1] + len(self._blocks[-1])
+                raise SyntaxError("Syntax error in line %d: %d frames "
+                                  "expected, got %d instead"
+                                  % (self.line_num + found - 1,
+                                     self.frames, found))
+            self._scan()
+        block = bisect.bisect_right(self._counts, i) - 1
+        return int(self._blocks[block][i - self._counts[block]])
+
+    def _scan(self):
+        """Index the line breaks of the next block of the file."""
+        size = min(self.block_size, len(self._mmap) - self._scanned)
+        buf = np.frombuffer(self._mmap, dtype=np.uint8, count=size,
+                            offset=self._scanned)
+        starts = np.flatnonzero(buf == ord("\n")) + (self._scanned + 1)
+        del buf
+        # A line break at the very end doesn't start another line
+        starts = starts[starts < len(self._mmap)]
+        self._counts.append(self._counts[-1] + len(self._blocks[-1]))
+        self._blocks.append(starts)
+        self._scanned += size
+
+    def close(self):
+        self._mmap.close()
+
+
+class GrowingFile(object):
+    """The complete lines of a file that is still being written.
+
+    Reading from the end of the file waits for more lines to be
+    appended, checking every poll_interval seconds, until the file is
+    finished: when no data was added for timeout seconds (never if
+    timeout is None) or the threading.Event stop is set.  A last line
+    without a line break is only returned once the file is finished.
+    readline() works like the method of a text file, so a BvhReader can
+    read the hierarchy from it.
+    """
+
+    def __init__(self, filename, poll_interval=0.1, timeout=None, stop=None):
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.stop = stop if stop is not None else threading.Event()
+        self.finished = False
+        # Number of lines returned so far
+        self.line_num = 0
+        self._f = open(filename, 'rb')
+        self._partial = b""
+        self._lines = collections.deque()
+
+    def _fill(self):
+        """Take in the data appended since the last call.  Returns the
+        number of bytes read."""
+        data = self._f.read()
+        if data:
+            lines = (self._partial + data).split(b"\n")
+            self._partial = lines.pop()
+            self._lines.extend(lines)
+        return len(data)
+
+    def wait(self):
+        """Wait until a line is available.  Returns False if the file is
+        finished instead."""
+        idle_since = time.time()
+        while not self._lines:
+            if self.finished:
+                return False
+            if self._fill():
+                idle_since = time.time()
+            elif self.stop.is_set() or (self.timeout is not None
+                                        and time.time() - idle_since >= self.timeout):
+                self.finished = True
+                if self._partial:
+                    self._lines.append(self._partial)
+                    self._partial = b""
+            else:
+                self.stop.wait(self.poll_interval)
+        return True
+
+    def available(self, limit):
+        """Return the lines that are available right now, at most limit
+        of them, without waiting."""
+        if len(self._lines) < limit:
+            self._fill()
+        lines = [self._lines.popleft().decode("utf-8") + "\n"
+                 for _ in range(min(limit, len(self._lines)))]
+        self.line_num += len(lines)
+        return lines
+
+    def readline(self):
+        if not self.wait():
+            return ""
+        self.line_num += 1
+        return self._lines.popleft().decode("utf-8") + "\n"
+
+    def close(self):
+        self._f.close()
+
+
 class BvhReader(object):
     """BioVision Hierarchical (.bvh) file reader."""
 
+    # Number of motion lines converted in one go
+    chunk_frames = 4096
+
+    # Frames to read, as a slice of the frame numbers, or None for all.
+    # The lines of other frames are skipped without being converted.
+    frame_range = None
+
+    # Cache of compiled hierarchies (see bvh_converter.rigs.RigCache), or
+    # None to parse every hierarchy.  The Rig of the file is kept in rig.
+    rig_cache = None
+    rig = None
+
+    # Floating point type the motion data is parsed to: numpy.float64, or
+    # numpy.float32 for half the memory at about 7 significant digits.
+    dtype = np.float64
+
     def __init__(self, filename):
 
         self.filename = filename
-        # A list of unprocessed tokens (strings)
-        self._token_list = []
+        # An iterator over the unprocessed tokens (strings)
+        self._tokens = iter(())
         # The current line number
         self._line_num = 0
 
@@ -89,21 +375,103 @@ class BvhReader(object):
     def on_frame(self, values):
         pass
 
+    def on_frames(self, values):
+        """Receive the motion data as one (frames, num_channels) array.
+
+        The default implementation hands each frame to on_frame() as a
+        list of floats, so subclasses that only implement on_frame()
+        keep working.
+        """
+        for row in values:
+            self.on_frame(row.tolist())
+
     def read(self):
         """Read the entire file."""
-        with open(self.filename, 'r') as self._file_handle:
-            self.read_hierarchy()
-            self.on_hierarchy(self.root)
-            self.read_motion()
+        with open_bvh(self.filename) as f:
+            self.read_file(f)
+
+    def read_file(self, f):
+        """Read BVH data from f, an open text file or any other object
+        that iterates over lines and has a readline() method.  The
+        filename isn't used."""
+        self._file_handle = f
+        self._tokens = self.iter_tokens()
+        self.read_hierarchy_section()
+        self.read_motion()
+
+    def read_header(self, f):
+        """Read the hierarchy and the motion header from f, an open text
+        file, leaving it at the first frame line.
+
+        Returns the number of frames the header gives, or None if f
+        ends before the MOTION section.
+        """
+        self._file_handle = f
+        self._tokens = self.iter_tokens()
+        self.read_hierarchy_section()
+        return self.read_motion_header()
+
+    def read_chunks(self, chunk_frames=None):
+        """Read the file, yielding the motion samples in chunks.
+
+        Works like read(), except that instead of passing all frames to
+        on_frames() at once, (n, num_channels) arrays of at most
+        chunk_frames frames are yielded as they are read.
+        """
+        with open_bvh(self.filename) as f:
+            frames = self.read_header(f)
+            if frames is None:
+                return
+            for values in self.iter_frames(frames, chunk_frames):
+                yield values
+
+    def map_motion(self):
+        """Read the hierarchy and the motion header, but map the motion
+        samples instead of reading them.
+
+        Returns a MappedMotion for the frame lines.  Compressed files can't
+        be mapped and raise a ValueError.
+        """
+        if get_compression(self.filename) is not None:
+            raise ValueError("Can't memory-map compressed file %s"
+                             % self.filename)
+        with open(self.filename, 'r') as f:
+            frames = self.read_header(f)
+            if frames is None:
+                frames = 0
+            offset = f.tell()
+        return MappedMotion(self.filename, offset, frames, self.num_channels,
+                            self._line_num + 1, self.dtype)
+
+    def frame_indices(self, frames):
+        """Return (start, stop, step) of the frames selected by frame_range
+        out of a clip of frames frames."""
+        if self.frame_range is None:
+            return 0, frames, 1
+        if self.frame_range.step is not None and self.frame_range.step < 1:
+            raise ValueError("Frame step must be at least 1")
+        return self.frame_range.indices(frames)
 
     def read_motion(self):
         """Read the motion samples."""
-        # No more tokens (i.e. end of file)? Then just return
-        try:
-            tok = self.token()
-        except StopIteration:
+        frames = self.read_motion_header()
+        if frames is None:
             return
 
+        # Read the channel values
+        self.on_frames(self.read_frames(frames))
+
+    def read_motion_header(self):
+        """Read the MOTION, Frames: and Frame Time: lines.
+
+        Returns the number of frames, or None if the file ends before
+        the MOTION section.
+        """
+        # No more tokens (i.e. end of file)? Then just return
+        tok = next(self._tokens, None)
+        if tok is None:
+            return None
+
         if tok != "MOTION":
             raise SyntaxError("Syntax error in line %d: 'MOTION' expected, "
                               "got '%s' instead" % (self._line_num, tok))
@@ -131,18 +499,89 @@ class BvhReader(object):
         dt = self.float_token()
 
         self.on_motion(frames, dt)
+        return frames
 
-        # Read the channel values
-        for i in range(frames):
-            s = self.read_line()
-            a = s.split()
-            if len(a) != self.num_channels:
-                raise SyntaxError("Syntax error in line %d: %d float values "
-                                  "expected, got %d instead"
-                                  % (self._line_num, self.num_channels,
-                                     len(a)))
-            values = list(map(lambda x: float(x), a))  # In Python 3 map returns map-object, not a list. Can't slice.
-            self.on_frame(values)
+    def read_frames(self, frames):
+        """Read the channel values of the next frames lines.
+
+        The return value is a dtype array of shape (n, num_channels),
+        where n is the number of frames selected by frame_range.
+        """
+        values = np.empty((len(range(*self.frame_indices(frames))), self.num_channels), dtype=self.dtype)
+        count = 0
+        for chunk in self.iter_frames(frames):
+            values[count:count + len(chunk)] = chunk
+            count += len(chunk)
+        return values
+
+    def iter_frames(self, frames, chunk_frames=None):
+        """Read the channel values of the next frames lines in chunks.
+
+        The lines are converted chunk_frames at a time instead of one
+        line at a time.  Yields dtype arrays of shape
+        (n, num_channels) with n <= chunk_frames.  Only the frames
+        selected by frame_range are converted; reading stops after the
+        last of them.
+        """
+        if chunk_frames is None:
+            chunk_frames = self.chunk_frames
+        start, stop, step = self.frame_indices(frames)
+        selected = len(range(start, stop, step))
+        # Discard any remaining tokens
+        self._tokens = self.iter_tokens()
+        first_line = self._line_num + 1 + start
+        lines_iter = itertools.islice(self._file_handle, start, stop, step)
+        count = 0
+        while count < selected:
+            lines = list(itertools.islice(lines_iter,
+                                          min(chunk_frames, selected - count)))
+            if not lines:
+                if step == 1:
+                    raise SyntaxError("Syntax error in line %d: %d frames "
+                                      "expected, got %d instead"
+                                      % (first_line + count - 1, frames,
+                                         start + count))
+                raise SyntaxError("Syntax error in line %d: %d frames "
+                                  "expected, frame %d is missing"
+                                  % (first_line + count * step, frames,
+                                     start + count * step))
+            chunk = parse_frame_lines(lines, self.num_channels,
+                                      first_line + count * step, step, self.dtype)
+            count += len(lines)
+            self._line_num = first_line + (count - 1) * step
+            yield chunk
+
+    def read_hierarchy_section(self):
+        """Read the skeleton hierarchy, through rig_cache if there is
+        one, and call on_hierarchy()."""
+        if self.rig_cache is None:
+            self.read_hierarchy()
+        else:
+            self.rig = self.rig_cache.read_hierarchy(self)
+        self.on_hierarchy(self.root)
+
+    def read_hierarchy_lines(self):
+        """Read the lines before the MOTION section without parsing them.
+
+        Returns the list of lines; the MOTION keyword and whatever
+        follows it on its line are left as the next tokens.
+        """
+        lines = []
+        line_num = self._line_num
+        for s in iter(self._file_handle.readline, ""):
+            # Only lines mentioning MOTION have to be split into tokens.
+            if "MOTION" in s:
+                tokens = s.split()
+                if "MOTION" in tokens:
+                    i = tokens.index("MOTION")
+                    self._line_num = line_num + len(lines) + 1
+                    if i:
+                        lines.append(" ".join(tokens[:i]) + "\n")
+                    self.create_tokens(" ".join(tokens[i:]))
+                    return lines
+            lines.append(s)
+        self._line_num = line_num + len(lines)
+        return lines
 
     def read_hierarchy(self):
         """Read the skeleton hierarchy."""
@@ -160,56 +599,59 @@ class BvhReader(object):
         self.read_node()
 
     def read_node(self):
-        """Read the data for a node."""
-
-        # Read the node name (or the word 'Site' if it was a 'End Site' node)
-        name = self.token()
-        self._node_stack[-1].name = name
+        """Read the data for a node and all of its children.
 
-        tok = self.token()
-        if tok != "{":
-            raise SyntaxError("Syntax error in line %d: '{' expected, "
-                              "got '%s' instead" % (self._line_num, tok))
+        Child nodes are handled with the node stack instead of recursion,
+        so deep hierarchies don't run into the recursion limit.
+        """
+        depth = len(self._node_stack)
+        self.read_node_name()
 
-        while 1:
+        while len(self._node_stack) >= depth:
+            node = self._node_stack[-1]
             tok = self.token()
             if tok == "OFFSET":
                 x = self.float_token()
                 y = self.float_token()
                 z = self.float_token()
-                self._node_stack[-1].offset = (x, y, z)
+                node.offset = (x, y, z)
             elif tok == "CHANNELS":
                 n = self.int_token()
                 channels = []
                 for i in range(n):
                     tok = self.token()
-                    if tok not in ["Xposition", "Yposition", "Zposition",
-                                   "Xrotation", "Yrotation", "Zrotation"]:
+                    if tok not in CHANNEL_NAMES:
                         raise SyntaxError("Syntax error in line %d: Invalid "
                                           "channel name: '%s'"
                                           % (self._line_num, tok))
                     channels.append(tok)
                 self.num_channels += len(channels)
-                self._node_stack[-1].channels = channels
-            elif tok == "JOINT":
-                node = Node()
-                self._node_stack[-1].children.append(node)
-                self._node_stack.append(node)
-                self.read_node()
-            elif tok == "End":
-                node = Node()
-                self._node_stack[-1].children.append(node)
-                self._node_stack.append(node)
-                self.read_node()
+                node.channels = channels
+            elif tok == "JOINT" or tok == "End":
+                child = Node()
+                node.children.append(child)
+                self._node_stack.append(child)
+                self.read_node_name()
             elif tok == "}":
-                if self._node_stack[-1].is_end_site:
-                    self._node_stack[-1].name = "End Site"
+                if node.is_end_site:
+                    node.name = "End Site"
                 self._node_stack.pop()
-                break
             else:
                 raise SyntaxError("Syntax error in line %d: Unknown "
                                   "keyword '%s'" % (self._line_num, tok))
 
+    def read_node_name(self):
+        """Read the name and opening brace of the node on top of the stack."""
+
+        # Read the node name (or the word 'Site' if it was a 'End Site' node)
+        name = self.token()
+        self._node_stack[-1].name = name
+
+        tok = self.token()
+        if tok != "{":
+            raise SyntaxError("Syntax error in line %d: '{' expected, "
+                              "got '%s' instead" % (self._line_num, tok))
+
     def int_token(self):
         """Return the next token which must be an int. """
         tok = self.token()
@@ -229,18 +671,28 @@ class BvhReader(object):
                               "got '%s' instead" % (self._line_num, tok))
 
     def token(self):
-        """Return the next token."""
+        """Return the next token.
+
+        If the end of the file has been reached, a SyntaxError is
+        raised.  (Not StopIteration, which would end any generator
+        reading the file as if nothing was wrong.)
+        """
+        tok = next(self._tokens, None)
+        if tok is None:
+            raise SyntaxError("Syntax error in line %d: Unexpected end of file"
+                              % self._line_num)
+        return tok
 
-        # Are there still some tokens left? then just return the next one
-        if self._token_list:
-            tok = self._token_list[0]
-            self._token_list = self._token_list[1:]
-            return tok
+    def iter_tokens(self):
+        """Iterate over the tokens of the remaining lines of the file.
 
-        # Read a new line
-        s = self.read_line()
-        self.create_tokens(s)
-        return self.token()
+        Lines are read lazily, so the line number always refers to the
+        line the last returned token came from.
+        """
+        for s in iter(self._file_handle.readline, ""):
+            self._line_num += 1
+            for tok in s.split():
+                yield tok
 
     def read_line(self):
         """Return the next line.
@@ -251,7 +703,7 @@ class BvhReader(object):
         empty string).
         """
         # Discard any remaining tokens
-        self._token_list = []
+        self._tokens = self.iter_tokens()
         # Read the next line
         while 1:
             s = self._file_handle.readline()
@@ -261,7 +713,6 @@ class BvhReader(object):
             return s
 
     def create_tokens(self, s):
-        """Populate the token list from the content of s."""
-        s = s.strip()
-        a = s.split()
-        self._token_list = a
+        """Make the content of s the next tokens, followed by the rest of
+        the file."""
+        self._tokens = itertools.chain(s.split(), self.iter_tokens())
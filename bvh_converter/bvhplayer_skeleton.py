@@ -1,9 +1,14 @@
 #!/usr/bin/python
 
 from __future__ import print_function
+from fnmatch import fnmatchcase
+import os
 from math import radians, cos, sin
-from bvh_converter.bvh import BvhReader
+from bvh_converter.bvh import BvhReader, GrowingFile, get_compression, parse_frame_lines
+from bvh_converter.cache import ParseCache
+from bvh_converter.stats import NO_STATS
 from numpy import array, dot
+import numpy as np
 
 """
 A word on this:
@@ -23,20 +28,22 @@ __authors__ = ["Bruce Hahne (hahne at prismnet dot com)",
 
 # AVOIDING OFF-BY-ONE ERRORS:
 # Let N be the total number of keyframes in the BVH file.  Then:
-# - bvh.keyframes[] is an array that runs from 0 to N-1
+# - bvh.keyframes[] is a (N, channels) array that runs from 0 to N-1
 # - skeleton.keyframes[] is another reference to bvh.keyframes and similarly
 #   runs from 0 to N-1
-# - skeleton.edges{t} is a dict where t can run from 1 to N
-# - joint.trtr{t} is a dict where t can run from 1 to N
-# - joint.worldpos{t} is a dict where t can run from 1 to N
+# - skeleton.worldpos[] and skeleton.rotations[] are (N, joints, 3) arrays
+#   that run from 0 to N-1
+# - skeleton.orientations[] is an optional (N, joints, 3, 3) array
+# - joint.worldpos[], joint.rot[], joint.orient[] and joint.trtr[] are views
+#   of the skeleton's arrays for a single joint and also run from 0 to N-1
 #
-# So if you're talking about raw BVH keyframe rows from the file,
-# you use an array and the values run from 0 to N-1.  This is an artifact
-# of using .append to create bvh.keyframes.
+# Everything derived from the keyframes is indexed by frame number.  The
+# time of frame i is i * skeleton.dt.
 #
-# By contrast, if you're talking about a non-keyframe data structure
-# derived from the BVH keyframes, such as matrices or edges, it's a
-# dictionary and the values run from 1 to N.
+# If only some frames of the file were read (start_frame and frame_step
+# below), frame numbers count the frames that were read, and the time of
+# frame i is (start_frame + i * frame_step) * skeleton.dt, the time of
+# that frame in the file.
 
 
 ZEROMAT = array([[0., 0., 0., 0.], [0., 0., 0., 0.],
@@ -44,6 +51,10 @@ ZEROMAT = array([[0., 0., 0., 0.], [0., 0., 0., 0.],
 IDENTITY = array([[1., 0., 0., 0.], [0., 1., 0., 0.],
                   [0., 0., 1., 0.], [0., 0., 0., 1.]])
 
+# Floating point types the keyframes can be parsed and evaluated in, by
+# name.  float32 halves the memory; see float_dtype.
+DTYPES = {"float64": np.float64, "float32": np.float32}
+
 
 #######################################
 # JOINT class (formerly BONE)
@@ -51,7 +62,10 @@ IDENTITY = array([[1., 0., 0., 0.], [0., 1., 0., 0.],
 # edges.  It's not accurate to call these "bones" because if
 # you rotate the joint, you rotate ALL attached bones.
 
-class Joint:
+class Joint(object):
+
+    __slots__ = ("name", "children", "channels", "hasparent", "parent",
+                 "strans", "stransmat", "index", "rot", "orient", "trtr", "worldpos")
 
     def __init__(self, name):
         self.name = name
@@ -66,9 +80,12 @@ class Joint:
         self.stransmat = array([[0., 0., 0., 0.], [0., 0., 0., 0.],
                                 [0., 0., 0., 0.], [0., 0., 0., 0.]])
         
-        self.rot = {}  # self.rot[t] Rotation values at the frame.
-        self.trtr = {}  # self.trtr[time]  A premultiplied series of translation and rotation matrices.
-        self.worldpos = {}  # Time-based worldspace xyz position of the joint's endpoint.  A list of vec4's
+        # Per-frame storage, set up by the Skeleton as views of its arrays.
+        self.index = None  # Position of the joint in Skeleton.joints
+        self.rot = None  # self.rot[i] Rotation values at frame i, None for end sites.
+        self.orient = None  # self.orient[i] Worldspace 3x3 orientation of the joint at frame i (optional).
+        self.trtr = None  # self.trtr[i] A premultiplied series of translation and rotation matrices (optional).
+        self.worldpos = None  # self.worldpos[i] Worldspace xyz position of the joint's endpoint at frame i.
 
     def info(self):
         """ Prints information about the joint to stdout.
@@ -109,24 +126,130 @@ class Joint:
 # End class joint
 
 
+def bind_joint_storage(joints, worldpos, rotations, trtr=None, orientations=None):
+    """
+    Point the per-frame storage of each joint at its column of the
+    (frames, joints, ...) arrays.  Joints without rotation channels get
+    no rotation storage.  trtr and orientations are optional.
+    :param joints: Joints in the order of the array columns.
+    :type joints: list
+    """
+    for j, joint in enumerate(joints):
+        joint.index = j
+        joint.worldpos = worldpos[:, j]
+        if any(channel.endswith("rotation") for channel in joint.channels):
+            joint.rot = rotations[:, j]
+        else:
+            joint.rot = None
+        if trtr is not None:
+            joint.trtr = trtr[:, j]
+        else:
+            joint.trtr = None
+        if orientations is not None:
+            joint.orient = orientations[:, j]
+        else:
+            joint.orient = None
+
+
+def unbind_joint_storage(joints):
+    """Remove the per-frame storage of joints, so their results aren't kept."""
+    for joint in joints:
+        joint.index = None
+        joint.worldpos = None
+        joint.rot = None
+        joint.orient = None
+        joint.trtr = None
+
+
+def select_joints(joints, patterns):
+    """
+    Pick joints by name.
+    :param joints: Joints to choose from.
+    :type joints: list
+    :param patterns: Joint names or shell-style patterns such as "*Hand*",
+        or a single one.
+    :type patterns: list
+    :return: The joints matching any of patterns, in the order of joints.
+    :rtype: list
+    """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    patterns = list(patterns)
+    for pattern in patterns:
+        if not any(fnmatchcase(joint.name, pattern) for joint in joints):
+            raise ValueError("No joint matches '{}'".format(pattern))
+    return [joint for joint in joints
+            if any(fnmatchcase(joint.name, pattern) for pattern in patterns)]
+
+
 ###############################
 # SKELETON class
 #
 # This class is actually for a skeleton plus some time-related info
 #   frames: number of frames in the animation
 #   dt: delta-t in seconds per frame (default: 30fps i.e. 1/30)
+#
+# Rotations and world positions of all joints are kept in two
+# (frames, joints, 3) arrays; keep_trtr adds a (frames, joints, 4, 4)
+# array with the full transformation of every joint.  keep_orientations
+# adds just its rotational part, a (frames, joints, 3, 3) array of the
+# global (worldspace) orientation of every joint, which is filled in by
+# the same forward kinematics pass as the world positions.
+#
+# A skeleton may also hold just a window of a longer clip, in which case
+# first_frame is the number of its first keyframe within the clip.
+#
+# The clip itself may be every frame_step-th frame of the file starting
+# at start_frame; frames is then the number of frames in that selection.
+#
+# select restricts the skeleton to the joints matching a list of names or
+# patterns (see select_joints).  Only those joints get storage, so only
+# they appear in the output, and the forward kinematics skip every joint
+# that isn't one of them or one of their ancestors.
 class Skeleton:
 
-    def __init__(self, hips, keyframes, frames=0, dt=.033333333, ignore_root_offset=True):
+    def __init__(self, hips, keyframes, frames=0, dt=.033333333, ignore_root_offset=True,
+                 keep_trtr=False, first_frame=0, select=None, start_frame=0, frame_step=1,
+                 keep_orientations=False, joints=None, rig=None):
         self.root = hips
         # 9/1/08: we now transfer the large bvh.keyframes data structure to
         # the skeleton because we need to keep this dataset around.
         self.keyframes = keyframes
-        self.frames = frames  # Number of frames (caller must set correctly)
+        self.frames = frames  # Number of frames (caller must set correctly), None if still growing
         self.dt = dt
+        self.first_frame = first_frame
+        self.start_frame = start_frame
+        self.frame_step = frame_step
+        self.select = select
+        # The Rig (see bvh_converter.rigs) the joints were built from, if any
+        self.rig = rig
+        self._pose_plan = None  # See evaluate_pose
         # self.edges = []  # List of list of edges.  self.edges[time][edge#]
         self.edges = {}  # As of 9/1/08 this now runs from 1...N not 0...N-1
 
+        # Joints in output order.  Each joint gets views of the
+        # skeleton-wide arrays below.  joints may hand in the joint_dfs
+        # order of hips if it's already known.
+        self.joints = list(joints) if joints is not None else self.joint_dfs(self.root)
+        if select is not None:
+            unbind_joint_storage(self.joints)
+            self.joints = select_joints(self.joints, select)
+        num_frames = len(self.keyframes)
+        num_joints = len(self.joints)
+        # Results are stored in the precision of the keyframes, see float_dtype
+        self.dtype = float_dtype(self.keyframes)
+        self.worldpos = np.zeros((num_frames, num_joints, 3), dtype=self.dtype)
+        self.rotations = np.zeros((num_frames, num_joints, 3), dtype=self.dtype)
+        if keep_trtr:
+            self.trtr = np.zeros((num_frames, num_joints, 4, 4), dtype=self.dtype)
+        else:
+            self.trtr = None
+        if keep_orientations:
+            self.orientations = np.zeros((num_frames, num_joints, 3, 3), dtype=self.dtype)
+        else:
+            self.orientations = None
+        bind_joint_storage(self.joints, self.worldpos, self.rotations, self.trtr, self.orientations)
+
         # Precompute hips min and max values in all 3 dimensions.
         # First determine how far into a keyframe we need to look to find the
         # XYZ hip positions
@@ -158,22 +281,17 @@ class Skeleton:
         ycorrect = self.root.strans[1]
         zcorrect = self.root.strans[2]
 
-        for keyframe in self.keyframes:
-            x = keyframe[xoffset] + xcorrect
-            y = keyframe[yoffset] + ycorrect
-            z = keyframe[zoffset] + zcorrect
-            if x < self.minx:
-                self.minx = x
-            if x > self.maxx:
-                self.maxx = x
-            if y < self.miny:
-                self.miny = y
-            if y > self.maxy:
-                self.maxy = y
-            if z < self.minz:
-                self.minz = z
-            if z > self.maxz:
-                self.maxz = z
+        if len(self.keyframes):
+            motion = np.asarray(self.keyframes, dtype=self.dtype)
+            x = motion[:, xoffset] + xcorrect
+            y = motion[:, yoffset] + ycorrect
+            z = motion[:, zoffset] + zcorrect
+            self.minx = float(x.min())
+            self.maxx = float(x.max())
+            self.miny = float(y.min())
+            self.maxy = float(y.max())
+            self.minz = float(z.min())
+            self.maxz = float(z.max())
 
     def __str__(self):
         str1 = "frames = " + str(self.frames) + ", dt = " + str(self.dt) + "\n"
@@ -198,33 +316,45 @@ class Skeleton:
                 stack.insert(0, child)
         return nodes
     
-    def get_frames_worldpos(self, n=None):
-        """Returns a list of frames, first item in list will be a header
-        :param n: If not None, returns specified frame (with header).
-        :type n: int
-        :rtype: tuple
+    def _frames_table(self, values, n=None):
+        """Prefix the (frames, joints, 3) array values with the frame times
+        and return it as a list of rows together with the header.
         """
-        joints = self.joint_dfs(self.root)
-
-        frame_data = []
         if n is None:
-            for i in range(len(self.keyframes)):
-                t = i * self.dt
-                single_frame = [t, ]
-                for j in joints:
-                    single_frame.extend(j.worldpos[t][:3])
-                frame_data.append(single_frame)
+            frame_nums = np.arange(len(values))
+            values = values.reshape(len(values), 3 * len(self.joints))
         else:
-            t = n * self.dt
-            single_frame = [t, ]
-            for j in joints:
-                single_frame.extend(j.worldpos[t][:3])
-            frame_data.append(single_frame)
+            frame_nums = np.array([n])
+            values = values[n].reshape(1, -1)
+        times = self.frame_time(self.first_frame + frame_nums)
+        frame_data = np.column_stack((times, values)).tolist()
+        return self.get_header(), frame_data
+
+    def frame_time(self, frame_nums):
+        """Return the time in the file of the given frame numbers of the clip.
+        :param frame_nums: Frame numbers, counting from the clip's first frame.
+        :type frame_nums: numpy.ndarray
+        :rtype: numpy.ndarray
+        """
+        return (self.start_frame + frame_nums * self.frame_step) * self.dt
 
-        header = ["{}.{}".format(j.name, thing) for j in joints
+    def get_header(self):
+        """Returns the column names of the tables returned by
+        get_frames_worldpos and get_frames_rotations.
+        :rtype: list
+        """
+        header = ["{}.{}".format(j.name, thing) for j in self.joints
                   for thing in ("X", "Y", "Z")]
         header = ["Time", ] + header
-        return header, frame_data
+        return header
+
+    def get_frames_worldpos(self, n=None):
+        """Returns a list of frames, first item in list will be a header
+        :param n: If not None, returns specified frame (with header).
+        :type n: int
+        :rtype: tuple
+        """
+        return self._frames_table(self.worldpos, n)
     
     def get_frames_rotations(self, n=None):
         """Returns a list of frames, first item in list will be a header
@@ -232,35 +362,7 @@ class Skeleton:
         :type n: int
         :rtype: tuple
         """
-        joints = self.joint_dfs(self.root)
-
-        frame_data = []
-        if n is None:
-            for i in range(len(self.keyframes)):
-                t = i * self.dt
-                single_frame = [t, ]
-                for j in joints:
-                    if j.rot:
-                        rot = j.rot[t]
-                    else:
-                        rot = [0.0, 0.0, 0.0]
-                    single_frame.extend(rot)
-                frame_data.append(single_frame)
-        else:
-            t = n * self.dt
-            single_frame = [t, ]
-            for j in joints:
-                if j.rot:
-                    rot = j.rot[t]
-                else:
-                    rot = [0.0, 0.0, 0.0]
-                single_frame.extend(rot)
-            frame_data.append(single_frame)
-
-        header = ["{}.{}".format(j.name, thing) for j in joints
-                  for thing in ("X", "Y", "Z")]
-        header = ["Time", ] + header
-        return header, frame_data
+        return self._frames_table(self.rotations, n)
 
     def get_frame(self, f):
         """
@@ -270,24 +372,44 @@ class Skeleton:
         :return: A dictionary of {joint.name: (rotation, world position)} for frame f
         :rtype: dict
         """
-        joints = self.joint_dfs(self.root)
-
         frame_data = dict()
         
-        t = f * self.dt
-        for j in joints:
-            frame_data[j.name] = j.rot[t] if t in j.rot else None, j.worldpos[t][:3]
+        for j in self.joints:
+            rot = tuple(self.rotations[f, j.index].tolist()) if j.rot is not None else None
+            frame_data[j.name] = rot, self.worldpos[f, j.index]
         return frame_data
     
+    def evaluate_pose(self, keyframe, t=None):
+        """
+        Run the forward kinematics on a single keyframe, through a PosePlan
+        compiled on the first call.  Not safe to call from several threads
+        at once.
+        :param keyframe: Channel values of the frame.
+        :type keyframe: numpy.ndarray
+        :param t: Frame number to store the results at in the skeleton's
+            arrays.  If None, they are returned in buffers that the next
+            call overwrites.
+        :type t: int
+        :return: Tuple of the (joints, 3) world positions and rotations.
+        :rtype: tuple
+        """
+        if self._pose_plan is None:
+            self._pose_plan = PosePlan(self.root, self.joints, self.dtype)
+        if t is None:
+            return self._pose_plan.evaluate(keyframe)
+        return self._pose_plan.evaluate(
+            keyframe, self.worldpos[t], self.rotations[t],
+            self.orientations[t] if self.orientations is not None else None,
+            self.trtr[t] if self.trtr is not None else None)
+
     def get_offsets(self):
         """
         Get the offsets for each joint in the skeleton.
         :return: Dictionary of {joint.name: offset}.
         :rtype: dict
         """
-        joints = self.joint_dfs(self.root)
         offsets = dict()
-        for j in joints:
+        for j in self.joints:
             offsets[j.name] = j.strans
         return offsets
     
@@ -297,10 +419,9 @@ class Skeleton:
         :return: Dictionary of {j.name: j.parent, j.strans, j.rot, type, children}
         :rtype: dict
         """
-        joints = self.joint_dfs(self.root)
         joints_dict = {}
 
-        for j in joints:
+        for j in self.joints:
             if not j.hasparent:
                 type = 'root'
             else:
@@ -308,8 +429,8 @@ class Skeleton:
             if j.name[-3:] == "End":
                 type = 'end'
             
-            if j.rot:
-                rot_0 = tuple(j.rot[0])
+            if j.rot is not None and len(self.rotations):
+                rot_0 = tuple(self.rotations[0, j.index].tolist())
             else:
                 rot_0 = None
                 
@@ -321,6 +442,72 @@ class Skeleton:
         return joints_dict
         
 
+#######################################
+# LAZYSKELETON class
+#
+# A Skeleton whose keyframes are only read and evaluated when asked for.
+# keyframes is anything that can be indexed and sliced like the keyframes
+# array, typically a MappedMotion.  Nothing is precomputed: every query
+# reads the frames it needs and runs the forward kinematics on just those.
+# The hips bounds aren't computed either.
+class LazySkeleton(Skeleton):
+
+    def __init__(self, hips, keyframes, frames=0, dt=.033333333, ignore_root_offset=True,
+                 keep_trtr=False, select=None, keep_orientations=False, joints=None, rig=None):
+        Skeleton.__init__(self, hips, keyframes[0:0], frames=frames, dt=dt,
+                          ignore_root_offset=ignore_root_offset, keep_trtr=keep_trtr,
+                          select=select, keep_orientations=keep_orientations, joints=joints, rig=rig)
+        self.keyframes = keyframes
+        self.ignore_root_offset = ignore_root_offset
+        self.keep_trtr = keep_trtr
+        self.keep_orientations = keep_orientations
+        # The windows share the selected joints and the channel layout
+        self._channel_offsets = channel_offsets(hips)
+
+    def get_window(self, start, stop):
+        """
+        Evaluate frames start to stop - 1.  A single frame is evaluated
+        with the skeleton's PosePlan (see evaluate_pose).
+        :return: A Skeleton holding just those frames.
+        :rtype: Skeleton
+        """
+        keyframes = self.keyframes[start:stop]
+        window = Skeleton(self.root, keyframes, frames=self.frames, dt=self.dt,
+                          ignore_root_offset=self.ignore_root_offset, keep_trtr=self.keep_trtr,
+                          first_frame=start, keep_orientations=self.keep_orientations,
+                          joints=self.joints, rig=self.rig)
+        window.select = self.select
+        if len(keyframes) == 1:
+            if self._pose_plan is None:
+                self._pose_plan = PosePlan(self.root, self.joints, self.dtype)
+            window._pose_plan = self._pose_plan
+            window.evaluate_pose(keyframes[0], 0)
+        else:
+            process_bvhkeyframes(keyframes, self.root, self._channel_offsets)
+        return window
+
+    def get_frames_worldpos(self, n=None):
+        if n is None:
+            return self.get_window(0, len(self.keyframes)).get_frames_worldpos()
+        return self.get_window(n, n + 1).get_frames_worldpos()
+
+    def get_frames_rotations(self, n=None):
+        if n is None:
+            return self.get_window(0, len(self.keyframes)).get_frames_rotations()
+        return self.get_window(n, n + 1).get_frames_rotations()
+
+    def get_frame(self, f):
+        return self.get_window(f, f + 1).get_frame(0)
+
+    def as_dict(self):
+        return self.get_window(0, 1).as_dict()
+
+    def close(self):
+        """Close the underlying keyframes, if they support it."""
+        if hasattr(self.keyframes, "close"):
+            self.keyframes.close()
+
+
 #######################################
 # READBVH class
 #
@@ -340,10 +527,9 @@ class ReadBVH(BvhReader):
         self.frames = frames
         self.dt = dt
 
-    def on_frame(self, values):
-        #   print("readbvh: onFrame invoked, values =", values
-        # Hopefully this gives us a list of lists
-        self.keyframes.append(values)
+    def on_frames(self, values):
+        # All keyframes as a single (frames, channels) array.
+        self.keyframes = values
 
 
 #######################################
@@ -395,6 +581,20 @@ def process_bvhnode(node, parentname='hips'):
     return b1
 
 
+def build_joints(reader):
+    """
+    Create the joint hierarchy of a reader that has read the hierarchy,
+    from its rig if it has one, or with process_bvhnode.
+    :type reader: BvhReader
+    :return: Tuple of (root joint, joints in Skeleton.joint_dfs order, or
+        None if they are yet to be found).
+    :rtype: tuple
+    """
+    if reader.rig is not None:
+        return reader.rig.build_joints()
+    return process_bvhnode(reader.root), None
+
+
 ###############################
 # PROCESS_BVHKEYFRAME
 # Recursively extract (occasionally) translation and (mostly) rotation
@@ -409,8 +609,12 @@ def process_bvhnode(node, parentname='hips'):
 # class, but to maintain similarity with process_bvhnode I won't do that.
 #
 # 9/1/08: rewritten to process only one keyframe
+#
+# t is the frame number the results are stored at.  The parent's trtr
+# matrix is handed down the recursion, so the skeleton doesn't have to
+# keep the per-frame trtr matrices for this to work.
 
-def process_bvhkeyframe(keyframe, joint, t, DEBUG=0):
+def process_bvhkeyframe(keyframe, joint, t, DEBUG=0, parent_trtr=None):
 
     counter = 0
     dotrans = 0
@@ -489,7 +693,8 @@ def process_bvhkeyframe(keyframe, joint, t, DEBUG=0):
             return(0)
         counter += 1
     # End "for channel..."
-    if has_xrot or has_yrot or has_zrot:  # End sites don't have rotations.
+    # End sites don't have rotations, unselected joints don't keep theirs.
+    if (has_xrot or has_yrot or has_zrot) and joint.rot is not None:
         joint.rot[t] = (xrot, yrot, zrot)
     
     if dotrans:  # If we are the hips...
@@ -514,10 +719,8 @@ def process_bvhkeyframe(keyframe, joint, t, DEBUG=0):
     # We now have enough to compute joint.trtr and also to convert
     # the position of this joint (vertex) to worldspace.
     #
-    # For the non-hips case, we assume that our parent joint has already
-    # had its trtr matrix appended to the end of self.trtr[]
-    # and that the appropriate matrix from the parent is the LAST item
-    # in the parent's trtr[] matrix list.
+    # For the non-hips case, the parent's trtr matrix for this frame is
+    # passed in as parent_trtr.
     #
     # Worldpos of the current joint is localtoworld = TRTR...T*[0,0,0,1]
     #   which equals parent_trtr * T*[0,0,0,1]
@@ -532,8 +735,8 @@ def process_bvhkeyframe(keyframe, joint, t, DEBUG=0):
     # compute localtoworld first, then trtr.
 
     if joint.hasparent:  # Not hips
-        # parent_trtr = joint.parent.trtr[-1]  # Last entry from parent
-        parent_trtr = joint.parent.trtr[t]  # Dictionary-based rewrite
+        if parent_trtr is None:
+            parent_trtr = joint.parent.trtr[t]
 
         # 8/31/2008: dtransmat now excluded from non-hips computation since
         # it's just identity anyway.
@@ -546,12 +749,15 @@ def process_bvhkeyframe(keyframe, joint, t, DEBUG=0):
 
     trtr = dot(localtoworld, drotmat)
 
-    joint.trtr[t] = trtr  # New dictionary-based approach
+    if joint.trtr is not None:
+        joint.trtr[t] = trtr
+    if joint.orient is not None:
+        joint.orient[t] = trtr[:3, :3]
 
-    # worldpos = localtoworld * ORIGIN  # worldpos should be a vec4
-    worldpos = array([localtoworld[0, 3], localtoworld[1, 3],
-                      localtoworld[2, 3], localtoworld[3, 3]])
-    joint.worldpos[t] = worldpos  # Dictionary-based approach
+    # worldpos = localtoworld * ORIGIN
+    worldpos = localtoworld[:3, 3]
+    if joint.worldpos is not None:
+        joint.worldpos[t] = worldpos
 
     if DEBUG:
         print("  Joint %s: here are some matrices" % (joint.name))
@@ -574,17 +780,360 @@ def process_bvhkeyframe(keyframe, joint, t, DEBUG=0):
         # Here's the recursion call.  Each time we call process_bvhkeyframe,
         # the returned value "newkeyframe" should shrink due to the slicing
         # process
-        newkeyframe = process_bvhkeyframe(newkeyframe, child, t, DEBUG=DEBUG)
-        if newkeyframe == 0:  # If retval = 0
+        newkeyframe = process_bvhkeyframe(newkeyframe, child, t, DEBUG=DEBUG,
+                                          parent_trtr=trtr)
+        if isinstance(newkeyframe, int):  # If retval = 0
             print("Passing up fatal error in process_bvhkeyframe")
             return 0
     return newkeyframe
 
 
+###############################
+# PROCESS_BVHKEYFRAMES
+# Vectorized counterpart of process_bvhkeyframe.  Instead of walking the
+# joint tree once per keyframe, we walk it once for the whole clip and
+# compute every joint's matrices for all frames at once, stacked along the
+# frame axis.  The results are stored in joint.rot, joint.trtr and
+# joint.worldpos exactly as process_bvhkeyframe would have stored them,
+# so the joints need the storage set up by a Skeleton.
+#
+# Rotations are kept as 3x3 stacks and positions as 3-vectors while
+# walking the tree; the 4x4 trtr matrices are only assembled at the end.
+# For a joint with parent P this is the same computation as
+#   localtoworld = P.trtr * stransmat
+#   trtr = localtoworld * drotmat
+# just without the multiplications by the constant bottom row.
+#
+# Joints without storage (see Skeleton's select) are only evaluated if a
+# descendant has storage; whole subtrees without any are skipped.
+
+def _axis_rotations(axis, degrees):
+    """Return a (frames, 3, 3) stack of rotations about a single axis.
+    :param axis: One of "X", "Y" or "Z".
+    :param degrees: Rotation angles, one per frame.
+    :rtype: numpy.ndarray
+    """
+    theta = np.radians(degrees)
+    mycos = np.cos(theta)
+    mysin = np.sin(theta)
+    mats = np.zeros((len(theta), 3, 3), dtype=theta.dtype)
+    if axis == "X":
+        mats[:, 0, 0] = 1.
+        mats[:, 1, 1] = mycos
+        mats[:, 1, 2] = -mysin
+        mats[:, 2, 1] = mysin
+        mats[:, 2, 2] = mycos
+    elif axis == "Y":
+        mats[:, 0, 0] = mycos
+        mats[:, 0, 2] = mysin
+        mats[:, 1, 1] = 1.
+        mats[:, 2, 0] = -mysin
+        mats[:, 2, 2] = mycos
+    else:
+        mats[:, 0, 0] = mycos
+        mats[:, 0, 1] = -mysin
+        mats[:, 1, 0] = mysin
+        mats[:, 1, 1] = mycos
+        mats[:, 2, 2] = 1.
+    return mats
+
+
+def channel_offsets(root):
+    """
+    Find where the channel values of each joint start in a keyframe.
+    :param root: Root joint of the hierarchy.
+    :type root: Joint
+    :return: Tuple of ({joint: index of its first channel}, joints in keyframe order).
+    :rtype: tuple
+    """
+    first_channel = {}
+    order = []
+    counter = 0
+    # Children are pushed in reverse so joints are visited in the same
+    # order as their channels appear in a keyframe.
+    stack = [root]
+    while stack:
+        joint = stack.pop()
+        order.append(joint)
+        first_channel[joint] = counter
+        counter += len(joint.channels)
+        stack.extend(reversed(joint.children))
+    return first_channel, order
+
+
+def float_dtype(keyframes):
+    """Return the floating point type keyframes are evaluated and stored
+    in: numpy.float32 for float32 arrays, numpy.float64 for anything else."""
+    if getattr(keyframes, "dtype", None) == np.float32:
+        return np.float32
+    return np.float64
+
+
+def process_bvhkeyframes(keyframes, root, offsets=None):
+    """Compute rotations and world positions of every joint with storage
+    for all frames, in the precision of keyframes (see float_dtype).
+    :param keyframes: Motion data, one row of channel values per frame.
+    :type keyframes: list or numpy.ndarray
+    :param root: Root joint of the hierarchy.
+    :type root: Joint
+    :param offsets: channel_offsets(root), if it is already known.
+    :type offsets: tuple
+    """
+    dtype = float_dtype(keyframes)
+    motion = np.asarray(keyframes, dtype=dtype)
+    frames = motion.shape[0]
+
+    # Only joints with storage and their ancestors have to be evaluated.
+    first_channel, order = offsets if offsets is not None else channel_offsets(root)
+    needed = {}
+    for joint in reversed(order):
+        needed[joint] = joint.worldpos is not None or any(needed[child] for child in joint.children)
+
+    stack = [(root, None, None)]
+    while stack:
+        joint, parent_rot, parent_pos = stack.pop()
+
+        drotmat = None
+        dtrans = np.zeros((frames, 3), dtype=dtype)
+        for counter, channel in enumerate(joint.channels, first_channel[joint]):
+            keyvals = motion[:, counter]
+            axis = channel[0]
+            if channel in ("Xposition", "Yposition", "Zposition"):
+                dtrans[:, "XYZ".index(axis)] = keyvals
+            elif channel in ("Xrotation", "Yrotation", "Zrotation"):
+                if joint.rot is not None:
+                    joint.rot[:frames, "XYZ".index(axis)] = keyvals
+                drotmat2 = _axis_rotations(axis, keyvals)
+                if drotmat is None:
+                    drotmat = drotmat2
+                else:
+                    drotmat = np.matmul(drotmat, drotmat2)
+            else:
+                raise ValueError("Illegal channel name '%s' in joint %s"
+                                 % (channel, joint.name))
+
+        if joint.hasparent:  # Not hips
+            # Position channels of non-root joints are ignored, as in
+            # process_bvhkeyframe.
+            pos = parent_pos + np.matmul(parent_rot, joint.stransmat[:3, 3].astype(dtype))
+        else:  # Hips
+            pos = joint.stransmat[:3, 3].astype(dtype) + dtrans
+            parent_rot = np.broadcast_to(np.eye(3, dtype=dtype), (frames, 3, 3))
+
+        if drotmat is None:
+            rot = parent_rot
+        else:
+            rot = np.matmul(parent_rot, drotmat)
+
+        if joint.trtr is not None:
+            joint.trtr[:frames, :3, :3] = rot
+            joint.trtr[:frames, :3, 3] = pos
+            joint.trtr[:frames, 3, :3] = 0.
+            joint.trtr[:frames, 3, 3] = 1.
+        if joint.orient is not None:
+            joint.orient[:frames] = rot
+
+        if joint.worldpos is not None:
+            joint.worldpos[:frames] = pos
+
+        for child in reversed(joint.children):
+            if needed[child]:
+                stack.append((child, rot, pos))
+
+
+###############################
+# POSEPLAN class
+# Single-pose counterpart of process_bvhkeyframes, for tools that evaluate
+# one frame at a time (an interactive viewer, a live stream).  Calling
+# process_bvhkeyframes on one frame walks the joint tree and builds small
+# arrays for every joint, which costs far more than the arithmetic.
+#
+# A PosePlan is compiled once from the joint tree: the keyframe index of
+# every channel, the rotation axes in channel order and the joints grouped
+# by depth, parents first.  All buffers, and the views of them used by
+# each depth level, are allocated at that point.  evaluate() then runs a
+# fixed sequence of NumPy calls writing into those buffers (out=): the
+# axis rotations of all joints at once, then one level of the tree at a
+# time, every joint of a level at once.  No arrays are allocated per call.
+#
+# As in process_bvhkeyframes, only the output joints and their ancestors
+# are evaluated and position channels of non-root joints are ignored.  A
+# plan isn't safe to share between threads, since its buffers are reused.
+
+# Entries of the 3x3 rotation about each axis (see _axis_rotations), as
+# positions in PosePlan's table of cosines, sines, negated sines, 0 and 1.
+_COS, _SIN, _NEG_SIN, _ZERO, _ONE = range(5)
+_AXIS_ENTRIES = {"X": ((_ONE, _ZERO, _ZERO), (_ZERO, _COS, _NEG_SIN), (_ZERO, _SIN, _COS)),
+                 "Y": ((_COS, _ZERO, _SIN), (_ZERO, _ONE, _ZERO), (_NEG_SIN, _ZERO, _COS)),
+                 "Z": ((_COS, _NEG_SIN, _ZERO), (_SIN, _COS, _ZERO), (_ZERO, _ZERO, _ONE))}
+
+
+class PosePlan(object):
+
+    def __init__(self, root, joints, dtype=np.float64):
+        """
+        :param root: Root joint of the hierarchy.
+        :type root: Joint
+        :param joints: Joints whose results are returned, in output order.
+        :type joints: list
+        :param dtype: Floating point type of the computation and results.
+        """
+        first_channel, order = channel_offsets(root)
+        self.num_channels = sum(len(joint.channels) for joint in order)
+        zero = self.num_channels  # Index of a channel value that is always 0
+
+        # Only the output joints and their ancestors are evaluated
+        output = set(joints)
+        needed = {}
+        for joint in reversed(order):
+            needed[joint] = joint in output or any(needed[child] for child in joint.children)
+        depth = {root: 0}
+        for joint in order[1:]:
+            depth[joint] = depth[joint.parent] + 1
+        plan = sorted([joint for joint in order if needed[joint]], key=lambda joint: depth[joint])
+        position = dict((joint, i) for i, joint in enumerate(plan))
+        n = len(plan)
+
+        # Up to 3 rotations per joint, in channel order; the unused slots
+        # rotate by channel zero, i.e. not at all.
+        # The table holds the cosines, sines and negated sines of the 3n
+        # angles, then 0 and 1; entry_index picks the entries of the axis
+        # rotations from it.
+        angle_index = np.full((n, 3), zero, dtype=np.intp)
+        entry_index = np.zeros((n, 3, 3, 3), dtype=np.intp)
+        constants = {_ZERO: 9 * n, _ONE: 9 * n + 1}
+        for i, joint in enumerate(plan):
+            axes = []
+            for counter, channel in enumerate(joint.channels, first_channel[joint]):
+                if channel in ("Xrotation", "Yrotation", "Zrotation"):
+                    if len(axes) == 3:
+                        raise ValueError("Too many rotation channels in joint %s" % joint.name)
+                    angle_index[i, len(axes)] = counter
+                    axes.append(channel[0])
+                elif channel not in ("Xposition", "Yposition", "Zposition"):
+                    raise ValueError("Illegal channel name '%s' in joint %s" % (channel, joint.name))
+            axes += ["X"] * (3 - len(axes))
+            for slot, axis in enumerate(axes):
+                angle = 3 * i + slot
+                entry_index[i, slot] = [[constants[entry] if entry in constants else entry * 3 * n + angle
+                                         for entry in row] for row in _AXIS_ENTRIES[axis]]
+        self._angle_index = angle_index
+        self._entry_index = entry_index
+
+        def channel_index(joint, channel):
+            # The last one of a repeated channel wins, as in process_bvhkeyframe
+            for counter, name in reversed(list(enumerate(joint.channels, first_channel[joint]))):
+                if name == channel:
+                    return counter
+            return zero
+
+        self._translation_index = np.array([channel_index(root, axis + "position") for axis in "XYZ"],
+                                           dtype=np.intp)
+        self._rotation_index = np.array([[channel_index(joint, axis + "rotation") for axis in "XYZ"]
+                                         for joint in joints], dtype=np.intp).reshape(-1, 3)
+        self._output_index = np.array([position[joint] for joint in joints], dtype=np.intp)
+
+        # Buffers
+        self._keyframe = np.zeros(self.num_channels + 1, dtype=dtype)
+        self._angles = np.zeros((n, 3), dtype=dtype)
+        self._table = np.zeros(9 * n + 2, dtype=dtype)
+        self._table[-1] = 1.
+        self._axis_rots = np.zeros((n, 3, 3, 3), dtype=dtype)
+        self._pair = np.zeros((n, 3, 3), dtype=dtype)
+        self._local = np.zeros((n, 3, 3), dtype=dtype)
+        self._rot = np.zeros((n, 3, 3), dtype=dtype)
+        self._pos = np.zeros((n, 3), dtype=dtype)
+        self._parent_rot = np.zeros((n, 3, 3), dtype=dtype)
+        self._parent_pos = np.zeros((n, 3), dtype=dtype)
+        self._offset_pos = np.zeros((n, 3, 1), dtype=dtype)
+        self._translation = np.zeros(3, dtype=dtype)
+        self.worldpos = np.zeros((len(joints), 3), dtype=dtype)
+        self.rotations = np.zeros((len(joints), 3), dtype=dtype)
+        self._orientations = np.zeros((len(joints), 3, 3), dtype=dtype)
+
+        # Views used by evaluate()
+        self._cos, self._sin, self._neg_sin = [self._table[k * 3 * n:(k + 1) * 3 * n].reshape(n, 3)
+                                               for k in (_COS, _SIN, _NEG_SIN)]
+        self._slots = [self._axis_rots[:, slot] for slot in range(3)]
+        self._root_offset = root.stransmat[:3, 3].astype(dtype)
+        self._levels = []
+        offsets = np.array([joint.stransmat[:3, 3] for joint in plan], dtype=dtype).reshape(n, 3, 1)
+        start = 1
+        while start < n:
+            stop = start
+            while stop < n and depth[plan[stop]] == depth[plan[start]]:
+                stop += 1
+            level = slice(start, stop)
+            self._levels.append((np.array([position[joint.parent] for joint in plan[level]], dtype=np.intp),
+                                 self._parent_rot[level], self._parent_pos[level],
+                                 offsets[level], self._offset_pos[level], self._offset_pos[level, :, 0],
+                                 self._local[level], self._rot[level], self._pos[level]))
+            start = stop
+
+    def evaluate(self, keyframe, worldpos=None, rotations=None, orientations=None, trtr=None):
+        """
+        Evaluate a single pose.  The results are written to the arrays
+        passed in, or else to buffers of the plan that the next call
+        overwrites.
+        :param keyframe: Channel values of the frame.
+        :type keyframe: numpy.ndarray
+        :param worldpos: (joints, 3) array for the world positions.
+        :param rotations: (joints, 3) array for the rotation channel values.
+        :param orientations: (joints, 3, 3) array for the global rotations, if wanted.
+        :param trtr: (joints, 4, 4) array for the joint transforms, if wanted.
+        :return: Tuple of the worldpos and rotations arrays.
+        :rtype: tuple
+        """
+        if len(keyframe) != self.num_channels:
+            raise ValueError("Expected %d channel values, got %d" % (self.num_channels, len(keyframe)))
+        if worldpos is None:
+            worldpos = self.worldpos
+        if rotations is None:
+            rotations = self.rotations
+        values = self._keyframe
+        values[:-1] = keyframe
+
+        # Rotation about every axis of every joint, then their products
+        np.take(values, self._angle_index, out=self._angles, mode='clip')
+        np.radians(self._angles, out=self._angles)
+        np.cos(self._angles, out=self._cos)
+        np.sin(self._angles, out=self._sin)
+        np.negative(self._sin, out=self._neg_sin)
+        np.take(self._table, self._entry_index, out=self._axis_rots, mode='clip')
+        np.matmul(self._slots[0], self._slots[1], out=self._pair)
+        np.matmul(self._pair, self._slots[2], out=self._local)
+
+        # Root, then one level of the tree at a time
+        np.take(values, self._translation_index, out=self._translation, mode='clip')
+        np.add(self._root_offset, self._translation, out=self._pos[0])
+        self._rot[0] = self._local[0]
+        for parents, parent_rot, parent_pos, offsets, offset_pos, offset_pos_flat, local, rot, pos in self._levels:
+            np.take(self._rot, parents, axis=0, out=parent_rot, mode='clip')
+            np.take(self._pos, parents, axis=0, out=parent_pos, mode='clip')
+            np.matmul(parent_rot, offsets, out=offset_pos)
+            np.add(parent_pos, offset_pos_flat, out=pos)
+            np.matmul(parent_rot, local, out=rot)
+
+        np.take(self._pos, self._output_index, axis=0, out=worldpos, mode='clip')
+        np.take(values, self._rotation_index, out=rotations, mode='clip')
+        if orientations is not None or trtr is not None:
+            if orientations is None:
+                orientations = self._orientations
+            np.take(self._rot, self._output_index, axis=0, out=orientations, mode='clip')
+            if trtr is not None:
+                trtr[:, :3, :3] = orientations
+                trtr[:, :3, 3] = worldpos
+                trtr[:, 3, :3] = 0.
+                trtr[:, 3, 3] = 1.
+        return worldpos, rotations
+
+
 ###############################
 # PROCESS_BVHFILE function
 
-def process_bvhfile(filename, DEBUG=0):
+def process_bvhfile(filename, DEBUG=0, keep_trtr=False, cache=None, select=None,
+                    start=None, end=None, step=None, keep_orientations=False, stats=NO_STATS,
+                    rigs=None, dtype=np.float64):
 
     # 9/11/08: the caller of this routine should cover possible exceptions.
     # Here are two possible errors:
@@ -599,19 +1148,219 @@ def process_bvhfile(filename, DEBUG=0):
     # So this isn't useful for error-checking.
     #
     # my_bvh.read() returns None on success and throws an exception on failure.
+    #
+    # cache is an optional ParseCache (or a cache directory) that the parsed
+    # file is taken from or stored in.  select picks the joints to keep,
+    # see Skeleton.  start, end and step select frames like a slice of
+    # the frame numbers; the other frames are skipped without parsing.
+    # keep_trtr and keep_orientations add the Skeleton arrays of the same
+    # names.  stats (see bvh_converter.stats) records the read and skeleton
+    # stages.  rigs is an optional RigCache (see bvh_converter.rigs) that
+    # compiles the hierarchy, or takes it from an earlier file with the
+    # same one; the skeleton's rig tells which rig that was.  dtype is
+    # numpy.float64 or numpy.float32: the keyframes are parsed to it, and
+    # the skeleton stores and process_bvhkeyframes computes the results
+    # in it (see float_dtype).
 
     print("Reading BVH file...",)
     my_bvh = ReadBVH(filename)  # Doesn't actually read the file, just creates
     # a readbvh object and sets up the file for
     # reading in the next line.
-    my_bvh.read()  # Reads and parses the file.
-
-    hips = process_bvhnode(my_bvh.root)  # Create joint hierarchy
-    print("done")
-
-    print("Building skeleton...",)
-    myskeleton = Skeleton(hips, keyframes=my_bvh.keyframes, frames=my_bvh.frames, dt=my_bvh.dt)
-    print("done")
+    my_bvh.frame_range = slice(start, end, step)
+    my_bvh.rig_cache = rigs
+    my_bvh.dtype = dtype
+    with stats.stage("read") as stage:
+        if cache is None:
+            my_bvh.read()  # Reads and parses the file.
+            stats.add_bytes_read(os.path.getsize(filename))
+        else:
+            if not isinstance(cache, ParseCache):
+                cache = ParseCache(cache)
+            cache.read(my_bvh, stats)
+        stage.frames = len(my_bvh.keyframes)
+
+    with stats.stage("skeleton", len(my_bvh.keyframes)):
+        hips, joints = build_joints(my_bvh)  # Create joint hierarchy
+        print("done")
+
+        print("Building skeleton...",)
+        start, _, step = my_bvh.frame_indices(my_bvh.frames)
+        myskeleton = Skeleton(hips, keyframes=my_bvh.keyframes, frames=len(my_bvh.keyframes), dt=my_bvh.dt,
+                              keep_trtr=keep_trtr, select=select, start_frame=start, frame_step=step,
+                              keep_orientations=keep_orientations, joints=joints, rig=my_bvh.rig)
+        print("done")
     if DEBUG:
         print("skeleton is: ", myskeleton)
     return myskeleton
+
+
+###############################
+# PROCESS_BVHFILE_CHUNKS function
+#
+# Streaming counterpart of process_bvhfile: reads chunk_frames keyframes
+# at a time, runs the forward kinematics on them and yields a Skeleton
+# holding just that window of the clip (its frames attribute is still the
+# number of frames in the whole clip).  Only one window is kept in
+# memory at a time, as long as the caller doesn't hold on to them.
+# start, end, step, rigs and dtype work as in process_bvhfile.  stats records
+# the read, skeleton and fk stages, added up over the chunks.
+# The joints are shared by all yielded skeletons and always point to
+# the storage of the latest one.
+
+def process_bvhfile_chunks(filename, chunk_frames=1024, keep_trtr=False, select=None,
+                           start=None, end=None, step=None, keep_orientations=False, stats=NO_STATS,
+                           rigs=None, dtype=np.float64):
+    my_bvh = ReadBVH(filename)
+    my_bvh.frame_range = slice(start, end, step)
+    my_bvh.rig_cache = rigs
+    my_bvh.dtype = dtype
+    hips = None
+    first_frame = 0
+    chunks = my_bvh.read_chunks(chunk_frames)
+    while True:
+        with stats.stage("read") as stage:
+            keyframes = next(chunks, None)
+            if keyframes is not None:
+                stage.frames = len(keyframes)
+        if keyframes is None:
+            break
+        with stats.stage("skeleton", len(keyframes)):
+            if hips is None:
+                hips, joints = build_joints(my_bvh)  # Create joint hierarchy
+                if joints is None:
+                    joints = Skeleton.joint_dfs(hips)
+                start, stop, step = my_bvh.frame_indices(my_bvh.frames)
+                frames = len(range(start, stop, step))
+            skeleton = Skeleton(hips, keyframes=keyframes, frames=frames, dt=my_bvh.dt,
+                                keep_trtr=keep_trtr, first_frame=first_frame, select=select,
+                                start_frame=start, frame_step=step, keep_orientations=keep_orientations,
+                                joints=joints, rig=my_bvh.rig)
+        with stats.stage("fk", len(keyframes)):
+            process_bvhkeyframes(keyframes, hips)
+        yield skeleton
+        first_frame += len(keyframes)
+    stats.add_bytes_read(os.path.getsize(filename))
+
+    if hips is None:  # No frames at all, still report the hierarchy
+        hips, joints = build_joints(my_bvh)
+        keyframes = np.empty((0, my_bvh.num_channels), dtype=dtype)
+        yield Skeleton(hips, keyframes=keyframes, frames=0, dt=getattr(my_bvh, "dt", .033333333),
+                       keep_trtr=keep_trtr, select=select, keep_orientations=keep_orientations,
+                       joints=joints, rig=my_bvh.rig)
+
+
+###############################
+# PROCESS_BVHFILE_FOLLOW function
+#
+# Like process_bvhfile_chunks, for a file that is still being written,
+# as tail -f does: the hierarchy is parsed once, then the frame lines are
+# converted as they are appended, and a Skeleton is yielded for every
+# batch of new frames (at most chunk_frames of them).  The Frames: count
+# of the header is ignored, so the yielded skeletons have frames=None;
+# their first_frame is the number of frames yielded before.  The file is
+# polled every poll_interval seconds, and it counts as finished once no
+# data was appended for timeout seconds (never if None) or the
+# threading.Event stop is set.  start, end and step select frames as in
+# process_bvhfile; reading stops at end.  dtype works as in process_bvhfile.
+
+def process_bvhfile_follow(filename, chunk_frames=1024, keep_trtr=False, select=None,
+                           start=None, end=None, step=None, keep_orientations=False, stats=NO_STATS,
+                           rigs=None, poll_interval=0.1, timeout=None, stop=None, dtype=np.float64):
+    if get_compression(filename) is not None:
+        raise ValueError("Can't follow compressed file %s" % filename)
+    source = GrowingFile(filename, poll_interval, timeout, stop)
+    return process_bvhstream(source, chunk_frames, keep_trtr, select, start, end, step,
+                             keep_orientations, stats, rigs, dtype)
+
+
+###############################
+# PROCESS_BVHSTREAM function
+#
+# The loop behind process_bvhfile_follow, for any source of BVH lines
+# that works like a GrowingFile: readline(), wait() for more lines
+# (False once the source is finished), available(limit) for the lines
+# that are there without waiting, line_num and close().  The source is
+# closed when the generator is done.
+
+def process_bvhstream(source, chunk_frames=1024, keep_trtr=False, select=None,
+                      start=None, end=None, step=None, keep_orientations=False, stats=NO_STATS,
+                      rigs=None, dtype=np.float64):
+    if step is not None and step < 1:
+        raise ValueError("Frame step must be at least 1")
+    start = start or 0
+    step = step or 1
+    try:
+        my_bvh = ReadBVH(getattr(source, "filename", None))
+        my_bvh.rig_cache = rigs
+        my_bvh.dtype = dtype
+        my_bvh.read_header(source)
+        hips, joints = build_joints(my_bvh)
+        if joints is None:
+            joints = Skeleton.joint_dfs(hips)
+        dt = getattr(my_bvh, "dt", .033333333)
+        index = 0  # Number of the next frame line
+        count = 0  # Number of frames yielded
+        plan = None
+        while end is None or index < end:
+            with stats.stage("read") as stage:
+                if not source.wait():
+                    break
+                lines = source.available(chunk_frames * step if end is None
+                                         else min(chunk_frames * step, end - index))
+                # Number the lines before dropping the blank ones, for errors
+                first_line = source.line_num - len(lines) + 1
+                line_nums = [n for n, s in enumerate(lines, first_line) if s.strip()]
+                lines = [s for s in lines if s.strip()]
+                # Only the selected frames are converted
+                skip = max(start - index, 0)
+                skip += (-(index + skip - start)) % step
+                index += len(lines)
+                lines = lines[skip::step]
+                line_nums = line_nums[skip::step]
+                if not lines:
+                    continue
+                keyframes = parse_frame_lines(lines, my_bvh.num_channels, line_nums[0], step, dtype,
+                                              line_nums)
+                stage.frames = len(keyframes)
+            with stats.stage("skeleton", len(keyframes)):
+                skeleton = Skeleton(hips, keyframes=keyframes, frames=None, dt=dt,
+                                    keep_trtr=keep_trtr, first_frame=count, select=select,
+                                    start_frame=start, frame_step=step, keep_orientations=keep_orientations,
+                                    joints=joints, rig=my_bvh.rig)
+            with stats.stage("fk", len(keyframes)):
+                if len(keyframes) == 1:
+                    # Frames arriving one by one share a compiled PosePlan
+                    if plan is None:
+                        plan = PosePlan(hips, skeleton.joints, skeleton.dtype)
+                    skeleton._pose_plan = plan
+                    skeleton.evaluate_pose(keyframes[0], 0)
+                else:
+                    process_bvhkeyframes(keyframes, hips)
+            yield skeleton
+            count += len(keyframes)
+        if count == 0:  # No frames at all, still report the hierarchy
+            yield Skeleton(hips, keyframes=np.empty((0, my_bvh.num_channels), dtype=dtype), frames=0, dt=dt,
+                           keep_trtr=keep_trtr, select=select, keep_orientations=keep_orientations,
+                           joints=joints, rig=my_bvh.rig)
+    finally:
+        source.close()
+
+
+###############################
+# PROCESS_BVHFILE_LAZY function
+#
+# Like process_bvhfile, but only the hierarchy is parsed up front.  The
+# motion lines are memory-mapped and frames are read and evaluated on
+# request, so looking at a few frames of a huge file is cheap.  rigs and
+# dtype work as in process_bvhfile.
+
+def process_bvhfile_lazy(filename, keep_trtr=False, select=None, keep_orientations=False, rigs=None,
+                         dtype=np.float64):
+    my_bvh = ReadBVH(filename)
+    my_bvh.rig_cache = rigs
+    my_bvh.dtype = dtype
+    keyframes = my_bvh.map_motion()
+    hips, joints = build_joints(my_bvh)  # Create joint hierarchy
+    return LazySkeleton(hips, keyframes, frames=len(keyframes), dt=getattr(my_bvh, "dt", .033333333),
+                        keep_trtr=keep_trtr, select=select, keep_orientations=keep_orientations,
+                        joints=joints, rig=my_bvh.rig)
@@ -0,0 +1,235 @@
+from __future__ import print_function, division
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from bvh_converter.bvh import BvhReader, Node
+from bvh_converter.stats import NO_STATS
+
+"""
+On-disk cache of parsed BVH files.
+
+Every entry is a pair of files named after the entry key:
+ - <key>.npy holds the motion data as a (frames, channels) float64 array,
+   which is loaded memory-mapped.
+ - <key>.json holds the hierarchy, frame count and frame time.
+
+The key is derived from the file contents (or, when use_hash is False,
+from its path, size and modification time) and CACHE_VERSION, so a
+changed file or a new parser simply misses the old entries.  Old entries
+are evicted least recently used first once the cache grows beyond
+max_size bytes.
+"""
+
+# Bump whenever the parser output changes, to invalidate existing entries.
+CACHE_VERSION = 1
+
+# Replace the destination if it exists (os.rename doesn't on Windows).
+_replace = getattr(os, "replace", os.rename)
+
+
+def node_to_dict(node):
+    """Convert a Node hierarchy to nested dictionaries."""
+    return {"name": node.name,
+            "offset": list(node.offset),
+            "channels": list(node.channels),
+            "children": [node_to_dict(child) for child in node.children]}
+
+
+def node_from_dict(data, root=True):
+    """Rebuild a Node hierarchy from node_to_dict() output."""
+    node = Node(root=root)
+    node.name = data["name"]
+    node.offset = tuple(data["offset"])
+    node.channels = list(data["channels"])
+    node.children = [node_from_dict(child, root=False)
+                     for child in data["children"]]
+    return node
+
+
+class _RecordingReader(BvhReader):
+    """Reader that keeps everything needed for a cache entry."""
+
+    def on_hierarchy(self, root):
+        self.frames = None
+        self.dt = None
+        self.values = None
+
+    def on_motion(self, frames, dt):
+        self.frames = frames
+        self.dt = dt
+
+    def on_frames(self, values):
+        self.values = values
+
+
+class ParseCache(object):
+    """Cache of parsed BVH files in a directory."""
+
+    def __init__(self, directory, max_size=1 << 30, use_hash=True):
+        """
+        :param directory: Cache directory, created if needed.
+        :param max_size: Maximum total size of the entries in bytes.
+        :param use_hash: Key entries by a hash of the file contents. If False,
+            the path, size and modification time are used instead, which
+            avoids reading the file on a cache hit.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.use_hash = use_hash
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, filename):
+        """Return the cache key of filename."""
+        digest = hashlib.sha1()
+        digest.update(("bvh-cache-%d\n" % CACHE_VERSION).encode("ascii"))
+        if self.use_hash:
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+        else:
+            stat = os.stat(filename)
+            digest.update(("%s\n%d\n%r\n" % (os.path.realpath(filename), stat.st_size,
+                                             stat.st_mtime)).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".json", base + ".npy"
+
+    def read(self, reader, stats=NO_STATS):
+        """
+        Read reader.filename like reader.read() does, taking the result from
+        the cache if possible.  The reader's on_hierarchy, on_motion and
+        on_frames callbacks are called just like when parsing the file,
+        including the reader's frame_range.  Entries always hold all frames.
+        :param reader: Reader to fill in.
+        :type reader: BvhReader
+        :param stats: Statistics (see bvh_converter.stats) that get the bytes
+            read: the file for a hash key or a miss, the entry on a hit.
+        :return: True on a cache hit.
+        :rtype: bool
+        """
+        key = self.key(reader.filename)
+        if self.use_hash:
+            stats.add_bytes_read(os.path.getsize(reader.filename))
+        entry = self.load(key)
+        hit = entry is not None
+        if hit:
+            stats.add_bytes_read(sum(os.path.getsize(path) for path in self._paths(key)
+                                     if os.path.exists(path)))
+        else:
+            recorder = _RecordingReader(reader.filename)
+            recorder.read()
+            stats.add_bytes_read(os.path.getsize(reader.filename))
+            entry = {"root": recorder.root,
+                     "num_channels": recorder.num_channels,
+                     "frames": recorder.frames,
+                     "dt": recorder.dt,
+                     "values": recorder.values}
+            self.store(key, entry)
+
+        reader.root = entry["root"]
+        reader.num_channels = entry["num_channels"]
+        reader.on_hierarchy(reader.root)
+        if entry["frames"] is not None:
+            reader.on_motion(entry["frames"], entry["dt"])
+            start, stop, step = reader.frame_indices(entry["frames"])
+            values = entry["values"][start:stop:step]
+            if values.dtype != reader.dtype:  # Entries are always float64
+                values = values.astype(reader.dtype)
+            reader.on_frames(values)
+        return hit
+
+    def load(self, key):
+        """Return the entry for key, or None if there is no valid entry."""
+        meta_path, values_path = self._paths(key)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta.get("version") != CACHE_VERSION:
+                raise ValueError("cache entry version mismatch")
+            values = None
+            if meta["frames"] is not None:
+                values = np.load(values_path, mmap_mode='r')
+                if values.shape != (meta["frames"], meta["num_channels"]):
+                    raise ValueError("cache entry shape mismatch")
+        except (IOError, OSError, ValueError, KeyError):
+            self.remove(key)
+            return None
+        os.utime(meta_path, None)  # Mark as recently used
+        return {"root": node_from_dict(meta["root"]),
+                "num_channels": meta["num_channels"],
+                "frames": meta["frames"],
+                "dt": meta["dt"],
+                "values": values}
+
+    def store(self, key, entry):
+        """Add an entry to the cache and evict old entries if needed."""
+        values = entry["values"]
+        size = values.nbytes if values is not None else 0
+        if size > self.max_size:
+            return
+        meta = {"version": CACHE_VERSION,
+                "root": node_to_dict(entry["root"]),
+                "num_channels": entry["num_channels"],
+                "frames": entry["frames"],
+                "dt": entry["dt"]}
+        meta_path, values_path = self._paths(key)
+        # Write to temporary files first so readers never see partial entries.
+        # The metadata goes last since it marks the entry as complete.
+        if values is not None:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.ascontiguousarray(values, dtype=np.float64))
+            _replace(tmp, values_path)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        _replace(tmp, meta_path)
+        self.evict()
+
+    def remove(self, key):
+        """Remove the entry for key, if present."""
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def entries(self):
+        """
+        List the cache entries.
+        :return: List of (last use, size in bytes, key), least recently used first.
+        :rtype: list
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-5]
+            size = 0
+            try:
+                for path in self._paths(key):
+                    if os.path.exists(path):
+                        size += os.path.getsize(path)
+                last_use = os.path.getmtime(self._paths(key)[0])
+            except OSError:  # Removed concurrently
+                continue
+            entries.append((last_use, size, key))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits max_size."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_size:
+                break
+            self.remove(key)
+            total -= size
@@ -0,0 +1,123 @@
+from __future__ import print_function, division
+import sys
+import argparse
+import json
+import os
+import socket
+import tempfile
+
+"""
+Thin client of the conversion daemon (see bvh_converter.daemon).
+
+    bvh-converter-client [--socket PATH] <bvh-converter arguments>
+    bvh-converter-client --status
+    bvh-converter-client --stop
+
+The conversion arguments are handed to the daemon as they are and parsed
+there, so this module only imports the standard library and starts fast.
+
+The daemon speaks newline delimited JSON over a UNIX socket: the client
+sends one request per connection and reads response lines until the
+connection is closed.
+ - {"command": "convert", "argv": [...], "cwd": "..."}: convert the files,
+   answered by a {"event": "file", ...} line per file as it is done and
+   a final {"event": "done", ...} line.
+ - {"command": "status"}: the daemon's state.
+ - {"command": "stop"}: finish the running jobs and exit.
+Errors are answered by {"event": "error", "error": message}.
+"""
+
+
+def default_socket():
+    """Return the socket path used unless one is given: $BVH_CONVERTER_SOCKET,
+    or a per-user file in the temporary directory."""
+    path = os.environ.get("BVH_CONVERTER_SOCKET")
+    if path:
+        return path
+    uid = os.getuid() if hasattr(os, "getuid") else 0
+    return os.path.join(tempfile.gettempdir(), "bvh-converter-{}.sock".format(uid))
+
+
+def request(message, socket_path=None, timeout=None):
+    """
+    Send a request to the daemon and yield its responses.
+    :param message: Request dictionary, see the module documentation.
+    :param socket_path: Socket of the daemon (default: default_socket()).
+    :param timeout: Seconds to wait for each response line (default: no limit).
+    :return: Generator of response dictionaries.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(socket_path or default_socket())
+        sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+        responses = sock.makefile("rb")
+        try:
+            for line in responses:
+                yield json.loads(line.decode("utf-8"))
+        finally:
+            responses.close()
+    finally:
+        sock.close()
+
+
+def convert(argv, socket_path=None, cwd=None):
+    """
+    Have the daemon convert files as `bvh-converter argv` would.
+    :param argv: List of bvh-converter command line arguments.
+    :param cwd: Directory relative file names are taken from (default: the current one).
+    :return: Generator of response dictionaries.
+    """
+    return request({"command": "convert", "argv": list(argv), "cwd": cwd or os.getcwd()}, socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="bvh-converter-client",
+        description="Convert BVH files with a running conversion daemon (bvh-converter-daemon). "
+                    "Any other arguments are bvh-converter arguments.")
+    parser.add_argument("--socket", type=str, help='Socket of the daemon (default: {}).'.format(default_socket()))
+    parser.add_argument("--status", action='store_true', help='Show the state of the daemon.')
+    parser.add_argument("--stop", action='store_true', help='Stop the daemon once its jobs are done.')
+    args, argv = parser.parse_known_args()
+    if args.status:
+        message = {"command": "status"}
+    elif args.stop:
+        message = {"command": "stop"}
+    elif argv:
+        message = {"command": "convert", "argv": argv, "cwd": os.getcwd()}
+    else:
+        parser.error("no files to convert")
+
+    failed = 0
+    try:
+        for response in request(message, args.socket):
+            event = response.get("event")
+            if event == "file":
+                if response["error"] is None:
+                    print("OK      {} ({} frames, {:.2f}s)".format(response["file"], response["frames"],
+                                                                 response["seconds"]))
+                else:
+                    failed += 1
+                    print("FAILED  {} ({})".format(response["file"], response["error"]))
+            elif event == "done":
+                if response.get("profile") is not None:
+                    print(json.dumps(response["profile"], indent=2))
+                print("Converted {} of {} files in {:.2f}s".format(
+                    response["files"] - response["failed"], response["files"], response["seconds"]))
+            elif event == "stopping":
+                print("The daemon stops once its jobs are done")
+            elif event == "error":
+                failed += 1
+                print("Error: {}".format(response["error"]), file=sys.stderr)
+            else:
+                print(json.dumps(response, indent=2, sort_keys=True))
+    except socket.error as e:
+        print("Error: can't reach the daemon ({})".format(e), file=sys.stderr)
+        sys.exit(2)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+from __future__ import print_function, division
+import sys
+import argparse
+import errno
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import os
+import signal
+import socket
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:  # Python 2
+    import SocketServer as socketserver
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from bvh_converter.__main__ import (build_parser, check_arguments, colliding_outputs, convert_task, find_inputs,
+                                    write_profile)
+from bvh_converter.client import default_socket
+
+"""
+Conversion daemon: a long running process that listens on a UNIX socket
+and converts files on request, so the start-up of Python and the imports
+are paid only once.
+
+    bvh-converter-daemon [--socket PATH] [--max-jobs N]
+    bvh-converter-client <bvh-converter arguments>
+
+Jobs take the arguments of bvh-converter, and are run by a pool of
+max_jobs worker processes that stay alive between requests; further jobs
+wait for a free worker.  A job whose worker dies fails, and so do the
+others running in the pool at the time; the next job starts a new pool.  Relative file names are taken from the client's
+working directory.  -j/--jobs is ignored and --fk-jobs isn't available,
+since the pool decides how many files are converted at once; neither is
+--follow, which would hold on to a worker indefinitely.
+
+The protocol is described in bvh_converter.client.  SIGINT, SIGTERM or a
+stop request make the daemon stop accepting connections, finish the jobs
+it has accepted, and remove its socket.
+"""
+
+
+class JobError(Exception):
+    """A request the daemon can't carry out."""
+
+
+class _JobParser(argparse.ArgumentParser):
+    """Command line parser for job arguments, raising JobError instead of exiting."""
+
+    def error(self, message):
+        raise JobError(message)
+
+    def exit(self, status=0, message=None):
+        raise JobError(message or "Unsupported argument")
+
+
+def parse_job(argv, cwd):
+    """
+    Parse the bvh-converter arguments of a job.
+    :param argv: List of command line arguments.
+    :param cwd: Directory relative paths are taken from.
+    :return: Parsed arguments, with absolute paths.
+    :rtype: argparse.Namespace
+    """
+    parser = build_parser(_JobParser)
+    args = parser.parse_args([str(arg) for arg in argv])
+    check_arguments(parser, args)
+    if args.fk_jobs != 1 or args.follow:
+        raise JobError("--fk-jobs and --follow aren't available in the daemon")
+    args.filenames = [os.path.join(cwd, name) for name in args.filenames]
+    if args.cache_dir:
+        args.cache_dir = os.path.join(cwd, args.cache_dir)
+    if args.profile and args.profile != "-":
+        args.profile = os.path.join(cwd, args.profile)
+    return args
+
+
+def _init_worker():
+    # Ctrl-C reaches the whole process group; only the daemon handles it,
+    # so the running jobs can finish.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _remove_stale_socket(socket_path):
+    """Remove socket_path if it was left behind by a daemon that is gone."""
+    if not os.path.exists(socket_path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        os.remove(socket_path)
+        return
+    finally:
+        sock.close()
+    raise socket.error(errno.EADDRINUSE, "A daemon is already listening on {}".format(socket_path))
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Handle one request per connection, see bvh_converter.client."""
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line.strip():  # Connected without a request, e.g. to probe the socket
+            return
+        try:
+            message = json.loads(line.decode("utf-8"))
+            if not isinstance(message, dict):
+                raise JobError("Requests must be JSON objects")
+            command = message.get("command")
+            if command == "convert":
+                self.server.convert(message, self.send)
+            elif command == "status":
+                self.send(self.server.status())
+            elif command == "stop":
+                self.server.stop()
+                self.send({"event": "stopping"})
+            else:
+                raise JobError("Unknown command '{}'".format(command))
+        except (ValueError, JobError) as e:  # Bad JSON is a ValueError
+            self.send({"event": "error", "error": str(e)})
+
+    def send(self, message):
+        self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+
+class ConversionDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Server converting files in a pool of worker processes."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=None, max_jobs=1):
+        """
+        :param socket_path: Socket to listen on (default: see bvh_converter.client.default_socket).
+        :param max_jobs: Number of files converted at once.
+        """
+        self.socket_path = socket_path or default_socket()
+        self.max_jobs = max_jobs
+        self.started = time.time()
+        self.stopping = False
+        self.jobs_pending = 0
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self._requests = 0
+        self._lock = threading.Condition()
+        _remove_stale_socket(self.socket_path)
+        self.pool = self._start_pool()
+        try:
+            socketserver.UnixStreamServer.__init__(self, self.socket_path, _RequestHandler)
+        except Exception:
+            self.pool.shutdown(wait=False)
+            raise
+
+    def _start_pool(self):
+        # Spawned workers don't inherit the socket, so they can't keep it
+        # open if the daemon dies.
+        return ProcessPoolExecutor(self.max_jobs, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_worker)
+
+    def process_request(self, request, client_address):
+        # Counted here, in the serving thread, so serve() can't miss a
+        # request whose thread hasn't started yet.
+        with self._lock:
+            self._requests += 1
+        socketserver.ThreadingMixIn.process_request(self, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            socketserver.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self._lock:
+                self._requests -= 1
+                self._lock.notify_all()
+
+    def convert(self, message, send):
+        """Run a convert request, calling send with every response."""
+        if self.stopping:
+            raise JobError("The daemon is stopping")
+        args = parse_job(message.get("argv") or [], message.get("cwd") or os.getcwd())
+        start = time.time()
+        files, missing = find_inputs(args.filenames)
+        collisions = colliding_outputs(files)
+        if collisions:
+            raise JobError("{} would write the same output files".format(", ".join(collisions[0])))
+        failed = len(missing)
+        for pattern in missing:
+            send({"event": "file", "file": pattern, "error": "File not found", "frames": 0,
+                  "seconds": 0., "wait_seconds": 0., "outputs": []})
+
+        done = queue.Queue()
+        with self._lock:
+            self.jobs_pending += len(files)
+        collected = 0
+        try:
+            for file_in in files:
+                self._submit(file_in, args, done)
+
+            profiles = []
+            total_frames = 0
+            connected = True
+            # Collect every result even if the client went away, to keep count.
+            for _ in files:
+                (file_in, num_frames, seconds, error, profile, outputs), submitted = done.get()
+                collected += 1
+                with self._lock:
+                    self.jobs_pending -= 1
+                    self.jobs_done += 1
+                    self.jobs_failed += error is not None
+                if error is None:
+                    total_frames += num_frames
+                else:
+                    failed += 1
+                if profile is not None:
+                    profiles.append(profile)
+                if connected:
+                    try:
+                        send({"event": "file", "file": file_in, "error": error, "frames": num_frames,
+                              "seconds": seconds, "wait_seconds": max(time.time() - submitted - seconds, 0.),
+                              "outputs": outputs})
+                    except socket.error:
+                        connected = False
+        finally:
+            with self._lock:
+                self.jobs_pending -= len(files) - collected
+
+        summary = {"event": "done", "files": len(files) + len(missing), "failed": failed,
+                   "frames": total_frames, "seconds": time.time() - start, "profile": None}
+        if args.profile == "-":
+            summary["profile"] = {"files": profiles}
+        elif args.profile:
+            write_profile(profiles, args.profile)
+        if connected:
+            send(summary)
+
+    def _submit(self, file_in, args, done):
+        """Convert file_in in the pool, putting (result, time submitted) on
+        the queue done.  Errors outside convert_task, such as results that
+        can't be pickled or a worker that died, are put there as failed
+        results."""
+        submitted = time.time()
+
+        def finished(future):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = (file_in, 0, 0., "{}: {}".format(type(e).__name__, e), None, [])
+            done.put((result, submitted))
+
+        with self._lock:
+            try:
+                future = self.pool.submit(convert_task, (file_in, args))
+            except BrokenProcessPool:
+                # A worker died earlier and took the pool with it
+                self.pool.shutdown(wait=False)
+                self.pool = self._start_pool()
+                future = self.pool.submit(convert_task, (file_in, args))
+        future.add_done_callback(finished)
+
+    def status(self):
+        """Return the state of the daemon as a status response."""
+        with self._lock:
+            return {"event": "status", "pid": os.getpid(), "socket": self.socket_path,
+                    "max_jobs": self.max_jobs, "jobs_pending": self.jobs_pending,
+                    "jobs_done": self.jobs_done, "jobs_failed": self.jobs_failed,
+                    "uptime": time.time() - self.started, "stopping": self.stopping}
+
+    def stop(self):
+        """Stop accepting connections; serve() returns once the accepted
+        requests are done.  Safe to call from signal handlers and request threads."""
+        with self._lock:
+            if self.stopping:
+                return
+            self.stopping = True
+        # shutdown() waits for serve_forever() to return, so it can't run
+        # in the serving thread.
+        threading.Thread(target=self.shutdown).start()
+
+    def serve(self):
+        """Serve requests until stop() is called, then finish the accepted
+        requests, stop the workers and remove the socket."""
+        try:
+            self.serve_forever()
+        finally:
+            with self._lock:
+                while self._requests:
+                    self._lock.wait()
+            self.server_close()
+            self.pool.shutdown(wait=True)
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="bvh-converter-daemon",
+        description="Serve BVH conversions on a UNIX socket, keeping the converter loaded between jobs. "
+                    "Send jobs with bvh-converter-client.")
+    parser.add_argument("--socket", type=str, help='Socket to listen on (default: {}).'.format(default_socket()))
+    parser.add_argument("--max-jobs", type=int, default=1,
+                        help='Number of files converted at once, 0 for one per CPU (default: 1).')
+    args = parser.parse_args()
+    if args.max_jobs < 0:
+        parser.error("--max-jobs can't be negative")
+
+    try:
+        daemon = ConversionDaemon(args.socket, args.max_jobs or multiprocessing.cpu_count())
+    except socket.error as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: daemon.stop())
+    print("Listening on {} ({} job(s) at a time)".format(daemon.socket_path, daemon.max_jobs))
+    sys.stdout.flush()
+    daemon.serve()
+    print("Stopped")
+
+
+if __name__ == "__main__":
+    main()
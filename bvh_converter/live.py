@@ -0,0 +1,464 @@
+from __future__ import print_function, division
+import sys
+import argparse
+import array
+import collections
+import json
+import socket
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:  # Python 2
+    import SocketServer as socketserver
+
+import numpy as np
+
+from bvh_converter.__main__ import check_rotation_arguments
+from bvh_converter.bvh import open_bvh
+from bvh_converter.bvhplayer_skeleton import DTYPES, process_bvhstream
+from bvh_converter.rigs import RIG_CACHE
+from bvh_converter.rotations import REPRESENTATIONS
+from bvh_converter.stats import NO_STATS
+from bvh_converter.writers import WRITERS, CsvWriter
+
+"""
+Live conversion of BVH data streamed over TCP.
+
+Motion capture software can stream a clip as it is recorded: the
+HIERARCHY section, the MOTION header (whose Frames: count is ignored) and
+then one frame line per frame, for as long as the capture runs.
+
+    bvh-converter-live serve --port 7001 --out take
+    bvh-converter-live replay clip.bvh --port 7001
+
+serve listens on a local TCP port and runs the forward kinematics on the
+frames of every connection as they arrive, using the same code as the
+offline conversion.  Frames that arrive together are converted together,
+so a burst doesn't fall behind.  The world positions are handed to a
+sink: any writer of bvh_converter.writers (written to files and flushed
+after every batch), a CallbackSink, or a SocketSink that forwards them as
+CSV rows over TCP.  When a stream ends, a report gives its frame rate and
+the percentiles of the per-frame latency: the time from receiving a frame
+line to the sink having its positions.
+
+replay streams an existing BVH file to the server at its frame rate (or
+any other), to test a setup without capture hardware.
+"""
+
+# Default port of the server
+DEFAULT_PORT = 7001
+
+# Measures the latencies; perf_counter is Python 3.3+
+timer = getattr(time, "perf_counter", time.time)
+
+
+class LineReceiver(object):
+    """The complete lines received on a socket, each with the time its
+    data arrived.  Works like a bvh.GrowingFile for process_bvhstream:
+    the stream is finished when the peer closes the connection or the
+    threading.Event stop is set.  arrivals holds the arrival times of
+    the lines last returned by available()."""
+
+    def __init__(self, sock, stop=None, poll_interval=0.1):
+        self.sock = sock
+        self.stop = stop if stop is not None else threading.Event()
+        self.finished = False
+        self.line_num = 0
+        self.bytes_received = 0
+        self.arrivals = []
+        self._partial = b""
+        self._lines = collections.deque()
+        self._times = collections.deque()
+        sock.settimeout(poll_interval)  # To notice stop
+
+    def _fill(self):
+        try:
+            data = self.sock.recv(1 << 16)
+        except socket.timeout:
+            return
+        now = timer()
+        self.bytes_received += len(data)
+        if not data:
+            self.finished = True
+            lines = [self._partial] if self._partial.strip() else []
+            self._partial = b""
+        else:
+            lines = (self._partial + data).split(b"\n")
+            self._partial = lines.pop()
+        lines = [s for s in lines if s.strip()]  # So arrivals line up with the frames
+        self._lines.extend(lines)
+        self._times.extend([now] * len(lines))
+
+    def wait(self):
+        """Wait until a line is available.  Returns False if the stream
+        is finished instead."""
+        while not self._lines:
+            if self.finished:
+                return False
+            if self.stop.is_set():
+                self.finished = True
+            else:
+                self._fill()
+        return True
+
+    def available(self, limit):
+        """Return the lines received so far, at most limit of them."""
+        count = min(limit, len(self._lines))
+        lines = [self._lines.popleft().decode("utf-8") + "\n" for _ in range(count)]
+        self.arrivals = [self._times.popleft() for _ in range(count)]
+        self.line_num += count
+        return lines
+
+    def readline(self):
+        if not self.wait():
+            return ""
+        return self.available(1)[0]
+
+    def close(self):
+        pass  # The socket belongs to the caller
+
+
+class CallbackSink(object):
+    """Sink calling function(skeleton) with every batch of converted frames.
+    skeleton.worldpos holds their (frames, joints, 3) world positions and
+    skeleton.first_frame the number of the first one."""
+
+    def __init__(self, function):
+        self.function = function
+        self.outputs = []
+
+    def write(self, skeleton):
+        self.function(skeleton)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SocketSink(CsvWriter):
+    """Sink forwarding the world positions as CSV rows (a header, then a
+    Time column and one column per joint and axis) to a TCP address."""
+
+    def __init__(self, address, precision=None):
+        CsvWriter.__init__(self, "", precision=precision)
+        self.address = address
+        self.outputs = [("Socket", "{}:{}".format(*address))]
+
+    def _open(self, filename):
+        self._sock = socket.create_connection(self.address)
+        return self._sock.makefile("wb")
+
+    def close(self):
+        CsvWriter.close(self)
+        if self._files:
+            self._sock.close()
+
+
+class LatencyStats(object):
+    """Per-frame latencies of a stream."""
+
+    def __init__(self):
+        self.latencies = array.array('d')
+        self.started = None
+        self.finished = None
+
+    def add(self, arrivals, done):
+        if self.started is None and arrivals:
+            self.started = arrivals[0]
+        self.latencies.extend(done - t for t in arrivals)
+        self.finished = done
+
+    def as_dict(self):
+        """
+        :return: Dictionary of frames, seconds from the first frame to the
+            last, fps, and latency_ms: the p50, p90, p99 and max latency
+            in milliseconds (None without frames).
+        :rtype: dict
+        """
+        frames = len(self.latencies)
+        seconds = self.finished - self.started if frames else 0.
+        latency = None
+        if frames:
+            values = np.frombuffer(self.latencies, dtype=np.float64) * 1000
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            latency = {"p50": p50, "p90": p90, "p99": p99, "max": float(values.max())}
+        return {"frames": frames, "seconds": seconds,
+                "fps": frames / seconds if frames and seconds > 0 else None,
+                "latency_ms": latency}
+
+
+def ingest(source, sink, select=None, keep_orientations=False, rigs=RIG_CACHE, stats=NO_STATS,
+           dtype=np.float64):
+    """
+    Convert the frames of source as they arrive and write them to sink.
+    :param source: LineReceiver (or any source of process_bvhstream that
+        sets arrivals).
+    :param sink: Writer, CallbackSink or SocketSink; closed at the end.
+    :param select: Joint name patterns to keep, see Skeleton.
+    :param dtype: numpy.float64 or numpy.float32, see process_bvhfile.
+    :return: Report of the stream, see LatencyStats.as_dict.
+    :rtype: dict
+    """
+    latency = LatencyStats()
+    try:
+        # Everything that has arrived is converted in one go
+        for skeleton in process_bvhstream(source, chunk_frames=1 << 16, select=select,
+                                          keep_orientations=keep_orientations, stats=stats, rigs=rigs,
+                                          dtype=dtype):
+            with stats.stage("write", len(skeleton.keyframes)):
+                sink.write(skeleton)
+                sink.flush()
+            if len(skeleton.keyframes):
+                latency.add(source.arrivals, timer())
+    finally:
+        sink.close()
+    report = latency.as_dict()
+    report["bytes"] = getattr(source, "bytes_received", None)
+    return report
+
+
+class _StreamHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        number = server.next_stream()
+        peer = "{}:{}".format(*self.client_address[:2])
+        # Replaced unless something unexpected is raised, which
+        # handle_error() then prints; the stream is reported either way.
+        report = {"frames": 0, "error": "Internal error"}
+        try:
+            sink = server.sink_factory(number)
+            report = ingest(LineReceiver(self.request, server.stop_event), sink,
+                            select=server.select, keep_orientations=server.keep_orientations,
+                            dtype=server.dtype)
+            report["error"] = None
+        except (SyntaxError, ValueError, IOError, socket.error) as e:
+            # SyntaxError includes a client disconnecting inside the header
+            report = {"frames": 0, "error": "{}: {}".format(type(e).__name__, e)}
+        finally:
+            report.update(stream=number, peer=peer)
+            server.stream_done(report)
+
+
+class StreamServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """TCP server converting every connection as a live BVH stream."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, sink_factory, select=None, keep_orientations=False,
+                 on_report=None, max_streams=None, dtype=np.float64):
+        """
+        :param address: (host, port) to listen on; port 0 picks a free one
+            (see server_address).
+        :param sink_factory: Function returning the sink of stream n (1, 2, ...).
+        :param select: Joint name patterns to keep, see Skeleton.
+        :param on_report: Function called with the report of every stream
+            that ends; "stream", "peer" and "error" are added to the
+            LatencyStats.as_dict() values.
+        :param max_streams: Stop serving after this many streams (default: never).
+        :param dtype: numpy.float64 or numpy.float32, see process_bvhfile.
+        """
+        self.sink_factory = sink_factory
+        self.select = select
+        self.keep_orientations = keep_orientations
+        self.dtype = dtype
+        self.on_report = on_report
+        self.max_streams = max_streams
+        self.reports = []
+        self.stop_event = threading.Event()
+        self._streams = 0
+        self._lock = threading.Lock()
+        socketserver.TCPServer.__init__(self, address, _StreamHandler)
+
+    def next_stream(self):
+        with self._lock:
+            self._streams += 1
+            return self._streams
+
+    def stream_done(self, report):
+        with self._lock:
+            self.reports.append(report)
+            done = self.max_streams is not None and len(self.reports) >= self.max_streams
+        if self.on_report is not None:
+            self.on_report(report)
+        if done:
+            self.stop()
+
+    def stop(self):
+        """Stop serving and end the running streams.  Safe to call from
+        any thread but the one running serve_forever()."""
+        self.stop_event.set()
+        threading.Thread(target=self.shutdown).start()
+
+
+def replay(filename, address, fps=None, loops=1):
+    """
+    Stream a BVH file to a server as motion capture software would.
+    :param address: (host, port) of the server.
+    :param fps: Frames per second to send, 0 for as fast as possible
+        (default: the frame rate of the file).
+    :param loops: Number of times the frames are sent.
+    :return: Number of frames sent.
+    :rtype: int
+    """
+    with open_bvh(filename) as f:
+        header = []
+        for s in f:
+            header.append(s)
+            if s.split()[:2] == ["Frame", "Time:"]:
+                break
+        else:
+            raise ValueError("{} has no MOTION section".format(filename))
+        if fps is None:
+            fps = 1. / float(header[-1].split()[2])
+        frames = [s for s in f if s.strip()]
+    sock = socket.create_connection(address)
+    try:
+        sock.sendall("".join(header).encode("utf-8"))
+        if not fps:
+            block = 256
+            for _ in range(loops):
+                for i in range(0, len(frames), block):
+                    sock.sendall("".join(frames[i:i + block]).encode("utf-8"))
+            return loops * len(frames)
+        start = timer()
+        sent = 0
+        total = loops * len(frames)
+        while sent < total:
+            # Send every frame that is due; sleep until the next one is
+            due = min(int((timer() - start) * fps) + 1, total)
+            if due > sent:
+                sock.sendall("".join(frames[i % len(frames)] for i in range(sent, due)).encode("utf-8"))
+                sent = due
+            time.sleep(max(start + sent / fps - timer(), 0))
+        return sent
+    finally:
+        sock.close()
+
+
+def format_report(report):
+    if report.get("error"):
+        return "Stream {} from {}: {}".format(report["stream"], report["peer"], report["error"])
+    text = "Stream {} from {}: {} frames in {:.2f}s".format(report["stream"], report["peer"],
+                                                           report["frames"], report["seconds"])
+    if report["fps"]:
+        text += " ({:.0f} frames/s)".format(report["fps"])
+    if report["latency_ms"]:
+        text += ", latency p50 {p50:.2f} ms, p90 {p90:.2f} ms, p99 {p99:.2f} ms, max {max:.2f} ms".format(
+            **report["latency_ms"])
+    return text
+
+
+def parse_address(text, default_host="127.0.0.1"):
+    """Split "host:port" or "port" into (host, port)."""
+    host, _, port = text.rpartition(":")
+    return host or default_host, int(port)
+
+
+def serve(args):
+    if args.out and args.forward:
+        sys.exit("Error: --out and --forward can't be combined")
+    options = {"rotation_format": args.rotation_format, "rotation_space": args.rotation_space}
+    # Global rotation matrices come straight out of the forward kinematics.
+    keep_orientations = args.rotation_space != "local" and args.rotation_format in ("matrix", "6d")
+
+    def sink_factory(number):
+        if args.forward:
+            return SocketSink(parse_address(args.forward))
+        if args.out:
+            base = args.out if args.once else "{}_{}".format(args.out, number)
+            return WRITERS[args.format](base, rotations=args.rotation, **options)
+        return CallbackSink(lambda skeleton: None)
+
+    reports = []
+
+    def on_report(report):
+        reports.append(report)
+        print(format_report(report))
+        sys.stdout.flush()
+
+    select = None
+    if args.joints:
+        select = [name.strip() for names in args.joints for name in names.split(",") if name.strip()]
+    server = StreamServer((args.host, args.port), sink_factory, select=select,
+                          keep_orientations=keep_orientations, on_report=on_report,
+                          max_streams=1 if args.once else None, dtype=DTYPES[args.dtype])
+    print("Listening on {}:{}".format(*server.server_address[:2]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop_event.set()
+    finally:
+        server.server_close()
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"streams": reports}, f, indent=2)
+    if any(report.get("error") for report in reports):
+        sys.exit(1)
+
+
+def replay_command(args):
+    fps = args.fps
+    start = timer()
+    sent = replay(args.filename, (args.host, args.port), fps, args.loops)
+    seconds = timer() - start
+    print("Sent {} frames in {:.2f}s ({:.0f} frames/s)".format(sent, seconds, sent / seconds if seconds else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bvh-converter-live",
+                                     description="Convert BVH frames streamed over TCP as they arrive.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    serve_parser = subparsers.add_parser("serve", help='Receive and convert BVH streams.')
+    serve_parser.add_argument("--host", default="127.0.0.1", help='Address to listen on (default: 127.0.0.1).')
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                              help='Port to listen on (default: {}).'.format(DEFAULT_PORT))
+    serve_parser.add_argument("--out", type=str,
+                              help='Base name of the output files; streams get _1, _2, ... appended '
+                                   'unless --once (default: no files).')
+    serve_parser.add_argument("-f", "--format", choices=sorted(WRITERS), default="csv",
+                              help='Output file format (default: csv).')
+    serve_parser.add_argument("-r", "--rotation", action='store_true', help='Write rotations as well.')
+    serve_parser.add_argument("--rotation-format", choices=sorted(REPRESENTATIONS), default="euler",
+                              help='Rotation output format, as for bvh-converter (default: euler).  '
+                                   'Implies -r unless euler.')
+    serve_parser.add_argument("--rotation-space", choices=("local", "global", "both"), default="local",
+                              help='Rotations relative to the parent joint, to the world or both, as for '
+                                   'bvh-converter (default: local).  Implies -r unless local.')
+    serve_parser.add_argument("--forward", type=str, metavar='HOST:PORT',
+                              help='Forward the world positions as CSV rows to this TCP address.')
+    serve_parser.add_argument("--joints", action='append',
+                              help='Comma separated joint names or patterns to convert (default: all).')
+    serve_parser.add_argument("--dtype", choices=sorted(DTYPES), default="float64",
+                              help='Floating point type to compute and write in (default: float64).')
+    serve_parser.add_argument("--once", action='store_true', help='Exit after the first stream.')
+    serve_parser.add_argument("--report", type=str, help='Write the stream reports as JSON to this file.')
+    serve_parser.set_defaults(func=serve)
+
+    replay_parser = subparsers.add_parser("replay", help='Stream a BVH file to a server.')
+    replay_parser.add_argument("filename", help='BVH file to stream.')
+    replay_parser.add_argument("--host", default="127.0.0.1", help='Server address (default: 127.0.0.1).')
+    replay_parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                               help='Server port (default: {}).'.format(DEFAULT_PORT))
+    replay_parser.add_argument("--fps", type=float,
+                               help='Frames per second, 0 for as fast as possible (default: the '
+                                    'frame rate of the file).')
+    replay_parser.add_argument("--loops", type=int, default=1, help='Times to send the frames (default: 1).')
+    replay_parser.set_defaults(func=replay_command)
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        check_rotation_arguments(serve_parser, args)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
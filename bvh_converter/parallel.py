@@ -0,0 +1,126 @@
+from __future__ import print_function, division
+import multiprocessing
+
+import numpy as np
+
+from bvh_converter.bvhplayer_skeleton import Joint, Skeleton, bind_joint_storage, process_bvhkeyframes
+
+"""
+Forward kinematics of a single clip split across worker processes.
+
+Frames are independent once the keyframes are parsed, so the frame range
+is cut into one contiguous slice per worker.  The keyframes and the output
+arrays live in shared memory; workers attach to them by name and write
+their slice of the results in place, so nothing but the slice bounds is
+pickled per task.  Every frame goes through the same process_bvhkeyframes
+code as a serial run, so the results are identical.
+
+Requires multiprocessing.shared_memory (Python 3.8+).
+"""
+
+# Worker process state, set up by _init_worker.
+_worker = {}
+
+
+def copy_joint_tree(joint):
+    """Copy a joint hierarchy without its per-frame storage, for sending it
+    to worker processes."""
+    copy = Joint(joint.name)
+    copy.channels = joint.channels
+    copy.strans = joint.strans
+    copy.stransmat = joint.stransmat
+    for child in joint.children:
+        copy.addchild(copy_joint_tree(child))
+    return copy
+
+
+def _init_worker(specs, root, selected):
+    """Attach to the shared arrays described by specs {name: (shm name, shape, dtype)}.
+    selected holds the positions of the skeleton's joints in joint_dfs order."""
+    from multiprocessing import shared_memory
+    _worker["shms"] = []
+    _worker["arrays"] = {}
+    for key, (name, shape, dtype) in specs.items():
+        # Pool workers share the parent's resource tracker, so attaching
+        # doesn't leave anything behind once the parent unlinks the block.
+        shm = shared_memory.SharedMemory(name=name)
+        _worker["shms"].append(shm)
+        _worker["arrays"][key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _worker["root"] = root
+    joints = Skeleton.joint_dfs(root)
+    _worker["joints"] = [joints[i] for i in selected]
+
+
+def _process_range(bounds):
+    """Run the forward kinematics for frames start to stop - 1."""
+    start, stop = bounds
+    arrays = _worker["arrays"]
+    trtr = arrays.get("trtr")
+    orientations = arrays.get("orientations")
+    bind_joint_storage(_worker["joints"], arrays["worldpos"][start:stop],
+                       arrays["rotations"][start:stop],
+                       trtr[start:stop] if trtr is not None else None,
+                       orientations[start:stop] if orientations is not None else None)
+    process_bvhkeyframes(arrays["keyframes"][start:stop], _worker["root"])
+    return stop - start
+
+
+def process_bvhkeyframes_parallel(skeleton, jobs=None):
+    """
+    Compute rotations and world positions of every joint for all frames of
+    skeleton, like process_bvhkeyframes(skeleton.keyframes, skeleton.root),
+    using jobs worker processes.
+    :param skeleton: Skeleton whose arrays receive the results.
+    :type skeleton: Skeleton
+    :param jobs: Number of worker processes, defaults to one per CPU.
+    :type jobs: int
+    """
+    frames = len(skeleton.keyframes)
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, frames)
+    # Daemonic processes (e.g. batch workers) can't start a pool of their own.
+    if jobs <= 1 or multiprocessing.current_process().daemon:
+        process_bvhkeyframes(skeleton.keyframes, skeleton.root)
+        return
+    from multiprocessing import shared_memory
+
+    outputs = {"worldpos": skeleton.worldpos, "rotations": skeleton.rotations}
+    if skeleton.trtr is not None:
+        outputs["trtr"] = skeleton.trtr
+    if skeleton.orientations is not None:
+        outputs["orientations"] = skeleton.orientations
+    inputs = {"keyframes": np.asarray(skeleton.keyframes, dtype=skeleton.dtype)}
+
+    shms = []
+    shared = {}
+    specs = {}
+    try:
+        for key, values in list(inputs.items()) + list(outputs.items()):
+            shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            shms.append(shm)
+            shared[key] = np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)
+            shared[key][...] = values
+            specs[key] = (shm.name, values.shape, values.dtype.str)
+
+        # The copied joints have no storage; only the selected ones get it.
+        position = dict((joint, i) for i, joint in enumerate(Skeleton.joint_dfs(skeleton.root)))
+        selected = [position[joint] for joint in skeleton.joints]
+
+        bounds = np.linspace(0, frames, jobs + 1).astype(int)
+        ranges = [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+        pool = multiprocessing.Pool(jobs, initializer=_init_worker,
+                                    initargs=(specs, copy_joint_tree(skeleton.root), selected))
+        try:
+            pool.map(_process_range, ranges)
+        finally:
+            pool.close()
+            pool.join()
+
+        for key, values in outputs.items():
+            values[...] = shared[key]
+    finally:
+        shared.clear()
+        for shm in shms:
+            shm.close()
+            shm.unlink()
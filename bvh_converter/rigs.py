@@ -0,0 +1,205 @@
+from __future__ import print_function, division
+import collections
+import hashlib
+import io
+import threading
+
+import numpy as np
+
+from bvh_converter.bvh import BvhReader, open_bvh
+from bvh_converter.bvhplayer_skeleton import Joint, Skeleton, channel_offsets, process_bvhnode
+
+"""
+Cache of compiled skeleton hierarchies (rigs).
+
+Clips exported from the same skeleton repeat the same HIERARCHY section.
+A RigCache keys every hierarchy by a hash of its text and keeps a Rig for
+it: the joint order, parent indices, channel layout and static offset
+matrices.  Readers with a rig_cache hash the hierarchy lines of a file
+and only parse them if the rig isn't known yet, so repeated rigs cost a
+lookup and the motion data is all that is left to parse:
+
+    reader.rig_cache = RIG_CACHE
+    reader.read()
+    root, joints = reader.rig.build_joints()
+
+The key ignores whitespace, so the same hierarchy written with other
+indentation or line endings is the same rig.  Clips with the same rig key
+have the same joints, channels and offsets in the same order, so their
+outputs can be stacked directly (see same_rig).
+"""
+
+# Bump whenever the compiled form or the key changes, so keys never mix versions.
+RIG_VERSION = 2
+
+
+def rig_key(lines):
+    """Return the key of the hierarchy made up of the text lines."""
+    # One split of the whole text normalizes the whitespace, and the
+    # result is hashed at once.
+    text = " ".join(u"".join(lines).split())
+    return hashlib.sha1(("bvh-rig-%d\n%s" % (RIG_VERSION, text)).encode("utf-8")).hexdigest()
+
+
+class Rig(object):
+    """Compiled topology of a BVH hierarchy.  The joints are in
+    Skeleton.joint_dfs order, as in the output."""
+
+    def __init__(self, root, num_channels, key=None):
+        """
+        :param root: Root of the parsed hierarchy.
+        :type root: Node
+        :param num_channels: Total number of channels.
+        :param key: rig_key() of the hierarchy text.
+        """
+        self.key = key
+        self.root = root
+        self.num_channels = num_channels
+        hips = process_bvhnode(root)
+        joints = Skeleton.joint_dfs(hips)
+        position = dict((joint, j) for j, joint in enumerate(joints))
+        first_channel, _ = channel_offsets(hips)
+        self.names = [joint.name for joint in joints]
+        self.parents = np.array([position[joint.parent] if joint.hasparent else -1 for joint in joints], dtype=int)
+        self.children = [[position[child] for child in joint.children] for joint in joints]
+        self.channels = [tuple(joint.channels) for joint in joints]
+        self.first_channels = np.array([first_channel[joint] for joint in joints], dtype=int)
+        self.offsets = np.array([joint.strans for joint in joints]).reshape(-1, 3)
+        self.stransmats = np.array([joint.stransmat for joint in joints]).reshape(-1, 4, 4)
+
+    def __len__(self):
+        return len(self.names)
+
+    def build_joints(self):
+        """
+        Create the joint tree of the rig, as process_bvhnode would, but
+        without walking the hierarchy.  Every call returns new joints.
+        :return: Tuple of (root joint, joints in Skeleton.joint_dfs order).
+        :rtype: tuple
+        """
+        # The joints are filled in directly instead of through Joint(),
+        # whose offset arrays would be replaced right away; their offsets
+        # are rows of one copy of the rig's arrays.
+        joints = [Joint.__new__(Joint) for _ in self.names]
+        for joint, name, children, channels, parent, offset, stransmat in zip(
+                joints, self.names, self.children, self.channels, self.parents.tolist(),
+                list(self.offsets.copy()), list(self.stransmats.copy())):
+            joint.name = name
+            joint.children = [joints[child] for child in children]
+            joint.channels = list(channels)
+            joint.hasparent = 1 if parent >= 0 else 0
+            joint.parent = joints[parent] if parent >= 0 else 0
+            joint.strans = offset
+            joint.stransmat = stransmat
+            joint.index = joint.rot = joint.orient = joint.trtr = joint.worldpos = None
+        return joints[0], joints
+
+
+class _HierarchyReader(BvhReader):
+    """Reader parsing hierarchy text on its own."""
+
+    def read_text(self, lines):
+        self._file_handle = io.StringIO(u"".join(lines))
+        self._tokens = self.iter_tokens()
+        self.read_hierarchy()
+        tok = next(self._tokens, None)
+        if tok is not None:
+            raise SyntaxError("Syntax error in line %d: 'MOTION' expected, "
+                              "got '%s' instead" % (self._line_num, tok))
+
+
+class RigCache(object):
+    """In-memory cache of Rigs by key, safe to share between threads."""
+
+    def __init__(self, max_rigs=256):
+        """
+        :param max_rigs: Number of rigs kept; the least recently used go first.
+        """
+        self.max_rigs = max_rigs
+        self.hits = 0
+        self.misses = 0
+        self._rigs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rigs)
+
+    def get(self, key):
+        """Return the rig for key, or None."""
+        with self._lock:
+            rig = self._rigs.pop(key, None)
+            if rig is not None:
+                self._rigs[key] = rig  # Most recently used
+        return rig
+
+    def add(self, rig):
+        """Add rig, evicting the least recently used rigs beyond max_rigs."""
+        with self._lock:
+            self._rigs.pop(rig.key, None)
+            self._rigs[rig.key] = rig
+            while len(self._rigs) > self.max_rigs:
+                self._rigs.popitem(last=False)
+
+    def compile(self, lines):
+        """
+        Return the rig of the hierarchy made up of the text lines, parsing
+        them only if the rig isn't cached yet.
+        :rtype: Rig
+        """
+        key = rig_key(lines)
+        rig = self.get(key)
+        with self._lock:
+            if rig is not None:
+                self.hits += 1
+                return rig
+            self.misses += 1
+        parser = _HierarchyReader(None)
+        parser.read_text(lines)
+        rig = Rig(parser.root, parser.num_channels, key)
+        self.add(rig)
+        return rig
+
+    def read_hierarchy(self, reader):
+        """
+        Read the hierarchy of reader's open file, like reader.read_hierarchy(),
+        taking it from the cache if possible.
+        :type reader: BvhReader
+        :return: The rig of the file.
+        :rtype: Rig
+        """
+        rig = self.compile(reader.read_hierarchy_lines())
+        reader.root = rig.root
+        reader.num_channels = rig.num_channels
+        return rig
+
+
+# Cache shared by the command line tools and the in-memory API
+RIG_CACHE = RigCache()
+
+
+def file_rig_key(filename):
+    """Return the rig key of a BVH file, reading only its hierarchy."""
+    reader = BvhReader(filename)
+    with open_bvh(filename) as f:
+        reader._file_handle = f
+        return rig_key(reader.read_hierarchy_lines())
+
+
+def same_rig(*clips):
+    """
+    Tell whether clips share a rig, so their outputs line up joint by joint.
+    :param clips: Skeletons, load_bvh() results or file names.
+    :rtype: bool
+    """
+    keys = set()
+    for clip in clips:
+        if isinstance(clip, Skeleton):
+            key = clip.rig.key if clip.rig is not None else None
+        elif isinstance(clip, dict):
+            key = clip.get("rig")
+        else:
+            key = file_rig_key(clip)
+        if key is None:
+            raise ValueError("The rig of {!r} isn't known".format(clip))
+        keys.add(key)
+    return len(keys) <= 1
@@ -0,0 +1,224 @@
+from __future__ import print_function, division
+
+import numpy as np
+
+from bvh_converter.bvhplayer_skeleton import channel_offsets
+
+"""
+Joint rotations as quaternions, rotation matrices or the 6D representation.
+
+The rotations are composed from the channel values in each joint's
+CHANNELS order, exactly like the forward kinematics do, for all frames at
+once.  Local rotations are relative to the parent joint, global ones are
+relative to the world.  Joints without rotation channels (end sites)
+have the identity as local rotation.
+
+Global matrices and 6D are taken from Skeleton.orientations if the
+skeleton keeps them (keep_orientations), since the forward kinematics
+have already computed them; they must have been run on the skeleton then.
+
+ - quat: unit quaternions (w, x, y, z) with w >= 0, shape (frames, joints, 4)
+ - matrix: 3x3 rotation matrices, shape (frames, joints, 3, 3)
+ - 6d: the first two columns of the rotation matrix, shape (frames, joints, 6)
+ - euler: the channel values in (x, y, z) order as in Skeleton.rotations,
+   local only
+"""
+
+# Names of the values of each representation, in the order they are stored
+# (matrices are flattened row by row).
+REPRESENTATIONS = {
+    "euler": ("X", "Y", "Z"),
+    "quat": ("W", "X", "Y", "Z"),
+    "matrix": ("M00", "M01", "M02", "M10", "M11", "M12", "M20", "M21", "M22"),
+    "6d": ("M00", "M10", "M20", "M01", "M11", "M21"),
+}
+SPACES = ("local", "global")
+
+
+# Number of frames converted in one go, to keep the temporaries small
+block_frames = 2048
+
+
+def _multiply_components(a, b):
+    """Hamilton product of quaternions given as (w, x, y, z) component arrays."""
+    aw, ax, ay, az = a
+    bw, bx, by, bz = b
+    return (aw * bw - ax * bx - ay * by - az * bz,
+            aw * bx + ax * bw + ay * bz - az * by,
+            aw * by - ax * bz + ay * bw + az * bx,
+            aw * bz + ax * by - ay * bx + az * bw)
+
+
+def _rotate_components(q, axis, c, s):
+    """Multiply quaternion components q by the rotations (c, s), the cosine
+    and sine of half the angles, about axis 0, 1 or 2 (x, y or z)."""
+    w, x, y, z = q
+    if axis == 0:
+        return w * c - x * s, x * c + w * s, y * c + z * s, z * c - y * s
+    if axis == 1:
+        return w * c - y * s, x * c - z * s, y * c + w * s, z * c + x * s
+    return w * c - z * s, x * c + y * s, y * c - x * s, z * c + w * s
+
+
+def _half_angle_cos_sin(degrees):
+    """
+    Return the cosine and sine of half of the angles in degrees.
+    With t = tan(angle / 4), these are 2 / (1 + t^2) - 1 and
+    2 t / (1 + t^2), which is exact to rounding and much faster than
+    calling cos and sin.
+    :rtype: tuple
+    """
+    t = np.tan(np.multiply(degrees, np.pi / 720))
+    u = np.divide(2., t * t + 1.)
+    t *= u
+    u -= 1.
+    return u, t
+
+
+def quat_multiply(a, b):
+    """Hamilton product of two arrays of (w, x, y, z) quaternions."""
+    return np.stack(_multiply_components(np.moveaxis(a, -1, 0), np.moveaxis(b, -1, 0)), axis=-1)
+
+
+def quat_to_matrix(q):
+    """Convert an array of unit quaternions to an array of 3x3 rotation matrices."""
+    w, x, y, z = np.moveaxis(q, -1, 0).copy()
+    m = np.empty((3, 3) + q.shape[:-1], dtype=q.dtype)
+    m[0, 0] = 1 - 2 * (y * y + z * z)
+    m[0, 1] = 2 * (x * y - w * z)
+    m[0, 2] = 2 * (x * z + w * y)
+    m[1, 0] = 2 * (x * y + w * z)
+    m[1, 1] = 1 - 2 * (x * x + z * z)
+    m[1, 2] = 2 * (y * z - w * x)
+    m[2, 0] = 2 * (x * z - w * y)
+    m[2, 1] = 2 * (y * z + w * x)
+    m[2, 2] = 1 - 2 * (x * x + y * y)
+    return np.ascontiguousarray(np.moveaxis(m, (0, 1), (-2, -1)))
+
+
+def _rotation_channels(joint, first_channel):
+    """
+    Return the rotation channels of joint as (keyframe column, axis) pairs,
+    in channel order, with axis 0, 1 or 2 for x, y or z.
+    :rtype: list
+    """
+    return [(i, "XYZ".index(channel[0]))
+            for i, channel in enumerate(joint.channels, first_channel)
+            if channel.endswith("rotation")]
+
+
+def _rotation_orders(joints, first_channel):
+    """
+    Group joints by the axes of their rotation channels, e.g. (2, 0, 1) for
+    ZXY, so the rotations of each group can be composed together.  Joints
+    without rotation channels aren't in any group.
+    :return: List of (axes, joint positions, keyframe columns of the
+        joints' rotation channels, one array per axis).
+    :rtype: list
+    """
+    groups = {}
+    for j, joint in enumerate(joints):
+        channels = _rotation_channels(joint, first_channel[joint])
+        if channels:
+            axes = tuple(axis for _, axis in channels)
+            groups.setdefault(axes, []).append((j, [i for i, _ in channels]))
+    return [(axes, np.array([j for j, _ in members]), np.array([columns for _, columns in members]).T)
+            for axes, members in sorted(groups.items())]
+
+
+def joint_quaternions(skeleton, space="local"):
+    """
+    Return the rotations of skeleton.joints as quaternions.
+    :param skeleton: Skeleton holding the keyframes.
+    :type skeleton: Skeleton
+    :param space: "local" or "global".
+    :type space: str
+    :return: (frames, joints, 4) array of (w, x, y, z) quaternions with w >= 0.
+    :rtype: numpy.ndarray
+    """
+    if space not in SPACES:
+        raise ValueError("Unknown rotation space '{}'".format(space))
+    motion = np.asarray(skeleton.keyframes, dtype=skeleton.dtype)
+    first_channel, order = channel_offsets(skeleton.root)
+    if space == "local":
+        joints = skeleton.joints
+    else:
+        # Global rotations need every ancestor of the selected joints,
+        # in keyframe order so parents come before their children.
+        needed = set()
+        for joint in skeleton.joints:
+            while joint not in needed:
+                needed.add(joint)
+                if not joint.hasparent:
+                    break
+                joint = joint.parent
+        joints = [joint for joint in order if joint in needed]
+    position = dict((joint, j) for j, joint in enumerate(joints))
+    orders = _rotation_orders(joints, first_channel)
+    rotations = [_rotation_channels(joint, first_channel[joint]) for joint in joints]
+    selected = [position[joint] for joint in skeleton.joints]
+
+    # Quaternions are kept as (joints, 4, frames) blocks, so every
+    # component of every joint is contiguous.
+    result = np.empty((len(motion), len(skeleton.joints), 4), dtype=motion.dtype)
+    for start in range(0, len(motion), block_frames):
+        stop = min(start + block_frames, len(motion))
+        angles = np.ascontiguousarray(motion[start:stop].T)
+        q = np.zeros((len(joints), 4, stop - start), dtype=motion.dtype)
+        q[:, 0] = 1.
+        if space == "local":
+            # Joints with the same rotation axes are composed together.
+            for axes, rows, columns in orders:
+                cos, sin = _half_angle_cos_sin(angles[columns[0]])
+                zero = np.zeros_like(cos)
+                local = [cos, zero, zero, zero]
+                local[axes[0] + 1] = sin
+                for axis, channel_columns in zip(axes[1:], columns[1:]):
+                    cos, sin = _half_angle_cos_sin(angles[channel_columns])
+                    local = _rotate_components(local, axis, cos, sin)
+                q[rows] = np.stack(local, axis=1)
+        else:
+            # The parent's rotation followed by the joint's own; parents
+            # come before their children in joints.
+            for j, joint in enumerate(joints):
+                if joint.hasparent:
+                    q[j] = q[position[joint.parent]]
+                for column, axis in rotations[j]:
+                    cos, sin = _half_angle_cos_sin(angles[column])
+                    np.stack(_rotate_components(q[j], axis, cos, sin), out=q[j])
+        if selected != list(range(len(joints))):
+            q = q[selected]
+        # q and -q are the same rotation; pick the one with w >= 0
+        q *= np.copysign(1., q[:, :1])
+        result[start:stop] = q.transpose(2, 0, 1)
+    return result
+
+
+def joint_rotations(skeleton, representation="quat", space="local"):
+    """
+    Return the rotations of skeleton.joints for all of its keyframes.
+    :param skeleton: Skeleton holding the keyframes.
+    :type skeleton: Skeleton
+    :param representation: One of REPRESENTATIONS.
+    :type representation: str
+    :param space: "local" or "global".
+    :type space: str
+    :return: (frames, joints, ...) array, see the module documentation.
+    :rtype: numpy.ndarray
+    """
+    if representation not in REPRESENTATIONS:
+        raise ValueError("Unknown rotation representation '{}'".format(representation))
+    if representation == "euler":
+        if space != "local":
+            raise ValueError("Euler angles are only available as local rotations")
+        return skeleton.rotations
+    if representation != "quat" and space == "global" and skeleton.orientations is not None:
+        m = skeleton.orientations
+    else:
+        q = joint_quaternions(skeleton, space)
+        if representation == "quat":
+            return q
+        m = quat_to_matrix(q)
+    if representation == "matrix":
+        return m
+    return np.concatenate((m[..., :, 0], m[..., :, 1]), axis=-1)
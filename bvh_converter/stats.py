@@ -0,0 +1,192 @@
+from __future__ import print_function, division
+import sys
+import json
+import time
+
+try:
+    import tracemalloc  # Python 3.4+
+except ImportError:
+    tracemalloc = None
+try:
+    import resource  # Unix only
+except ImportError:
+    resource = None
+
+"""
+Per-stage timing and memory statistics of a conversion.
+
+Functions that support profiling take a stats argument and wrap each of
+their stages in stats.stage(name).  By default that is NO_STATS, whose
+stages do nothing, so profiling costs nothing unless it's asked for.
+Pass a ConversionStats to record the stages:
+
+    stats = ConversionStats()
+    skeleton = process_bvhfile(filename, stats=stats)
+    print(stats.to_json())
+
+Every stage records its wall time, the number of frames it handled, the
+frame rate and the peak resident set size of the process when it ended
+(max_rss), which shows the stage that drove memory use up.  With
+track_memory, the peak memory allocated during each stage is traced as
+well (peak_memory, Python 3.9+), at the price of slowing pure Python code
+down considerably.  A stage entered several times, e.g. once per chunk in
+stream mode, adds up.
+"""
+
+
+def max_rss():
+    """Return the peak resident set size of the process in bytes, or None."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":  # Kilobytes except on macOS
+        rss *= 1024
+    return rss
+
+
+class _NullStage(object):
+    """Context manager that does nothing.  It is shared, so setting
+    frames or any other attribute is ignored."""
+
+    frames = 0
+
+    def __setattr__(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class NullStats(object):
+    """Statistics that aren't recorded, used when profiling is off."""
+
+    enabled = False
+
+    def stage(self, name, frames=0):
+        return _NULL_STAGE
+
+    def add_bytes_read(self, count):
+        pass
+
+    def add_bytes_written(self, count):
+        pass
+
+
+NO_STATS = NullStats()
+
+
+class _Stage(object):
+    """A running stage of a ConversionStats.  Set frames if it isn't
+    known when the stage starts."""
+
+    def __init__(self, stats, name, frames):
+        self.stats = stats
+        self.name = name
+        self.frames = frames
+
+    def __enter__(self):
+        self.memory = self.stats._memory_start()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.time() - self.start
+        self.stats._record(self.name, seconds, self.frames, self.stats._memory_peak(self.memory))
+        return False
+
+
+class ConversionStats(object):
+    """Statistics of the stages of a conversion."""
+
+    enabled = True
+
+    def __init__(self, track_memory=False, hooks=()):
+        """
+        :param track_memory: Trace memory allocations with tracemalloc to find
+            the peak memory use of every stage.  This slows Python code down.
+        :param hooks: Functions called as hook(name, record) whenever a
+            stage ends, with the stage's record so far (see as_dict).
+        """
+        self.stages = {}
+        self.order = []
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.hooks = list(hooks)
+        self._started_tracing = False
+        if track_memory and tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.track_memory = track_memory and tracemalloc is not None
+
+    def stage(self, name, frames=0):
+        """
+        Time a stage.
+        :param name: Stage name, e.g. "read".
+        :param frames: Number of frames the stage handles.
+        :return: Context manager covering the stage.
+        """
+        return _Stage(self, name, frames)
+
+    def add_bytes_read(self, count):
+        self.bytes_read += count
+
+    def add_bytes_written(self, count):
+        self.bytes_written += count
+
+    def _memory_start(self):
+        if not self.track_memory:
+            return None
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+            return tracemalloc.get_traced_memory()[0]
+        return None
+
+    def _memory_peak(self, start):
+        if start is None:
+            return None
+        return tracemalloc.get_traced_memory()[1] - start
+
+    def _record(self, name, seconds, frames, peak_memory):
+        record = self.stages.get(name)
+        if record is None:
+            record = self.stages[name] = {"seconds": 0., "frames": 0, "calls": 0, "peak_memory": None,
+                                          "max_rss": None}
+            self.order.append(name)
+        record["seconds"] += seconds
+        record["frames"] += frames
+        record["calls"] += 1
+        record["max_rss"] = max_rss()
+        if peak_memory is not None:
+            record["peak_memory"] = max(record["peak_memory"] or 0, peak_memory)
+        record["fps"] = record["frames"] / record["seconds"] if record["frames"] and record["seconds"] else None
+        for hook in self.hooks:
+            hook(name, record)
+
+    def as_dict(self):
+        """
+        :return: Dictionary of the list of stages, each a dictionary of name,
+            seconds, frames, fps, calls, max_rss and peak_memory, in the order
+            they first ran; the total time, bytes read and written, and the
+            peak resident set size of the process.
+        :rtype: dict
+        """
+        return {"stages": [dict(self.stages[name], name=name) for name in self.order],
+                "total_seconds": sum(record["seconds"] for record in self.stages.values()),
+                "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written,
+                "max_rss": max_rss()}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def close(self):
+        """Stop tracing memory allocations if this object started it."""
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
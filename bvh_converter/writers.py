@@ -0,0 +1,322 @@
+from __future__ import print_function, division
+import sys
+import csv
+import io
+import struct
+
+import numpy as np
+
+from bvh_converter.rotations import REPRESENTATIONS, joint_rotations
+
+"""
+Output writers for converted skeletons.
+
+All writers share one interface: write(skeleton) is called with either the
+whole clip or, in stream mode, with consecutive windows of it (see
+Skeleton.first_frame), and close() finishes the output files.  outputs
+lists (description, filename) pairs of the files written.
+
+Every writer writes a list of tables (see output_tables): world positions
+and optionally rotations, each a (frames, joints, ...) array.  The binary
+formats store them as such, together with the joint names, the parent
+index of every joint (-1 for the root) and the time of every frame.  CSV
+files get one column per joint and value, e.g. Hips.X or Hips.W.
+
+Skeletons with frames=None come from a clip that is still growing (follow
+mode): the binary outputs then grow with every write, and flush() makes
+everything written so far readable.
+"""
+
+
+def open_csv(filename, mode='r'):
+    """Open a csv file in proper mode depending on Python version."""
+    if sys.version_info < (3,):
+        return io.open(filename, mode=mode+'b')
+    else:
+        return io.open(filename, mode=mode, newline='')
+
+
+def open_output(filename, compression=None):
+    """Open filename for writing bytes, compressed with one of COMPRESSIONS."""
+    if compression is None:
+        return io.open(filename, mode='wb')
+    if compression == "gz":
+        import gzip
+        return gzip.open(filename, 'wb')
+    if compression == "bz2":
+        import bz2
+        return bz2.BZ2File(filename, 'wb')
+    if compression == "xz":
+        import lzma  # Python 3 only
+        return lzma.open(filename, 'wb')
+    raise ValueError("Unknown compression '{}'".format(compression))
+
+
+def joint_parents(skeleton):
+    """Return the index of each joint's parent in skeleton.joints, -1 for the root.
+    If the parent isn't among the selected joints, its nearest selected
+    ancestor is used instead."""
+    parents = []
+    for joint in skeleton.joints:
+        parent = joint.parent if joint.hasparent else None
+        while parent is not None and parent.index is None:
+            parent = parent.parent if parent.hasparent else None
+        parents.append(parent.index if parent is not None else -1)
+    return np.array(parents, dtype=int)
+
+
+def joint_names(skeleton):
+    """Return the joint names as a unicode array, which loads without pickle."""
+    return np.array([j.name for j in skeleton.joints], dtype=np.str_)
+
+
+def output_tables(rotations=False, rotation_format="euler", rotation_space="local"):
+    """
+    List the tables to write.
+    :param rotations: Write rotations as well as world positions.
+    :param rotation_format: One of rotations.REPRESENTATIONS.
+    :param rotation_space: "local", "global" or "both".
+    :return: List of (name, description, value names, function returning the
+        (frames, joints, ...) array of a skeleton).
+    :rtype: list
+    """
+    tables = [("worldpos", "World Positions", ("X", "Y", "Z"), lambda skeleton: skeleton.worldpos)]
+    if not rotations:
+        return tables
+    if rotation_format not in REPRESENTATIONS:
+        raise ValueError("Unknown rotation format '{}'".format(rotation_format))
+    names = REPRESENTATIONS[rotation_format]
+    if rotation_space in ("local", "both"):
+        tables.append(("rotations", "Rotations", names,
+                       lambda skeleton: joint_rotations(skeleton, rotation_format, "local")))
+    if rotation_space in ("global", "both"):
+        tables.append(("global_rotations", "Global Rotations", names,
+                       lambda skeleton: joint_rotations(skeleton, rotation_format, "global")))
+    if len(tables) == 1:
+        raise ValueError("Unknown rotation space '{}'".format(rotation_space))
+    return tables
+
+
+class _GrowingArray(object):
+    """In-memory array that grows as frames are appended by assigning to
+    the slice after its last frame."""
+
+    def __init__(self, shape, dtype=np.float64):
+        self.rows = 0
+        self._data = np.zeros((16,) + tuple(shape), dtype=dtype)
+
+    def __setitem__(self, key, values):
+        if key.start != self.rows:
+            raise ValueError("Frames can only be appended")
+        stop = self.rows + len(values)
+        if stop > len(self._data):
+            data = np.zeros((max(stop, 2 * len(self._data)),) + self._data.shape[1:], dtype=self._data.dtype)
+            data[:self.rows] = self._data[:self.rows]
+            self._data = data
+        self._data[self.rows:stop] = values
+        self.rows = stop
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self._data[:self.rows], dtype=dtype)
+
+    def flush(self):
+        pass
+
+
+class _GrowingNpy(_GrowingArray):
+    """.npy file that grows as frames are appended.  The header leaves
+    room for any frame count and is rewritten by flush()."""
+
+    header_size = 128
+
+    def __init__(self, filename, shape, dtype=np.float64):
+        self.rows = 0
+        self.shape = tuple(shape)
+        self.descr = np.dtype(dtype).newbyteorder('<').str
+        self._f = open(filename, 'w+b')
+        self.flush()
+
+    def __setitem__(self, key, values):
+        if key.start != self.rows:
+            raise ValueError("Frames can only be appended")
+        self._f.write(np.ascontiguousarray(values, dtype=self.descr).tobytes())
+        self.rows += len(values)
+
+    def flush(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (self.descr, (self.rows,) + self.shape)
+        header = header.ljust(self.header_size - 11) + "\n"
+        self._f.seek(0)
+        self._f.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+        self._f.seek(0, 2)
+        self._f.flush()
+
+    def close(self):
+        self.flush()
+        self._f.close()
+
+
+class CsvWriter(object):
+    """
+    Write <base>_worldpos.csv and optionally <base>_rotations.csv and
+    <base>_global_rotations.csv.
+
+    Rows are formatted block_frames frames at a time with a single string
+    formatting operation.  By default every value is written exactly as
+    csv.writer writes a float (str()), so the output is the same as
+    writing get_frames_worldpos() row by row; float32 values get 9
+    significant digits, which read back as the same float32.  precision
+    gives a fixed number of decimal places instead.  compression is one of
+    COMPRESSIONS; the extension is appended to the file names.
+    """
+
+    block_frames = 1024
+
+    def __init__(self, base, rotations=False, precision=None, compression=None,
+                 rotation_format="euler", rotation_space="local"):
+        suffix = ".csv"
+        if compression is not None:
+            suffix += "." + compression
+        self.tables = output_tables(rotations, rotation_format, rotation_space)
+        self.outputs = [(description, base + "_" + name + suffix)
+                        for name, description, _, _ in self.tables]
+        self.compression = compression
+        self.precision = precision
+        self._files = []
+
+    def write(self, skeleton):
+        if not self._files:
+            for (_, filename), (_, _, names, _) in zip(self.outputs, self.tables):
+                f = self._open(filename)
+                self._files.append(f)
+                header = ["Time"] + ["{}.{}".format(j.name, name) for j in skeleton.joints
+                                     for name in names]
+                line = io.StringIO() if sys.version_info >= (3,) else io.BytesIO()
+                csv.writer(line).writerow(header)
+                header = line.getvalue()
+                if not isinstance(header, bytes):
+                    header = header.encode("utf-8")
+                f.write(header)
+
+        for f, (_, _, names, get_values) in zip(self._files, self.tables):
+            values = get_values(skeleton)
+            num_columns = len(skeleton.joints) * len(names)
+            if self.precision is not None:
+                value_format = "%.{}f".format(self.precision)
+            elif values.dtype == np.float32:
+                value_format = "%.9g"
+            else:
+                value_format = "%s"
+            row_format = ",".join([value_format] * (1 + num_columns)) + "\r\n"
+            for start in range(0, len(values), self.block_frames):
+                block = values[start:start + self.block_frames]
+                frame_nums = np.arange(start, start + len(block)) + skeleton.first_frame
+                table = np.column_stack((skeleton.frame_time(frame_nums),
+                                         block.reshape(len(block), num_columns)))
+                text = (row_format * len(table)) % tuple(table.ravel().tolist())
+                f.write(text.encode("ascii"))
+
+    def _open(self, filename):
+        """Open the binary file a table is written to."""
+        return open_output(filename, self.compression)
+
+    def flush(self):
+        for f in self._files:
+            f.flush()
+
+    def close(self):
+        for f in self._files:
+            f.close()
+
+
+class NpyWriter(object):
+    """
+    Write <base>_worldpos.npy, optionally <base>_rotations.npy and
+    <base>_global_rotations.npy, and <base>_skeleton.npz holding joints,
+    parents and time.  The .npy files are written through memory maps and
+    can be read back with numpy.load(filename, mmap_mode='r').  If the clip
+    is still growing, they are appended to instead, and each flush()
+    updates their headers to the frames written so far.
+    """
+
+    def __init__(self, base, rotations=False, rotation_format="euler", rotation_space="local"):
+        self.tables = output_tables(rotations, rotation_format, rotation_space)
+        self.outputs = [(description, base + "_" + name + ".npy")
+                        for name, description, _, _ in self.tables]
+        self.outputs.append(("Skeleton", base + "_skeleton.npz"))
+        self._arrays = None
+
+    def _allocate(self, skeleton, values):
+        if skeleton.frames is None:
+            return [_GrowingNpy(filename, v.shape[1:], v.dtype) for (_, filename), v in zip(self.outputs, values)]
+        return [np.lib.format.open_memmap(filename, mode='w+', dtype=v.dtype,
+                                          shape=(skeleton.frames,) + v.shape[1:])
+                for (_, filename), v in zip(self.outputs, values)]
+
+    def write(self, skeleton):
+        values = [get_values(skeleton) for _, _, _, get_values in self.tables]
+        if self._arrays is None:
+            self._arrays = self._allocate(skeleton, values)
+            self._skeleton = skeleton
+            self._frames = 0
+        start = skeleton.first_frame
+        stop = start + len(skeleton.keyframes)
+        self._frames = max(self._frames, stop)
+        for array, v in zip(self._arrays, values):
+            array[start:stop] = v
+
+    def _times(self):
+        skeleton = self._skeleton
+        frames = skeleton.frames if skeleton.frames is not None else self._frames
+        return skeleton.frame_time(np.arange(frames))
+
+    def flush(self):
+        for array in self._arrays or ():
+            array.flush()
+
+    def close(self):
+        if self._arrays is None:
+            return
+        skeleton = self._skeleton
+        for array in self._arrays:
+            array.flush()
+            if isinstance(array, _GrowingNpy):
+                array.close()
+        self._arrays = None
+        np.savez(self.outputs[-1][1], joints=joint_names(skeleton),
+                 parents=joint_parents(skeleton), time=self._times())
+
+
+class NpzWriter(NpyWriter):
+    """
+    Write everything to a single <base>.npz with the arrays worldpos,
+    optionally rotations and global_rotations, joints, parents and time.
+    The arrays are collected in memory, so this isn't constant-memory in
+    stream mode, and a growing clip is only written out by close().
+    """
+
+    def __init__(self, base, rotations=False, rotation_format="euler", rotation_space="local"):
+        self.tables = output_tables(rotations, rotation_format, rotation_space)
+        self.outputs = [("NPZ", base + ".npz")]
+        self._arrays = None
+
+    def _allocate(self, skeleton, values):
+        if skeleton.frames is None:
+            return [_GrowingArray(v.shape[1:], v.dtype) for v in values]
+        return [np.zeros((skeleton.frames,) + v.shape[1:], dtype=v.dtype) for v in values]
+
+    def flush(self):
+        # A .npz file can't be appended to; it's written by close().
+        pass
+
+    def close(self):
+        if self._arrays is None:
+            return
+        skeleton = self._skeleton
+        arrays = dict(zip([name for name, _, _, _ in self.tables], [np.asarray(a) for a in self._arrays]))
+        self._arrays = None
+        np.savez(self.outputs[0][1], joints=joint_names(skeleton),
+                 parents=joint_parents(skeleton), time=self._times(), **arrays)
+
+
+WRITERS = {"csv": CsvWriter, "npy": NpyWriter, "npz": NpzWriter}
+COMPRESSIONS = ("gz", "bz2", "xz")
@@ -23,12 +23,17 @@ setup(
         "License :: OSI Approved :: Mozilla Public License 2.0 (MPL 2.0)",
         "Operating System :: OS Independent",
         "Programming Language :: Python",
+        "Programming Language :: Python :: 3",
         "Topic :: Utilities"
     ],
+    python_requires='>=3.7',
     install_requires=get_requirements(),
     entry_points={
         'console_scripts': [
             'bvh-converter=bvh_converter.__main__:main',
+            'bvh-converter-daemon=bvh_converter.daemon:main',
+            'bvh-converter-client=bvh_converter.client:main',
+            'bvh-converter-live=bvh_converter.live:main',
         ]
     }
 )
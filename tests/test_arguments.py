@@ -0,0 +1,31 @@
+from __future__ import print_function, division
+
+import pytest
+
+from bvh_converter.__main__ import build_parser, check_arguments
+
+"""
+Command line options that can't be combined.
+"""
+
+
+def check(*argv):
+    parser = build_parser()
+    args = parser.parse_args(["clip.bvh"] + list(argv))
+    check_arguments(parser, args)
+    return args
+
+
+@pytest.mark.parametrize("argv", [
+    ["--stream", "--cache-dir", "cache"],
+    ["--follow", "--cache-dir", "cache"],
+    ["--follow", "--stream"],
+    ["--stream", "--fk-jobs", "2"],
+])
+def test_conflicting_options(argv):
+    with pytest.raises(SystemExit):
+        check(*argv)
+
+
+def test_cache_dir_alone():
+    assert check("--cache-dir", "cache").cache_dir == "cache"
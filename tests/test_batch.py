@@ -0,0 +1,46 @@
+from __future__ import print_function, division
+
+import gzip
+import os
+import shutil
+import sys
+
+import pytest
+
+from benchmarks.synthetic import generate_bvh
+from bvh_converter.__main__ import colliding_outputs, main
+
+"""
+Converting several files at once.
+"""
+
+
+@pytest.fixture
+def clips(tmpdir):
+    for name in ("a", "b"):
+        tmpdir.mkdir(name)
+        generate_bvh(str(tmpdir.join(name, "walk.bvh")), joints=5, depth=3, frames=10)
+    return tmpdir
+
+
+def test_same_names_in_different_directories(monkeypatch, clips):
+    files = [str(clips.join("a", "walk.bvh")), str(clips.join("b", "walk.bvh"))]
+    assert colliding_outputs(files) == []
+    monkeypatch.setattr(sys, "argv", ["bvh-converter"] + files)
+    main()
+    assert clips.join("a", "walk_worldpos.csv").check()
+    assert clips.join("b", "walk_worldpos.csv").check()
+
+
+def test_colliding_outputs(monkeypatch, clips):
+    walk = str(clips.join("a", "walk.bvh"))
+    with open(walk, "rb") as f, gzip.open(walk + ".gz", "wb") as g:
+        shutil.copyfileobj(f, g)
+    other_path = os.path.join(str(clips), "b", "..", "a", "walk.bvh")
+    assert colliding_outputs([walk, walk + ".gz", other_path]) == [[walk, walk + ".gz", other_path]]
+
+    monkeypatch.setattr(sys, "argv", ["bvh-converter", str(clips.join("a"))])
+    with pytest.raises(SystemExit) as exit_info:
+        main()
+    assert exit_info.value.code == 1
+    assert not clips.join("a", "walk_worldpos.csv").check()
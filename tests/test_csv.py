@@ -0,0 +1,73 @@
+from __future__ import print_function, division
+
+import csv
+import gzip
+import io
+import sys
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import generate_bvh
+from bvh_converter.__main__ import main
+from bvh_converter.bvhplayer_skeleton import process_bvhfile, process_bvhkeyframes
+
+"""
+CSV output of the command line against the rows of the original converter.
+"""
+
+
+@pytest.fixture
+def clip(tmpdir):
+    filename = str(tmpdir.join("clip.bvh"))
+    generate_bvh(filename, joints=12, depth=5, fanout=3, frames=40, six_channel=0.2, seed=11)
+    return filename
+
+
+def convert(monkeypatch, *argv):
+    monkeypatch.setattr(sys, "argv", ["bvh-converter"] + list(argv))
+    main()
+
+
+def baseline_csv(filename, rotations=False):
+    """The CSV bytes the original converter wrote for the same forward
+    kinematics: get_frames_worldpos() rows through csv.writer."""
+    skeleton = process_bvhfile(filename)
+    process_bvhkeyframes(skeleton.keyframes, skeleton.root)
+    header, frames = skeleton.get_frames_rotations() if rotations else skeleton.get_frames_worldpos()
+    f = io.StringIO(newline="")
+    writer = csv.writer(f)
+    writer.writerow(header)
+    for frame in frames:
+        writer.writerow(frame)
+    return f.getvalue().encode("ascii")
+
+
+def read_table(data):
+    rows = list(csv.reader(io.StringIO(data.decode("ascii"), newline="")))
+    return rows[0], np.array(rows[1:], dtype=float)
+
+
+def test_default_output_matches_baseline(monkeypatch, clip):
+    convert(monkeypatch, clip, "--rotation")
+    with open(clip[:-4] + "_worldpos.csv", "rb") as f:
+        assert f.read() == baseline_csv(clip)
+    with open(clip[:-4] + "_rotations.csv", "rb") as f:
+        assert f.read() == baseline_csv(clip, rotations=True)
+
+
+def test_precision(monkeypatch, clip):
+    convert(monkeypatch, clip, "--precision", "3")
+    with open(clip[:-4] + "_worldpos.csv", "rb") as f:
+        data = f.read()
+    header, table = read_table(data)
+    expected_header, expected = read_table(baseline_csv(clip))
+    assert header == expected_header
+    assert all(len(value.split(".")[1]) == 3 for value in data.decode("ascii").splitlines()[1].split(","))
+    np.testing.assert_allclose(table, expected, rtol=0, atol=0.0005 + 1e-9)
+
+
+def test_compress_gz(monkeypatch, clip):
+    convert(monkeypatch, clip, "--compress", "gz")
+    with gzip.open(clip[:-4] + "_worldpos.csv.gz", "rb") as f:
+        assert f.read() == baseline_csv(clip)
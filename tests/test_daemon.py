@@ -0,0 +1,56 @@
+from __future__ import print_function, division
+
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from benchmarks.synthetic import generate_bvh
+from bvh_converter.daemon import ConversionDaemon
+
+"""
+Conversion daemon jobs, called directly rather than through the socket.
+"""
+
+
+@pytest.fixture
+def daemon(tmpdir):
+    daemon = ConversionDaemon(str(tmpdir.join("daemon.sock")), max_jobs=1)
+    yield daemon
+    daemon.stop()
+    daemon.serve()
+
+
+def convert(daemon, argv, cwd):
+    messages = []
+    daemon.convert({"argv": argv, "cwd": cwd}, messages.append)
+    return messages
+
+
+@pytest.mark.skipif(not hasattr(os, "mkfifo"), reason="needs named pipes")
+def test_worker_dies(tmpdir, daemon):
+    generate_bvh(str(tmpdir.join("clip.bvh")), joints=5, depth=3, frames=10)
+    # The job on the pipe blocks its worker until the worker is killed.
+    os.mkfifo(str(tmpdir.join("pipe.bvh")))
+    messages = []
+    thread = threading.Thread(target=lambda: messages.extend(convert(daemon, ["pipe.bvh"], str(tmpdir))))
+    thread.daemon = True
+    thread.start()
+    deadline = time.time() + 30
+    while not daemon.pool._processes and time.time() < deadline:
+        time.sleep(0.05)
+    time.sleep(0.5)
+    for pid in list(daemon.pool._processes):
+        os.kill(pid, signal.SIGKILL)
+    thread.join(30)
+    assert not thread.is_alive()
+    assert messages[0]["error"].startswith("BrokenProcessPool")
+    assert messages[-1]["failed"] == 1
+
+    messages = convert(daemon, ["clip.bvh"], str(tmpdir))
+    assert messages[0]["error"] is None
+    assert messages[-1]["failed"] == 0
+    status = daemon.status()
+    assert (status["jobs_pending"], status["jobs_done"], status["jobs_failed"]) == (0, 2, 1)
@@ -0,0 +1,115 @@
+from __future__ import print_function, division
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import generate_bvh
+from bvh_converter.bvhplayer_skeleton import (process_bvhfile, process_bvhfile_chunks, process_bvhfile_lazy,
+                                              process_bvhkeyframe, process_bvhkeyframes)
+from bvh_converter.parallel import process_bvhkeyframes_parallel
+
+"""
+The forward kinematics paths against process_bvhkeyframe, frame by frame,
+on a clip with a 6-channel ZXY root and mixed rotation orders.
+"""
+
+
+@pytest.fixture(scope="module")
+def clip(tmpdir_factory):
+    filename = str(tmpdir_factory.mktemp("fk").join("clip.bvh"))
+    generate_bvh(filename, joints=40, depth=10, fanout=3, frames=150, six_channel=0.2, seed=7)
+    return filename
+
+
+@pytest.fixture(scope="module")
+def reference(clip):
+    skeleton = process_bvhfile(clip, keep_trtr=True)
+    assert skeleton.root.channels[:3] == ["Xposition", "Yposition", "Zposition"]
+    assert skeleton.root.channels[3:] == ["Zrotation", "Xrotation", "Yrotation"]
+    for t, keyframe in enumerate(skeleton.keyframes):
+        process_bvhkeyframe(keyframe, skeleton.root, t)
+    return skeleton
+
+
+def assert_same_motion(skeleton, reference, start=0):
+    stop = start + len(skeleton.worldpos)
+    np.testing.assert_allclose(skeleton.worldpos, reference.worldpos[start:stop], rtol=0, atol=1e-10)
+    np.testing.assert_allclose(skeleton.rotations, reference.rotations[start:stop], rtol=0, atol=1e-10)
+
+
+def test_process_bvhkeyframes(clip, reference):
+    skeleton = process_bvhfile(clip, keep_trtr=True)
+    process_bvhkeyframes(skeleton.keyframes, skeleton.root)
+    assert_same_motion(skeleton, reference)
+    np.testing.assert_allclose(skeleton.trtr, reference.trtr, rtol=0, atol=1e-10)
+
+
+def test_evaluate_pose(clip, reference):
+    skeleton = process_bvhfile(clip)
+    for t, keyframe in enumerate(skeleton.keyframes):
+        skeleton.evaluate_pose(keyframe, t)
+    assert_same_motion(skeleton, reference)
+
+
+def test_process_bvhfile_chunks(clip, reference):
+    first_frames = []
+    for skeleton in process_bvhfile_chunks(clip, chunk_frames=64):
+        assert_same_motion(skeleton, reference, skeleton.first_frame)
+        first_frames.append(skeleton.first_frame)
+    assert first_frames == [0, 64, 128]
+
+
+def test_lazy_skeleton_windows(clip, reference):
+    lazy = process_bvhfile_lazy(clip)
+    try:
+        for start, stop in ((0, 1), (10, 90), (149, 150), (0, 150)):
+            assert_same_motion(lazy.get_window(start, stop), reference, start)
+    finally:
+        lazy.close()
+
+
+def test_parallel(clip, reference):
+    skeleton = process_bvhfile(clip, keep_trtr=True)
+    process_bvhkeyframes_parallel(skeleton, jobs=3)
+    assert_same_motion(skeleton, reference)
+    np.testing.assert_allclose(skeleton.trtr, reference.trtr, rtol=0, atol=1e-10)
+
+
+REPEATED_CHANNELS = """HIERARCHY
+ROOT Hips
+{
+  OFFSET 0 0 0
+  CHANNELS 6 Xposition Yposition Zposition Yrotation Xrotation Zrotation
+  JOINT Spine
+  {
+    OFFSET 0 10 0
+    CHANNELS 3 Xrotation Xrotation Zrotation
+    End Site
+    {
+      OFFSET 0 10 0
+    }
+  }
+}
+MOTION
+Frames: 2
+Frame Time: 0.0083333
+1 2 3 10 20 30 70 80 90
+-1 -2 -3 -10 -20 -30 15 -25 35
+"""
+
+
+def test_repeated_channels(tmpdir):
+    # process_bvhkeyframe needs all three rotation channels, so
+    # process_bvhkeyframes is the reference here.
+    filename = str(tmpdir.join("repeated.bvh"))
+    with open(filename, "w") as f:
+        f.write(REPEATED_CHANNELS)
+    reference = process_bvhfile(filename)
+    process_bvhkeyframes(reference.keyframes, reference.root)
+    spine = [joint.name for joint in reference.joints].index("Spine")
+    np.testing.assert_array_equal(reference.rotations[:, spine], [[80, 0, 90], [-25, 0, 35]])
+
+    skeleton = process_bvhfile(filename)
+    for t, keyframe in enumerate(skeleton.keyframes):
+        skeleton.evaluate_pose(keyframe, t)
+    assert_same_motion(skeleton, reference)
@@ -0,0 +1,49 @@
+from __future__ import print_function, division
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import generate_bvh
+from bvh_converter.bvhplayer_skeleton import process_bvhfile, process_bvhkeyframes
+
+"""
+Forward kinematics in float32 against float64 on a synthetic clip.
+"""
+
+
+@pytest.fixture(scope="module")
+def clip(tmpdir_factory):
+    filename = str(tmpdir_factory.mktemp("float32").join("clip.bvh"))
+    generate_bvh(filename, joints=60, depth=12, fanout=3, frames=200, six_channel=0.2, seed=3)
+    return filename
+
+
+def convert(filename, dtype):
+    skeleton = process_bvhfile(filename, dtype=dtype)
+    process_bvhkeyframes(skeleton.keyframes, skeleton.root)
+    return skeleton
+
+
+def chain_lengths(skeleton):
+    """Return the length of the offset chain from the root to every joint."""
+    lengths = []
+    for joint in skeleton.joints:
+        length = 0.
+        while joint.hasparent:
+            length += np.linalg.norm(joint.strans)
+            joint = joint.parent
+        lengths.append(length)
+    return np.array(lengths)
+
+
+def test_float32_worldpos_matches_float64(clip):
+    double = convert(clip, np.float64)
+    single = convert(clip, np.float32)
+    assert single.keyframes.dtype == np.float32
+    assert single.worldpos.dtype == np.float32
+    assert single.rotations.dtype == np.float32
+    assert single.worldpos.shape == double.worldpos.shape
+
+    error = np.abs(single.worldpos.astype(np.float64) - double.worldpos).max(axis=2)
+    bound = 1e-6 * (np.linalg.norm(double.worldpos, axis=2) + chain_lengths(double))
+    assert (error <= bound).all(), "max error ratio {}".format((error / bound).max())
@@ -0,0 +1,47 @@
+from __future__ import print_function, division
+
+import pytest
+
+from bvh_converter.bvhplayer_skeleton import process_bvhfile_follow
+
+"""
+Following a BVH file that is already complete.
+"""
+
+
+HEADER = """HIERARCHY
+ROOT Hips
+{
+  OFFSET 0 0 0
+  CHANNELS 6 Xposition Yposition Zposition Zrotation Xrotation Yrotation
+  End Site
+  {
+    OFFSET 0 10 0
+  }
+}
+MOTION
+Frames: 4
+Frame Time: 0.0083333
+"""
+
+
+def follow(filename, **kwargs):
+    return list(process_bvhfile_follow(filename, poll_interval=0.01, timeout=0.05, **kwargs))
+
+
+@pytest.mark.parametrize("step", [1, 2])
+def test_error_line_after_blank_lines(tmpdir, step):
+    filename = str(tmpdir.join("blank.bvh"))
+    with open(filename, "w") as f:
+        f.write(HEADER + "0 0 0 0 0 0\n\n\n0 0 0 0 0 0\n\n0 0 0 0 0 0\n0 0 0 0 x 0\n")
+    with pytest.raises(SyntaxError) as error:
+        follow(filename, step=step, start=1)
+    assert "line 20:" in str(error.value)
+
+
+def test_blank_lines_are_skipped(tmpdir):
+    filename = str(tmpdir.join("blank.bvh"))
+    with open(filename, "w") as f:
+        f.write(HEADER + "1 0 0 0 0 0\n\n2 0 0 0 0 0\n\n\n3 0 0 0 0 0\n")
+    skeletons = follow(filename)
+    assert [row[0] for skeleton in skeletons for row in skeleton.keyframes] == [1, 2, 3]
@@ -0,0 +1,74 @@
+from __future__ import print_function, division
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import generate_bvh
+from bvh_converter.bvhplayer_skeleton import process_bvhfile, process_bvhkeyframes
+from bvh_converter.rotations import joint_rotations, quat_to_matrix
+
+"""
+Joint rotations against the orientations from forward kinematics.
+"""
+
+
+TWO_ORDERS = """HIERARCHY
+ROOT Hips
+{
+  OFFSET 0 0 0
+  CHANNELS 6 Xposition Yposition Zposition Zrotation Xrotation Yrotation
+  JOINT Spine
+  {
+    OFFSET 0 10 0
+    CHANNELS 3 Xrotation Yrotation Zrotation
+    End Site
+    {
+      OFFSET 0 10 0
+    }
+  }
+}
+MOTION
+Frames: 2
+Frame Time: 0.0083333
+0 0 0 30 -45 60 30 -45 60
+1 2 3 -10 20 170 -10 20 170
+"""
+
+
+@pytest.fixture(scope="module")
+def clip(tmpdir_factory):
+    filename = str(tmpdir_factory.mktemp("rotations").join("clip.bvh"))
+    generate_bvh(filename, joints=60, depth=12, fanout=3, frames=200, six_channel=0.2, seed=5)
+    return filename
+
+
+def test_global_quaternions_match_orientations(clip):
+    skeleton = process_bvhfile(clip, keep_orientations=True)
+    process_bvhkeyframes(skeleton.keyframes, skeleton.root)
+    matrices = quat_to_matrix(joint_rotations(skeleton, "quat", "global"))
+    assert matrices.shape == skeleton.orientations.shape
+    np.testing.assert_allclose(matrices, skeleton.orientations, atol=1e-12)
+
+
+def test_local_quaternions_follow_channel_order(tmpdir):
+    filename = str(tmpdir.join("orders.bvh"))
+    with open(filename, "w") as f:
+        f.write(TWO_ORDERS)
+    skeleton = process_bvhfile(filename)
+    names = [joint.name for joint in skeleton.joints]
+    hips, spine = names.index("Hips"), names.index("Spine")
+    quats = joint_rotations(skeleton, "quat", "local")
+    assert not np.allclose(quats[:, hips], quats[:, spine])
+
+    # Each one is the product of its channel rotations in channel order.
+    for joint, order in ((hips, "ZXY"), (spine, "XYZ")):
+        for frame, angles in enumerate(skeleton.keyframes[:, 3:6]):
+            expected = np.eye(3)
+            for axis, angle in zip(order, np.radians(angles)):
+                c, s = np.cos(angle), np.sin(angle)
+                i, k = [(1, 2), (2, 0), (0, 1)]["XYZ".index(axis)]
+                rotation = np.eye(3)
+                rotation[i, i] = rotation[k, k] = c
+                rotation[i, k], rotation[k, i] = -s, s
+                expected = expected.dot(rotation)
+            np.testing.assert_allclose(quat_to_matrix(quats[frame, joint]), expected, atol=1e-12)
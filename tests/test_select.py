@@ -0,0 +1,48 @@
+from __future__ import print_function, division
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import generate_bvh
+from bvh_converter.bvhplayer_skeleton import process_bvhfile, process_bvhkeyframes
+
+"""
+Joint selection against the full skeleton.
+"""
+
+
+@pytest.fixture(scope="module")
+def clip(tmpdir_factory):
+    filename = str(tmpdir_factory.mktemp("select").join("clip.bvh"))
+    generate_bvh(filename, joints=30, depth=8, fanout=3, frames=50, six_channel=0.2, seed=13)
+    return filename
+
+
+def convert(filename, select=None):
+    skeleton = process_bvhfile(filename, select=select)
+    process_bvhkeyframes(skeleton.keyframes, skeleton.root)
+    return skeleton
+
+
+@pytest.mark.parametrize("as_list", [False, True])
+def test_leaf_joint_matches_full_run(clip, as_list):
+    full = convert(clip)
+    leaf = [joint for joint in full.joints if joint.name.endswith("End")][-1]
+    parent = leaf.parent.name
+    selected = convert(clip, [parent, leaf.name] if as_list else parent)
+    names = [joint.name for joint in selected.joints]
+    assert names == ([parent, leaf.name] if as_list else [parent])
+
+    columns = [joint.index for joint in full.joints if joint.name in names]
+    np.testing.assert_array_equal(selected.worldpos, full.worldpos[:, columns])
+    np.testing.assert_array_equal(selected.rotations, full.rotations[:, columns])
+    header, frames = selected.get_frames_worldpos()
+    full_header, full_frames = full.get_frames_worldpos()
+    keep = [0] + [i for i, name in enumerate(full_header) if name.rsplit(".", 1)[0] in names]
+    assert header == [full_header[i] for i in keep]
+    assert frames == [[row[i] for i in keep] for row in full_frames]
+
+
+def test_unknown_joint(clip):
+    with pytest.raises(ValueError):
+        process_bvhfile(clip, select="Nope")
@@ -0,0 +1,46 @@
+from __future__ import print_function, division
+
+import os
+
+import pytest
+
+from benchmarks.synthetic import generate_bvh
+from bvh_converter.bvhplayer_skeleton import process_bvhfile
+from bvh_converter.cache import ParseCache
+from bvh_converter.stats import NO_STATS, ConversionStats
+
+"""
+Statistics of the bytes read, and the stages of NO_STATS.
+"""
+
+
+@pytest.fixture
+def clip(tmpdir):
+    filename = str(tmpdir.join("clip.bvh"))
+    generate_bvh(filename, joints=20, depth=6, fanout=3, frames=100, seed=17)
+    return filename
+
+
+def bytes_read(filename, cache=None):
+    stats = ConversionStats()
+    process_bvhfile(filename, cache=cache, stats=stats)
+    return stats.bytes_read
+
+
+def entry_size(cache):
+    return sum(size for _, size, _ in cache.entries())
+
+
+@pytest.mark.parametrize("use_hash", [True, False])
+def test_cache_bytes_read(tmpdir, clip, use_hash):
+    cache = ParseCache(str(tmpdir.join("cache")), use_hash=use_hash)
+    size = os.path.getsize(clip)
+    assert bytes_read(clip) == size
+    assert bytes_read(clip, cache) == (2 * size if use_hash else size)
+    assert bytes_read(clip, cache) == entry_size(cache) + (size if use_hash else 0)
+
+
+def test_null_stage_ignores_frames():
+    with NO_STATS.stage("read") as stage:
+        stage.frames = 10
+    assert NO_STATS.stage("read").frames == 0